@@ -0,0 +1,74 @@
+# Equivalence check of the DBSCAN engines: the grid engine and the tiled run must give the same labels as a
+# single-pass scikit-learn DBSCAN. The random clouds are close to the density threshold, so many border points
+# touch more than one cluster, which is where the engines can disagree. Run from the repository root:
+#   python -m benchmarks.check_dbscan --trials 40
+
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+import bin.tiling as tl
+from bin.clustering import dbscan_grid
+
+def random_cloud(rng, n_points, size):
+    points = rng.uniform(0, size, (n_points, 3))
+    points[:, 1] *= 0.3  # thin in Y, like a cliff face
+    return points
+
+def shared_borders(points, labels, core, eps):
+    # Border points with core neighbours of two or more clusters
+    border = np.flatnonzero(~core & (labels >= 0))
+    if not border.size:
+        return 0
+    neighbours = NearestNeighbors(radius=eps).fit(points[core]).radius_neighbors(points[border], return_distance=False)
+    core_labels = labels[core]
+    return sum(len(np.unique(core_labels[n])) > 1 for n in neighbours)
+
+def tiled_labels(points, eps, min_samples, tile_size, halo):
+    diff_cluster = tl.tiled_dbscan_core(pd.DataFrame(points, columns=['x', 'y', 'z']), eps, min_samples, tile_size, halo)
+    labels = np.full(points.shape[0], -1)
+    labels[diff_cluster.index] = diff_cluster['rockfall_label'].values
+    return labels
+
+def check(trials, n_points, size, eps, min_samples, tile_size, halo, seed=0):
+    failures = {'grid': 0, 'tiled': 0}
+    shared = 0
+    for trial in range(trials):
+        points = random_cloud(np.random.default_rng(seed + trial), n_points, size)
+        reference = DBSCAN(eps=eps, min_samples=min_samples).fit(points)
+        core = np.zeros(n_points, dtype=bool)
+        core[reference.core_sample_indices_] = True
+        shared += shared_borders(points, reference.labels_, core, eps)
+        results = {'grid': dbscan_grid(points, eps, min_samples)[0], 'tiled': tiled_labels(points, eps, min_samples, tile_size, halo)}
+        for engine, labels in results.items():
+            if not np.array_equal(labels, reference.labels_):
+                failures[engine] += 1
+                print(f"Trial {trial}: {engine} differs from scikit-learn in {(labels != reference.labels_).sum()} points")
+    return failures, shared
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the grid and tiled DBSCAN engines match scikit-learn")
+    parser.add_argument('--trials', type=int, default=40, help="Random clouds to check (default: 40)")
+    parser.add_argument('--points', type=int, default=1500, help="Points per cloud (default: 1500)")
+    parser.add_argument('--size', type=float, default=6.0, help="Side of the cloud in m (default: 6)")
+    parser.add_argument('--eps', type=float, default=0.35)
+    parser.add_argument('--min-samples', type=int, default=5)
+    parser.add_argument('--tile-size', type=float, default=1.5)
+    parser.add_argument('--halo', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    failures, shared = check(args.trials, args.points, args.size, args.eps, args.min_samples, args.tile_size, args.halo, args.seed)
+    print(f"\n{args.trials} clouds, {shared} border points shared by two or more clusters")
+    for engine, count in failures.items():
+        print(f"  {engine}: {args.trials - count} of {args.trials} identical to scikit-learn")
+    if not shared:
+        print("WARNING: no border point touches two clusters, increase --points or --eps")
+    return 0 if not any(failures.values()) and shared else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# Benchmark harness: times the main PyRockDiff stages on a synthetic cliff and checks the detected volumes
+# against the ground truth of the generator. Run from the repository root:
+#   python -m benchmarks.run_benchmark --points 1e6 5e6 --output /tmp/pyrockdiff_bench
+
+import os
+import sys
+import json
+import argparse
+import datetime
+import subprocess
+import numpy as np
+import bin.telemetry as tm
+import bin.cleaning as cl
+import bin.registration as reg
+import bin.m3c2 as m3c2
+import bin.clustering as rf
+import bin.volume as vl
+from bin.utils import loadPC, create_folder
+from benchmarks.synthetic_cliff import generate
+
+STAGES = ['outlier_filter', 'FGR_reg', 'm3c2', 'dbscan', 'volume']
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_parameters(truth, eps=0.3):
+    # min_samples follows the density of the synthetic cliff, like the auto_parameters option
+    return {'nb_neighbors_f': 10, 'std_ratio_f': 1.5, 'voxel_size': 0.25, 'ite_FGR': 2,
+            'diff_threshold': -0.05, 'eps_rockfalls': eps,
+            'min_samples_rockfalls': max(5, int(0.3 * truth['density'] * np.pi * eps ** 2)),
+            'volume_workers': 0}
+
+def run_stages(truth, run_folder, stages, parameters):
+    e1_path, e2_path = truth['e1'], truth['e2']
+    e1e2_change_path = e1ve2_DBSCAN_path = volumes_db = None
+
+    if 'outlier_filter' in stages:
+        folder = create_folder(run_folder, '1.3_clean')
+        with tm.stage('outlier_filter', [e1_path, e2_path]) as record:
+            e1_path = cl.outlier_filter(e1_path, parameters['nb_neighbors_f'], parameters['std_ratio_f'], folder)
+            e2_path = cl.outlier_filter(e2_path, parameters['nb_neighbors_f'], parameters['std_ratio_f'], folder)
+            record['outputs'] = [e1_path, e2_path]
+
+    if 'FGR_reg' in stages:
+        folder = create_folder(run_folder, '2_registration')
+        with tm.stage('FGR_reg', [e1_path, e2_path]) as record:
+            e1_path, e2_path = reg.FGR_reg(parameters['voxel_size'], e1_path, e2_path, folder, parameters['ite_FGR'], gui=False)
+            record['outputs'] = [e1_path, e2_path]
+
+    if 'm3c2' in stages:
+        folder = create_folder(run_folder, '3_change_detection')
+        with tm.stage('m3c2', [e1_path, e2_path]) as record:
+            e1e2_change_path = m3c2.m3c2_core(None, e1_path, e2_path, truth['m3c2_param'], folder, truth['e1'], truth['e2'], engine='native')
+            record['outputs'] = [e1e2_change_path]
+
+    if 'dbscan' in stages and e1e2_change_path:
+        folder = create_folder(run_folder, '4_dbscan')
+        with tm.stage('dbscan', [e1e2_change_path]) as record:
+            e1ve2_DBSCAN_path = rf.dbscan(folder, e1e2_change_path, parameters)
+            record['outputs'] = [e1ve2_DBSCAN_path]
+
+    if 'volume' in stages and e1ve2_DBSCAN_path:
+        folder = create_folder(run_folder, '5_volume')
+        with tm.stage('volume', [e1ve2_DBSCAN_path]):
+            volumes_db, _ = vl.volume(e1ve2_DBSCAN_path, folder, parameters['volume_workers'])
+
+    return e1ve2_DBSCAN_path, volumes_db
+
+def check_volumes(truth, e1ve2_DBSCAN_path, volumes_db, tolerance):
+    # Every cluster is assigned to the rockfall scar that contains its centroid
+    rockfalls = loadPC(e1ve2_DBSCAN_path)
+    centroids = rockfalls.groupby('rockfall_label')[['x', 'z']].mean()
+    volumes = volumes_db.set_index('rockfall_label')['total_volume']
+    assigned = set()
+    results = []
+    for r in truth['rockfalls']:
+        r2 = ((centroids['x'] - r['center'][0]) / r['a']) ** 2 + ((centroids['z'] - r['center'][1]) / r['b']) ** 2
+        labels = centroids.index[r2 < 1].tolist()
+        assigned.update(labels)
+        detected = float(volumes.reindex(labels).fillna(0).sum())
+        error = (detected - r['volume']) / r['volume']
+        results.append({'id': r['id'], 'volume': round(r['volume'], 4), 'detected': round(detected, 4), 'clusters': len(labels),
+                        'relative_error': round(error, 4), 'ok': bool(labels) and abs(error) <= tolerance})
+    false_positives = [int(label) for label in centroids.index if label not in assigned]
+    return results, false_positives
+
+def print_summary(records, results, false_positives, tolerance):
+    print(f"\n{'Stage':<16}{'Wall (s)':>10}{'CPU (s)':>10}{'Peak RSS (MB)':>15}{'Points':>12}{'Points/s':>12}")
+    for record in records:
+        print(f"{record['stage']:<16}{record['wall_s']:>10.2f}{record['cpu_s'] + record['cpu_children_s']:>10.2f}"
+              f"{record['peak_rss_mb'] or 0:>15.1f}{record['inputs']['points'] or 0:>12}{record.get('points_per_s', 0):>12.0f}")
+    if results is not None:
+        ok = sum(r['ok'] for r in results)
+        print(f"\nVolumes within {tolerance:.0%} of the ground truth: {ok} of {len(results)} rockfalls "
+              f"({len(false_positives)} clusters outside the rockfalls)")
+        for r in results:
+            if not r['ok']:
+                print(f"  Rockfall {r['id']}: {r['detected']} m³ detected, {r['volume']} m³ expected ({r['clusters']} clusters)")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PyRockDiff benchmark on synthetic cliffs with known rockfalls")
+    parser.add_argument('-n', '--points', type=float, nargs='+', default=[1e6], help="Points per epoch, one run per value (default: 1e6)")
+    parser.add_argument('-o', '--output', default='benchmark_runs', help="Folder for the synthetic data, results and reports")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help="Stages to run (default: all)")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Maximum relative volume error (default: 0.2)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help="Generate the synthetic clouds even if they already exist")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    passed = True
+    for n_points in map(int, args.points):
+        data_folder = os.path.join(args.output, f'cliff_{n_points}_seed{args.seed}')
+        truth_path = os.path.join(data_folder, 'truth.json')
+        if args.regenerate or not os.path.exists(truth_path):
+            print(f"Generating synthetic cliff: {n_points} points per epoch")
+            generate(data_folder, n_points, seed=args.seed)
+        with open(truth_path) as f:
+            truth = json.load(f)
+
+        timestamp = datetime.datetime.now().strftime('%y%m%d_%H%M%S')
+        run_folder = create_folder(args.output, f'run_{timestamp}_{n_points}')
+        report = tm.start_report(run_folder)
+        parameters = benchmark_parameters(truth)
+        e1ve2_DBSCAN_path, volumes_db = run_stages(truth, run_folder, args.stages, parameters)
+
+        results, false_positives = None, []
+        if volumes_db is not None:
+            results, false_positives = check_volumes(truth, e1ve2_DBSCAN_path, volumes_db, args.tolerance)
+            passed &= all(r['ok'] for r in results)
+        print_summary(report['stages'], results, false_positives, args.tolerance)
+
+        summary = {'revision': git_revision(), 'created': timestamp, 'n_points': n_points, 'seed': args.seed,
+                   'parameters': parameters, 'tolerance': args.tolerance, 'stages': report['stages'],
+                   'volumes': results, 'false_positives': false_positives}
+        with open(os.path.join(run_folder, 'benchmark.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"Benchmark report: {os.path.join(run_folder, 'benchmark.json')}")
+    return 0 if passed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
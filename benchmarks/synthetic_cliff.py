@@ -0,0 +1,145 @@
+# Synthetic two-epoch cliff generator for the PyRockDiff benchmarks.
+# The cliff face lies on the XZ plane (x along the cliff, z height) and faces +Y, like the ROI, plots and volumes.
+# Rockfalls are ellipsoidal scars removed from the second epoch, so their volume is known: pi * a * b * depth / 2.
+
+import os
+import json
+import argparse
+import numpy as np
+
+CHUNK_SIZE = 1000000
+M3C2_PARAMS = """[General]
+M3C2VER=1
+NormalMode=0
+NormalScale=0.4
+NormalMinScale=0.2
+NormalStep=0.2
+NormalMaxScale=0.8
+NormalPreferedOri=2
+SearchScale=0.25
+SearchDepth=3
+RegistrationErrorEnabled=false
+UseSinglePass4Depth=false
+PositiveSearchOnly=false
+UseMedian=false
+UseMinPoints4Stat=false
+"""
+
+def surface(x, z):
+    # Smooth relief with gentle slopes, so the M3C2 normals stay close to +Y
+    return 0.3 * np.sin(0.31 * x) + 0.2 * np.cos(0.47 * z) + 0.15 * np.sin(0.73 * x + 0.41 * z)
+
+def make_rockfalls(rng, width, height, n_rockfalls, margin=4.0):
+    rockfalls = []
+    for _ in range(1000 * n_rockfalls):
+        if len(rockfalls) == n_rockfalls:
+            break
+        a, b = rng.uniform(0.6, 3.0, 2)
+        center = rng.uniform([margin, margin], [width - margin, height - margin])
+        # Scars do not overlap so every detected cluster can be matched to a single rockfall
+        if any(np.hypot(*(center - r['center'])) < max(a, b) + max(r['a'], r['b']) + 1.0 for r in rockfalls):
+            continue
+        depth = rng.uniform(0.2, 0.6) * min(a, b)  # shallow scars: M3C2 can't resolve walls steeper than its cylinder
+        rockfalls.append({'id': len(rockfalls), 'center': center, 'a': a, 'b': b, 'depth': depth,
+                          'volume': np.pi * a * b * depth / 2})
+    if len(rockfalls) < n_rockfalls:
+        raise ValueError(f"{n_rockfalls} rockfalls don't fit in a {width:.1f} x {height:.1f} m cliff")
+    return rockfalls
+
+def make_vegetation(rng, width, height, n_patches, rockfalls):
+    patches = []
+    for _ in range(1000 * n_patches):
+        if len(patches) == n_patches:
+            break
+        center = rng.uniform([0, 0], [width, height])
+        if any(np.hypot(*(center - r['center'])) < max(r['a'], r['b']) + 2.0 for r in rockfalls):
+            continue
+        patches.append({'center': center, 'radius': rng.uniform(0.5, 1.5)})
+    return patches
+
+def rockfall_depth(x, z, rockfalls):
+    depth = np.zeros_like(x)
+    for r in rockfalls:
+        r2 = ((x - r['center'][0]) / r['a']) ** 2 + ((z - r['center'][1]) / r['b']) ** 2
+        inside = r2 < 1
+        depth[inside] = np.maximum(depth[inside], r['depth'] * (1 - r2[inside]))
+    return depth
+
+def sample_chunk(rng, start, n, nz, spacing, noise, vegetation, patches, rockfalls=None):
+    # Jittered grid, like a cloud subsampled by spatial distance: every epoch gets its own jitter
+    index = np.arange(start, start + n)
+    x = (index // nz + 0.5 + rng.uniform(-0.3, 0.3, n)) * spacing
+    z = (index % nz + 0.5 + rng.uniform(-0.3, 0.3, n)) * spacing
+    y = surface(x, z) + rng.normal(0, noise, n)
+    if rockfalls is not None:
+        y -= rockfall_depth(x, z, rockfalls)
+    points = np.column_stack([x, y, z])
+
+    is_vegetation = rng.random(n) < vegetation if patches else np.zeros(n, dtype=bool)
+    n_vegetation = is_vegetation.sum()
+    if n_vegetation:
+        # Vegetation is sampled again in every epoch: it moves between surveys
+        patch = rng.integers(len(patches), size=n_vegetation)
+        centers = np.array([p['center'] for p in patches])[patch]
+        radius = np.array([p['radius'] for p in patches])[patch]
+        offset = rng.normal(0, 0.5, (n_vegetation, 2)) * radius[:, None]
+        vx, vz = centers[:, 0] + offset[:, 0], centers[:, 1] + offset[:, 1]
+        vy = surface(vx, vz) + rng.uniform(0.1, 1.0, n_vegetation) * radius
+        points[is_vegetation] = np.column_stack([vx, vy, vz])
+    return points
+
+def write_epoch(path, rng, n_points, nz, spacing, noise, vegetation, patches, rockfalls=None, shift=(0.0, 0.0, 0.0)):
+    # Streamed to a memory-mapped .npy, so clouds larger than the RAM can be generated
+    output = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(n_points, 3))
+    for start in range(0, n_points, CHUNK_SIZE):
+        n = min(CHUNK_SIZE, n_points - start)
+        output[start:start + n] = sample_chunk(rng, start, n, nz, spacing, noise, vegetation, patches, rockfalls) + shift
+    output.flush()
+    del output
+    return path
+
+def generate(output_folder, n_points, density=400.0, height=50.0, n_rockfalls=None, noise=0.01, vegetation=0.02, shift=0.0, seed=0):
+    os.makedirs(output_folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    spacing = 1 / np.sqrt(density)
+    nz = int(round(height / spacing))
+    width = np.ceil(n_points / nz) * spacing
+    if n_rockfalls is None:
+        n_rockfalls = max(5, min(200, int(width * height / 250)))
+    rockfalls = make_rockfalls(rng, width, height, n_rockfalls)
+    patches = make_vegetation(rng, width, height, max(1, n_rockfalls // 2), rockfalls) if vegetation > 0 else []
+
+    e1_path = write_epoch(os.path.join(output_folder, 'e1.npy'), rng, n_points, nz, spacing, noise, vegetation, patches)
+    e2_path = write_epoch(os.path.join(output_folder, 'e2.npy'), rng, n_points, nz, spacing, noise, vegetation, patches,
+                          rockfalls, shift=(shift, shift, 0.0))
+    m3c2_param = os.path.join(output_folder, 'm3c2_params.txt')
+    with open(m3c2_param, 'w') as f:
+        f.write(M3C2_PARAMS)
+
+    truth = {'n_points': n_points, 'density': density, 'width': float(width), 'height': height, 'noise': noise,
+             'vegetation': vegetation, 'shift': shift, 'seed': seed,
+             'e1': e1_path, 'e2': e2_path, 'm3c2_param': m3c2_param,
+             'rockfalls': [dict(r, center=r['center'].tolist()) for r in rockfalls]}
+    with open(os.path.join(output_folder, 'truth.json'), 'w') as f:
+        json.dump(truth, f, indent=2)
+    return truth
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic two-epoch cliff with known rockfalls")
+    parser.add_argument('output', help="Output folder (e1.npy, e2.npy, truth.json and m3c2_params.txt)")
+    parser.add_argument('-n', '--points', type=float, default=1e6, help="Points per epoch (default: 1e6)")
+    parser.add_argument('--density', type=float, default=400.0, help="Points per m² (default: 400, ~5 cm spacing)")
+    parser.add_argument('--height', type=float, default=50.0, help="Cliff height in m (default: 50)")
+    parser.add_argument('--rockfalls', type=int, help="Number of rockfalls (default: 1 every 250 m²)")
+    parser.add_argument('--noise', type=float, default=0.01, help="Gaussian noise in m (default: 0.01)")
+    parser.add_argument('--vegetation', type=float, default=0.02, help="Fraction of vegetation points (default: 0.02)")
+    parser.add_argument('--shift', type=float, default=0.0, help="Misalignment of the second epoch in m (default: 0)")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    truth = generate(args.output, int(args.points), args.density, args.height, args.rockfalls, args.noise,
+                     args.vegetation, args.shift, args.seed)
+    print(f"{truth['n_points']} points per epoch ({truth['width']:.1f} x {truth['height']:.1f} m) "
+          f"with {len(truth['rockfalls'])} rockfalls written to {args.output}")
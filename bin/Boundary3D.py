@@ -1,8 +1,16 @@
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.path import Path as MplPath
+from pathlib import Path
+from scipy import ndimage
 import alphashape
-from bin.utils import loadPC, savePC, get_file_name
+from bin.utils import loadPC, savePC, get_file_name, _print, PC_EXT
 import os
+
+ROI_CELL_SIZE = 0.25
+ROI_CLOSING = 2  # cells
+ROI_CHUNK_SIZE = 5000000
 def extract_boundary(epoch_xz):
     #alpha = 0.95 * alphashape.optimizealpha(epoch_xz)
     alpha = 0.5
@@ -19,7 +27,7 @@ def extract_boundary(epoch_xz):
                 id = i
         hull_pts = polygon[id]
         hull_pts = hull_pts.exterior.coords.xy
-    line = plt.plot(hull_pts[0], hull_pts[1])
+    line = MplPath(np.column_stack(hull_pts))
     return hull_pts, line
 
 def plot_boundary(epoch, hull_pts, plot=False):
@@ -29,32 +37,117 @@ def plot_boundary(epoch, hull_pts, plot=False):
         plt.scatter(epoch[:,0], epoch[:,2], c='r', s=0.001)
         plt.show()
 def remove_points(epoch, line):
-    mask = line[0].get_path().contains_points(epoch[:,[0,2]])
+    mask = line.contains_points(epoch[:,[0,2]])
     filtered_epoch = epoch[mask]
     return filtered_epoch
 
-def main_2Dcut(epoch1_path, epoch2_path, registration_path):
-    epoch1 = loadPC(epoch1_path)
-    epoch2 = loadPC(epoch2_path)
+def main_2Dcut(epoch1_path, epoch2_path, registration_path, plot=True):
+    epoch1 = loadPC(epoch1_path, array=True)
+    epoch2 = loadPC(epoch2_path, array=True)
     epoch1_name = get_file_name(epoch1_path)
     epoch2_name = get_file_name(epoch2_path)
 
     epoch_xz = epoch1[:, [0, 2]]
     hull_pts, line = extract_boundary(epoch_xz)
-    plot_boundary(epoch2, hull_pts, plot=True)
-    plot_boundary(epoch1, hull_pts, plot=True)
+    plot_boundary(epoch2, hull_pts, plot=plot)
+    plot_boundary(epoch1, hull_pts, plot=plot)
     epoch1_cut = remove_points(epoch1, line)
     epoch2_cut = remove_points(epoch2, line)
 
     epoch_xz = epoch2_cut[:, [0, 2]]
     hull_pts, line = extract_boundary(epoch_xz)
-    plot_boundary(epoch1_cut, hull_pts, plot=True)
-    plot_boundary(epoch2_cut, hull_pts, plot=True)
+    plot_boundary(epoch1_cut, hull_pts, plot=plot)
+    plot_boundary(epoch2_cut, hull_pts, plot=plot)
 
     epoch1_cut = remove_points(epoch1_cut, line)
     epoch2_cut = remove_points(epoch2_cut, line)
-    epoch1_cut_path = savePC(os.path.join(registration_path, epoch1_name + '_cut.xyz'), epoch1_cut)
-    epoch2_cut_path = savePC(os.path.join(registration_path, epoch2_name + '_cut.xyz'), epoch2_cut)
+    epoch1_cut_path = savePC(os.path.join(registration_path, epoch1_name + '_cut' + PC_EXT), epoch1_cut)
+    epoch2_cut_path = savePC(os.path.join(registration_path, epoch2_name + '_cut' + PC_EXT), epoch2_cut)
 
     return epoch1_cut_path, epoch2_cut_path
 
+
+# Raster engine: XZ occupancy grids of both epochs, cleaned with morphology and intersected. Points are clipped with
+# a lookup of their cell, streaming the memory-mapped .npy files chunk by chunk.
+
+def _xz_chunks(path, chunk_size=ROI_CHUNK_SIZE):
+    if Path(path).suffix == PC_EXT:
+        pc = np.load(path, mmap_mode='r')
+    else:
+        pc = loadPC(path, array=True)
+    for start in range(0, pc.shape[0], chunk_size):
+        chunk = pc[start:start + chunk_size]
+        if pc.dtype.names:
+            yield start, np.column_stack([chunk[pc.dtype.names[0]], chunk[pc.dtype.names[2]]]).astype(np.float64)
+        else:
+            yield start, np.asarray(chunk[:, [0, 2]], dtype=np.float64)
+
+def occupied_cells(path, cell_size):
+    cells = []
+    for _, xz in _xz_chunks(path):
+        cells.append(pd.DataFrame(np.floor(xz / cell_size).astype(np.int64)).drop_duplicates().values)
+    cells = np.vstack(cells)
+    return pd.DataFrame(cells).drop_duplicates().values
+
+def footprint(cells, origin, shape, closing=ROI_CLOSING):
+    # Gaps between points are closed, interior holes filled (like the exterior of the alpha shape)
+    # and only the largest connected area is kept
+    grid = np.zeros(shape, dtype=bool)
+    grid[cells[:, 0] - origin[0], cells[:, 1] - origin[1]] = True
+    if closing:
+        grid = ndimage.binary_closing(np.pad(grid, closing), structure=np.ones((3, 3)), iterations=closing)[closing:-closing, closing:-closing]
+    grid = ndimage.binary_fill_holes(grid)
+    return largest_component(grid)
+
+def largest_component(grid):
+    labels, n_labels = ndimage.label(grid)
+    if n_labels <= 1:
+        return grid
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    return labels == np.argmax(sizes)
+
+def clip_points(path, output_path, mask, origin, cell_size):
+    # First pass: cell lookup of every point; second pass: kept points written to a memory-mapped .npy
+    keep = []
+    for _, xz in _xz_chunks(path):
+        cells = np.floor(xz / cell_size).astype(np.int64) - origin
+        inside = np.all((cells >= 0) & (cells < mask.shape), axis=1)
+        chunk_keep = np.zeros(len(xz), dtype=bool)
+        chunk_keep[inside] = mask[cells[inside, 0], cells[inside, 1]]
+        keep.append(chunk_keep)
+    keep = np.concatenate(keep)
+
+    pc = np.load(path, mmap_mode='r') if Path(path).suffix == PC_EXT else loadPC(path, array=True)
+    output = np.lib.format.open_memmap(output_path, mode='w+', dtype=pc.dtype, shape=(int(keep.sum()),) + pc.shape[1:])
+    position = 0
+    for start in range(0, pc.shape[0], ROI_CHUNK_SIZE):
+        kept = pc[start:start + ROI_CHUNK_SIZE][keep[start:start + ROI_CHUNK_SIZE]]
+        output[position:position + len(kept)] = kept
+        position += len(kept)
+    output.flush()
+    del output
+    _print(f'ROI clipping {get_file_name(path)}: {position} of {len(keep)} points kept')
+    return output_path
+
+def plot_footprint(mask, origin, cell_size, plot=False):
+    if plot:
+        extent = [origin[0] * cell_size, (origin[0] + mask.shape[0]) * cell_size, origin[1] * cell_size, (origin[1] + mask.shape[1]) * cell_size]
+        plt.figure()
+        plt.imshow(mask.T, origin='lower', extent=extent, cmap='Greys')
+        plt.title('ROI footprint (XZ)')
+        plt.show()
+
+def raster_2Dcut(epoch1_path, epoch2_path, output_folder, cell_size=ROI_CELL_SIZE, closing=ROI_CLOSING, plot=False):
+    _print(f'ROI clipping (raster engine): cell size {cell_size} m, closing {closing} cells')
+    cells1 = occupied_cells(epoch1_path, cell_size)
+    cells2 = occupied_cells(epoch2_path, cell_size)
+    origin = np.minimum(cells1.min(axis=0), cells2.min(axis=0))
+    shape = tuple(np.maximum(cells1.max(axis=0), cells2.max(axis=0)) - origin + 1)
+    mask = largest_component(footprint(cells1, origin, shape, closing) & footprint(cells2, origin, shape, closing))
+    _print(f'ROI footprint: {mask.sum() * cell_size ** 2:.1f} m² ({mask.sum()} of {mask.size} cells)')
+    plot_footprint(mask, origin, cell_size, plot=plot)
+
+    epoch1_cut_path = clip_points(epoch1_path, os.path.join(output_folder, get_file_name(epoch1_path) + '_cut' + PC_EXT), mask, origin, cell_size)
+    epoch2_cut_path = clip_points(epoch2_path, os.path.join(output_folder, get_file_name(epoch2_path) + '_cut' + PC_EXT), mask, origin, cell_size)
+    return epoch1_cut_path, epoch2_cut_path
@@ -0,0 +1,165 @@
+# Batch runner: processes many JSON configurations (sites, epoch pairs) with a limited number of concurrent runs.
+# Every run is a separate 'main.py --no-gui' process. The state of the jobs is kept in a JSON file, so an
+# interrupted batch (crash, reboot, Ctrl+C) is resumed by running the same command again: finished jobs are
+# skipped and unfinished ones are rerun in the same project folder with the stage cache, which restores the
+# steps they had completed.
+#   python -m bin.batch json_files/sites/*.json --jobs 4 --state campaign_2024.json
+
+import os
+import sys
+import json
+import glob
+import argparse
+import datetime
+import threading
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+STATE_FILE = 'batch_state.json'
+POLL_INTERVAL = 5  # seconds between updates of the stage of the running jobs
+EXIT_INTERRUPTED = 130  # exit code of main.py when the run is interrupted
+
+_lock = threading.Lock()
+
+def now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+def expand_configs(patterns):
+    configs = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        configs.extend(matches if matches else [pattern])
+    return [os.path.abspath(config) for config in dict.fromkeys(configs)]
+
+def load_state(state_path):
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    return {'created': now(), 'jobs': []}
+
+def _write_state(state, state_path):
+    # Written to a temporary file and renamed: a crash never leaves a truncated state file
+    state['updated'] = now()
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+
+def save_state(state, state_path):
+    with _lock:
+        _write_state(state, state_path)
+
+def update_job(job, state, state_path, **changes):
+    with _lock:
+        job.update(changes)
+        _write_state(state, state_path)
+
+def add_jobs(state, configs, output=None):
+    known = {job['config']: job for job in state['jobs']}
+    names = {job['name'] for job in state['jobs']}
+    for config in configs:
+        if config in known:
+            continue
+        # The project folder is named after the configuration, so a resumed job finds its previous results
+        name = base = Path(config).stem
+        suffix = 2
+        while name in names:
+            name, suffix = f'{base}_{suffix}', suffix + 1
+        names.add(name)
+        state['jobs'].append({'config': config, 'name': name, 'output': output, 'status': 'pending', 'stage': None,
+                              'project_folder': None, 'attempts': 0, 'returncode': None, 'started': None, 'finished': None})
+    return state
+
+def project_folder(job):
+    output = job['output']
+    if output is None:
+        with open(job['config']) as f:
+            output = json.load(f)['paths']['output']
+    return os.path.join(output, job['name'])
+
+def last_stage(folder):
+    # Last step completed by the run, from the performance report that main.py updates after every step
+    try:
+        with open(os.path.join(folder, 'telemetry.json')) as f:
+            stages = json.load(f)['stages']
+    except (OSError, ValueError, KeyError):
+        return None
+    done = [record['stage'] for record in stages if record['status'] == 'done']
+    return done[-1] if done else None
+
+def run_job(job, state, state_path, logs_folder):
+    command = [sys.executable, MAIN_PATH, job['config'], '--no-gui', '--name', job['name'], '--overwrite', 'overwrite', '--cache']
+    if job['output']:
+        command += ['--output', job['output']]
+    try:
+        folder = project_folder(job)
+    except (OSError, ValueError, KeyError) as e:
+        update_job(job, state, state_path, status='failed', error=f"The JSON configuration file can't be read: {e}", finished=now())
+        return job
+
+    log_path = os.path.join(logs_folder, job['name'] + '.out')
+    update_job(job, state, state_path, status='running', project_folder=folder, attempts=job['attempts'] + 1, started=now(),
+               finished=None, returncode=None, log=log_path, error=None)
+    print(f"[{now()}] Started {job['name']} (attempt {job['attempts']})")
+
+    with open(log_path, 'a') as log:
+        log.write(f"\n{'=' * 50}\n{now()} :: {' '.join(command)}\n{'=' * 50}\n")
+        log.flush()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        while True:
+            try:
+                returncode = process.wait(timeout=POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                stage = last_stage(folder)
+                if stage != job['stage']:
+                    update_job(job, state, state_path, stage=stage)
+
+    # An interrupted job is not a failure: it is resumed by the next run
+    status = 'done' if returncode == 0 else 'pending' if returncode == EXIT_INTERRUPTED else 'failed'
+    update_job(job, state, state_path, status=status, stage=last_stage(folder), returncode=returncode, finished=now())
+    print(f"[{now()}] {job['name']}: {status} (exit code {returncode}, last step: {job['stage']})")
+    return job
+
+def run_batch(configs, state_path=STATE_FILE, jobs=1, output=None, retry_failed=False):
+    state = add_jobs(load_state(state_path), configs, output)
+    for job in state['jobs']:
+        # Jobs left 'running' were stopped by a crash or a reboot
+        if job['status'] == 'running' or (retry_failed and job['status'] == 'failed'):
+            job['status'] = 'pending'
+    save_state(state, state_path)
+
+    queue = [job for job in state['jobs'] if job['status'] == 'pending']
+    skipped = len(state['jobs']) - len(queue)
+    print(f"Batch: {len(queue)} jobs to run, {skipped} already finished or failed, {jobs} at a time. State: {os.path.abspath(state_path)}")
+    logs_folder = os.path.splitext(os.path.abspath(state_path))[0] + '_logs'
+    os.makedirs(logs_folder, exist_ok=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            list(executor.map(lambda job: run_job(job, state, state_path, logs_folder), queue))
+    except KeyboardInterrupt:
+        # The runs receive the interrupt too: their jobs stay 'pending' and are resumed by the next run
+        print("Batch interrupted by the user: run the same command again to resume it")
+        return EXIT_INTERRUPTED
+
+    counts = {status: sum(job['status'] == status for job in state['jobs']) for status in ['done', 'failed', 'pending']}
+    print(f"\nBatch finished: {counts['done']} done, {counts['failed']} failed, {counts['pending']} pending")
+    for job in state['jobs']:
+        if job['status'] == 'failed':
+            print(f"  Failed: {job['name']} (last step: {job['stage']}, log: {job.get('log')})")
+    return 0 if counts['done'] == len(state['jobs']) else 1
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PyRockDiff batch runner: many JSON configurations, resumable")
+    parser.add_argument('configs', nargs='*', help="JSON configuration files or glob patterns. If omitted, the jobs of the state file are resumed")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Configurations processed at the same time (default: 1)")
+    parser.add_argument('-s', '--state', default=STATE_FILE, help=f"State file of the batch (default: {STATE_FILE})")
+    parser.add_argument('-o', '--output', help="Output directory for every job (overrides 'output' in the JSON paths)")
+    parser.add_argument('--retry-failed', action='store_true', help="Run the failed jobs again")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    sys.exit(run_batch(expand_configs(args.configs), args.state, args.jobs, args.output, args.retry_failed))
@@ -0,0 +1,203 @@
+import os
+import json
+import shutil
+import hashlib
+import time
+import tempfile
+import threading
+from pathlib import Path
+from bin.utils import _print
+
+CACHE_VERSION = 1  # increase when a stage changes the content of its results
+CACHE_FOLDER = '.pyrockdiff_cache'
+HASH_BLOCK = 8 * 1024 * 1024
+HASHES_FOLDER = 'hashes'
+STALE_TEMPORARY = 24 * 3600  # seconds: temporary entries left by a process that crashed while storing
+
+_lock = threading.Lock()
+
+def open_cache(paths, options, parameters, project_folder):
+    if not options.get('stage_cache', False):
+        return None
+    folder = paths.get('cache') or os.path.join(paths['output'], CACHE_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    cache = {'folder': folder, 'project': os.path.abspath(project_folder),
+             'max_size': parameters.get('cache_size_gb', 20) * 1024 ** 3,
+             'hashes_folder': os.path.join(folder, HASHES_FOLDER), 'hashes': {}}
+    os.makedirs(cache['hashes_folder'], exist_ok=True)
+    _print(f"Stage cache enabled: {folder}")
+    return cache
+
+def _write_json(path, data, folder):
+    # Unique temporary name: several main.py processes (bin/batch.py) share the cache folder
+    descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    with os.fdopen(descriptor, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+    os.replace(temporary, path)
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def file_hash(cache, path):
+    # Hashes are remembered by path, size and modification time: raw clouds are only read once. One file per
+    # input, so processes sharing the cache never overwrite the hashes of each other
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    hash_path = os.path.join(cache['hashes_folder'], hashlib.sha256(path.encode()).hexdigest() + '.json')
+    known = cache['hashes'].get(path) or _read_json(hash_path)
+    if known and known['path'] == path and known['signature'] == signature:
+        cache['hashes'][path] = known
+        return known['sha256']
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    known = {'path': path, 'signature': signature, 'sha256': digest.hexdigest()}
+    _write_json(hash_path, known, cache['hashes_folder'])
+    cache['hashes'][path] = known
+    return known['sha256']
+
+def stage_key(cache, stage, inputs, params):
+    # File names are part of the key because the stages name their results after their inputs
+    key = {'version': CACHE_VERSION, 'stage': stage, 'params': params,
+           'inputs': [[Path(path).name, file_hash(cache, path)] for path in inputs]}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def result_paths(cache, result):
+    # Files of the project folder returned by the stage (a path or a tuple of paths)
+    if isinstance(result, (tuple, list)):
+        return [path for value in result for path in result_paths(cache, value)]
+    if isinstance(result, str) and os.path.abspath(result).startswith(cache['project'] + os.sep):
+        return [os.path.abspath(result)]
+    return []
+
+def encode_result(cache, result, inputs):
+    if isinstance(result, (tuple, list)):
+        return {'tuple': [encode_result(cache, value, inputs) for value in result]}
+    if isinstance(result, str):
+        path = os.path.abspath(result)
+        if path in inputs:
+            return {'input': inputs.index(path)}
+        if path.startswith(cache['project'] + os.sep):
+            return {'project': os.path.relpath(path, cache['project'])}
+    json.dumps(result)  # raises TypeError if the result can't be stored
+    return {'value': result}
+
+def decode_result(cache, encoded, inputs):
+    if 'tuple' in encoded:
+        return tuple(decode_result(cache, value, inputs) for value in encoded['tuple'])
+    if 'input' in encoded:
+        return inputs[encoded['input']]
+    if 'project' in encoded:
+        return os.path.join(cache['project'], encoded['project'])
+    return encoded['value']
+
+def restore(cache, entry, manifest, inputs):
+    for relative in manifest['files']:
+        target = os.path.join(cache['project'], relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(os.path.join(entry, 'files', relative), target)
+    os.utime(os.path.join(entry, 'manifest.json'))
+    return decode_result(cache, manifest['result'], inputs)
+
+def run_stage(cache, stage, inputs, params, func, *args, outputs=(), **kwargs):
+    # outputs: files written by the stage besides the paths it returns (reports, intermediate clouds read by
+    # later steps). Only the returned and declared files are stored: other stages may be writing to the
+    # project folder at the same time
+    if cache is None:
+        return func(*args, **kwargs)
+
+    inputs = [os.path.abspath(path) for path in inputs]
+    key = stage_key(cache, stage, inputs, params)
+    entry = os.path.join(cache['folder'], key)
+    manifest_path = os.path.join(entry, 'manifest.json')
+
+    manifest = _read_json(manifest_path)
+    if manifest is not None:
+        try:
+            result = restore(cache, entry, manifest, inputs)
+            _print(f"Stage cache: reusing the results of '{stage}' ({key[:12]})")
+            return result
+        except OSError:
+            # Entry removed by the eviction of another process while it was being copied
+            _print(f"Stage cache: the results of '{stage}' ({key[:12]}) are no longer in the cache, computing them")
+
+    result = func(*args, **kwargs)
+    paths = [path for path in dict.fromkeys(result_paths(cache, result) + [os.path.abspath(path) for path in outputs]) if path not in inputs]
+    missing = [path for path in paths if not os.path.isfile(path) or not path.startswith(cache['project'] + os.sep)]
+    if missing:
+        _print(f"Stage cache: the results of '{stage}' can't be stored, files not found in the project folder: "
+               f"{', '.join(Path(path).name for path in missing)}")
+        return result
+    files = [os.path.relpath(path, cache['project']) for path in paths]
+
+    try:
+        encoded = encode_result(cache, result, inputs)
+    except TypeError:
+        _print(f"Stage cache: the results of '{stage}' can't be stored")
+        return result
+
+    # Results are copied (not linked): later runs overwrite files of the project folder in place. The entry is
+    # filled in a temporary folder of its own and renamed: a process reading the cache never sees it half-written
+    temporary = tempfile.mkdtemp(prefix=key[:12] + '.', suffix='.tmp', dir=cache['folder'])
+    for relative in files:
+        target = os.path.join(temporary, 'files', relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(os.path.join(cache['project'], relative), target)
+    manifest = {'stage': stage, 'params': params, 'files': files, 'result': encoded,
+                'size': sum(os.path.getsize(path) for path in paths)}
+    with open(os.path.join(temporary, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    try:
+        os.replace(temporary, entry)
+    except OSError:  # stored meanwhile by another process with the same inputs and parameters
+        shutil.rmtree(temporary, ignore_errors=True)
+        return result
+    _print(f"Stage cache: results of '{stage}' stored ({len(files)} files, {manifest['size'] / 1024 ** 2:.1f} MB)")
+
+    evict(cache, keep=key)
+    return result
+
+def evict(cache, keep=None):
+    with _lock:
+        _evict(cache, keep)
+
+def _evict(cache, keep):
+    # Least recently used entries are removed until the cache fits in 'cache_size_gb'
+    entries = []
+    for key in os.listdir(cache['folder']):
+        if key.endswith('.tmp'):  # entry being stored by a concurrent stage
+            path = os.path.join(cache['folder'], key)
+            try:
+                if time.time() - os.path.getmtime(path) > STALE_TEMPORARY:
+                    shutil.rmtree(path, ignore_errors=True) if os.path.isdir(path) else os.remove(path)
+            except OSError:
+                pass
+            continue
+        manifest_path = os.path.join(cache['folder'], key, 'manifest.json')
+        manifest = _read_json(manifest_path)
+        if manifest is not None:
+            try:
+                entries.append((os.path.getmtime(manifest_path), key, manifest['size']))
+            except OSError:  # removed by another process
+                continue
+    total = sum(size for _, _, size in entries)
+    for _, key, size in sorted(entries):
+        if total <= cache['max_size']:
+            break
+        if key == keep:
+            continue
+        # Renamed before it is deleted: a process restoring it fails on the missing files and computes the stage
+        removed = os.path.join(cache['folder'], key + f'.{os.getpid()}.removed.tmp')
+        try:
+            os.replace(os.path.join(cache['folder'], key), removed)
+        except OSError:  # removed by another process, or in use (Windows)
+            continue
+        shutil.rmtree(removed, ignore_errors=True)
+        total -= size
+        _print(f"Stage cache: entry {key[:12]} removed ({size / 1024 ** 2:.1f} MB)")
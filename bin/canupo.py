@@ -1,32 +1,233 @@
-import subprocess
+from bin.telemetry import run_CloudCompare
 import os
-from bin.utils import get_file_name, loadPC, savePC, _print
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from bin.utils import get_file_name, loadPC, savePC, _print, ascii_copies, fromASCII, PC_EXT
+import bin.spatial_index as si
+import bin.tiling as tiling
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 import numpy as np
 
-def canupo_core(CloudComapare_path, epoch_path, canupo_file, canupo_folder):
+def canupo_core(CloudComapare_path, epoch_path, canupo_file, canupo_folder, rock_class=1):
     name = get_file_name(epoch_path)
-    output_path = os.path.join(canupo_folder, name + "__canupo.xyz")
+    ascii_path = os.path.join(canupo_folder, name + "__canupo.xyz")
+    output_path = os.path.join(canupo_folder, name + "__canupo" + PC_EXT)
 
     _print(f'CANUPO Algorithm: {get_file_name(epoch_path)}')
 
-    CC_canupo_Command = [CloudComapare_path,
-                      "-AUTO_SAVE", "OFF",
-                      "-C_EXPORT_FMT", "ASC", "-PREC", "3",
-                      "-O", epoch_path,
-                      "-CANUPO_CLASSIFY", canupo_file,
-                      "-SAVE_CLOUDS", "FILE", f'"{output_path}"']
+    with ascii_copies(epoch_path) as (epoch_ascii_path,):
+        CC_canupo_Command = [CloudComapare_path,
+                          "-AUTO_SAVE", "OFF",
+                          "-C_EXPORT_FMT", "ASC", "-PREC", "3",
+                          "-O", epoch_ascii_path,
+                          "-CANUPO_CLASSIFY", canupo_file,
+                          "-SAVE_CLOUDS", "FILE", f'"{ascii_path}"']
 
-    subprocess.run(CC_canupo_Command)
+        run_CloudCompare(CC_canupo_Command)
 
     _print(f'CANUPO Algorithm: {get_file_name(epoch_path)} done')
+    fromASCII(ascii_path, output_path)
     _print(f'CANUPO Algorithm: {get_file_name(output_path)} saved')
 
     epoch_filtered = loadPC(output_path, array=True)
-    epoch_rock = epoch_filtered[epoch_filtered[:, 3] == 1]
-    savePC(os.path.join(canupo_folder, name + '__rock.xyz'), epoch_rock)
+    epoch_rock = epoch_filtered[epoch_filtered[:, 3] == rock_class]
+    savePC(os.path.join(canupo_folder, name + '__rock' + PC_EXT), epoch_rock)
 
     # epoch_vegetation = epoch_filtered[epoch_filtered[:, 3] == 2]
-    #savePC(os.path.join(canupo_folder, name + '__veg.xyz'), epoch_vegetation)
+    #savePC(os.path.join(canupo_folder, name + '__veg' + PC_EXT), epoch_vegetation)
 
-    return os.path.join(canupo_folder, name + '__rock.xyz')
+    return os.path.join(canupo_folder, name + '__rock' + PC_EXT)
 
+
+# Native classifier: multi-scale dimensionality features (N. Brodu and D. Lague) with the CANUPO .prm parameters
+
+QUERY_BATCH = 1000  # core points per neighbourhood query: the largest scales may hold thousands of neighbours
+CANUPO_TILE_SIZE = 20.0
+
+def read_prm(canupo_file):
+    with open(canupo_file, 'rb') as f:
+        data = f.read()
+    position = 0
+
+    def take(dtype, count=1):
+        nonlocal position
+        values = np.frombuffer(data, dtype=dtype, count=count, offset=position)
+        position += values.nbytes
+        return values
+
+    n_scales = int(take('<i4')[0])
+    scales = take('<f4', n_scales).astype(np.float64)
+    classifiers = []
+    for _ in range(int(take('<i4')[0])):
+        classifier = {'class1': int(take('<i4')[0]), 'class2': int(take('<i4')[0]),
+                      'weights_axis1': take('<f4', 2 * n_scales + 1).astype(np.float64),
+                      'weights_axis2': take('<f4', 2 * n_scales + 1).astype(np.float64)}
+        path_size = int(take('<i4')[0])
+        classifier['path'] = take('<f4', 2 * path_size).astype(np.float64).reshape(-1, 2)
+        classifier['refpt_pos'] = take('<f4', 2).astype(np.float64)
+        classifier['refpt_neg'] = take('<f4', 2).astype(np.float64)
+        classifier['absmaxXY'] = float(take('<f4')[0])
+        classifier['axis_scale_ratio'] = float(take('<f4')[0])
+        classifiers.append(classifier)
+    return {'scales': scales, 'classifiers': classifiers}
+
+def write_prm(canupo_file, parameters):
+    # Same binary layout as the CloudCompare CANUPO plugin, so trained classifiers can be used by both engines
+    with open(canupo_file, 'wb') as f:
+        f.write(np.int32(len(parameters['scales'])).tobytes())
+        f.write(np.asarray(parameters['scales'], dtype='<f4').tobytes())
+        f.write(np.int32(len(parameters['classifiers'])).tobytes())
+        for classifier in parameters['classifiers']:
+            f.write(np.array([classifier['class1'], classifier['class2']], dtype='<i4').tobytes())
+            f.write(np.asarray(classifier['weights_axis1'], dtype='<f4').tobytes())
+            f.write(np.asarray(classifier['weights_axis2'], dtype='<f4').tobytes())
+            f.write(np.int32(len(classifier['path'])).tobytes())
+            f.write(np.asarray(classifier['path'], dtype='<f4').tobytes())
+            f.write(np.asarray([*classifier['refpt_pos'], *classifier['refpt_neg'], classifier['absmaxXY'],
+                                classifier['axis_scale_ratio']], dtype='<f4').tobytes())
+    return canupo_file
+
+def multiscale_features(tree, points, queries, scales):
+    # For every scale (ball diameter) the normalised PCA eigenvalues (l1 >= l2 >= l3) give the proportions of 1D, 2D
+    # and 3D behaviour a = l1 - l2, b = 2 (l2 - l3), c = 3 l3, mapped to the triangle: x = b + c / 2, y = c * sqrt(3) / 2
+    scales = np.asarray(scales, dtype=np.float64)
+    ascending = np.argsort(scales)
+    radius_sq = (scales[ascending] / 2) ** 2
+    features = np.empty((len(queries), 2 * len(scales)), dtype=np.float32)
+    for start in range(0, len(queries), QUERY_BATCH):
+        batch = queries[start:start + QUERY_BATCH]
+        counts, idx, owner = si.radius_neighbours(tree, batch, np.sqrt(radius_sq[-1]), return_sorted=False)
+        rel = points[idx] - batch[owner]
+        # Every neighbour is counted in the smallest ball that contains it, cumulative sums give the larger balls
+        key = owner * len(scales) + np.searchsorted(radius_sq, np.einsum('ij,ij->i', rel, rel))
+        size = len(batch) * len(scales)
+        moments = [np.ones(len(key))] + [rel[:, i] for i in range(3)] + [rel[:, i] * rel[:, j] for i in range(3) for j in range(i, 3)]
+        sums = np.stack([np.bincount(key, m, size) for m in moments], axis=1).reshape(len(batch), len(scales), -1).cumsum(axis=1)
+        n = sums[..., 0]
+        mean = sums[..., 1:4] / np.maximum(n, 1)[..., None]
+        cov = np.empty(n.shape + (3, 3))
+        k = 4
+        for i in range(3):
+            for j in range(i, 3):
+                cov[..., i, j] = cov[..., j, i] = sums[..., k] / np.maximum(n, 1) - mean[..., i] * mean[..., j]
+                k += 1
+        eigenvalues = np.clip(np.linalg.eigvalsh(cov)[..., ::-1], 0, None)
+        # Less than 3 neighbours: no shape information, the point is placed at the 3D corner like a full ball
+        undefined = (n < 3) | (eigenvalues.sum(axis=-1) <= 0)
+        eigenvalues[undefined] = 1
+        eigenvalues /= eigenvalues.sum(axis=-1, keepdims=True)
+        b = 2 * (eigenvalues[..., 1] - eigenvalues[..., 2])
+        c = 3 * eigenvalues[..., 2]
+        features[start:start + len(batch), 2 * ascending] = b + c / 2
+        features[start:start + len(batch), 2 * ascending + 1] = c * np.sqrt(3) / 2
+    return features
+
+def project(features, classifier):
+    w1, w2 = classifier['weights_axis1'], classifier['weights_axis2']
+    return np.column_stack([features @ w1[:-1] + w1[-1], features @ w2[:-1] + w2[-1]])
+
+def _path_side(xy, path):
+    # Side of the closest segment of the decision path (first and last segments extended to infinity)
+    starts, ends = path[:-1], path[1:]
+    direction = ends - starts
+    length_sq = np.maximum(np.einsum('ij,ij->i', direction, direction), 1e-12)
+    rel = xy[:, None, :] - starts[None, :, :]
+    t = np.einsum('nkj,kj->nk', rel, direction) / length_sq
+    lower, upper = np.zeros(len(starts)), np.ones(len(starts))
+    lower[0], upper[-1] = -np.inf, np.inf
+    t = np.clip(t, lower, upper)
+    closest = starts[None] + t[..., None] * direction[None]
+    nearest = np.argmin(np.sum((xy[:, None, :] - closest) ** 2, axis=2), axis=1)
+    rows = np.arange(len(xy))
+    return np.sign(direction[nearest, 0] * rel[rows, nearest, 1] - direction[nearest, 1] * rel[rows, nearest, 0])
+
+def classify_features(features, parameters):
+    # One vote per classifier (pairs of classes), the most voted class wins
+    classes = sorted({c for classifier in parameters['classifiers'] for c in (classifier['class1'], classifier['class2'])})
+    votes = np.zeros((features.shape[0], len(classes)), dtype=np.int32)
+    for classifier in parameters['classifiers']:
+        side = _path_side(project(features, classifier), classifier['path'])
+        positive = side == _path_side(classifier['refpt_pos'][None], classifier['path'])[0]
+        votes[positive, classes.index(classifier['class1'])] += 1
+        votes[~positive, classes.index(classifier['class2'])] += 1
+    return np.asarray(classes)[np.argmax(votes, axis=1)]
+
+def _classify_tile(data, core, parameters):
+    features = multiscale_features(si.build_index(data), data, data[core], parameters['scales'])
+    return classify_features(features, parameters)
+
+def classify(points, parameters, tile_size=CANUPO_TILE_SIZE, workers=0):
+    # Spatial chunks on the XZ plane with a halo of the largest neighbourhood radius, classified in a process pool
+    points = np.ascontiguousarray(points[:, :3], dtype=np.float64)
+    halo = float(np.max(parameters['scales'])) / 2
+    tiles = tiling.tile_memberships(points[:, tiling.TILE_AXES], max(tile_size, 2 * halo), halo)
+    workers = workers or os.cpu_count() or 1
+    _print(f"CANUPO native: {points.shape[0]} points in {len(tiles)} tiles using {workers} processes")
+
+    labels = np.empty(points.shape[0], dtype=np.int32)
+    datasets = [points[rows] for _, rows, _ in tiles]
+    cores = [core for _, _, core in tiles]
+    if workers > 1 and len(tiles) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_classify_tile, datasets, cores, [parameters] * len(tiles)))
+    else:
+        results = list(map(_classify_tile, datasets, cores, [parameters] * len(tiles)))
+    for (_, rows, core), tile_labels in zip(tiles, results):
+        labels[rows[core]] = tile_labels
+    return labels
+
+def canupo_native(epoch_path, canupo_file, canupo_folder, tile_size=CANUPO_TILE_SIZE, workers=0, rock_class=1):
+    name = get_file_name(epoch_path)
+    _print(f'CANUPO Algorithm (native): {name}')
+    parameters = read_prm(canupo_file)
+    _print(f"CANUPO classifier: scales {np.round(parameters['scales'], 3).tolist()}, {len(parameters['classifiers'])} classifier(s)")
+
+    points = loadPC(epoch_path, array=True)[:, :3]
+    labels = classify(points, parameters, tile_size, workers)
+    rock = labels == rock_class
+    _print(f'CANUPO Algorithm: {name} done ({rock.sum()} rock points, {(~rock).sum()} vegetation points)')
+
+    # Same outputs as the CloudCompare engine: classified cloud (vegetation plot) and rock points
+    savePC(os.path.join(canupo_folder, name + '__canupo' + PC_EXT), np.column_stack([points, labels]))
+    return savePC(os.path.join(canupo_folder, name + '__rock' + PC_EXT), points[rock])
+
+def train_classifier(samples, scales, class1=1, class2=2):
+    # Linear discriminant of the multi-scale features of two labelled sample clouds (class1 first).
+    # The decision path is the line x = 0 of the discriminant axis, the second axis is the main remaining variance.
+    features = [multiscale_features(si.build_index(points), points[:, :3], points[:, :3], scales).astype(np.float64)
+                for points in samples]
+    X = np.vstack(features)
+    y = np.concatenate([np.ones(len(features[0])), np.zeros(len(features[1]))])
+    lda = LinearDiscriminantAnalysis().fit(X, y)
+    weights_axis1 = np.append(lda.coef_[0], lda.intercept_[0])
+
+    axis1 = lda.coef_[0] / np.linalg.norm(lda.coef_[0])
+    residual = X - np.outer(X @ axis1, axis1)
+    residual -= residual.mean(axis=0)
+    axis2 = np.linalg.svd(residual, full_matrices=False)[2][0]
+    weights_axis2 = np.append(axis2, -X.mean(axis=0) @ axis2)
+
+    classifier = {'class1': class1, 'class2': class2, 'weights_axis1': weights_axis1, 'weights_axis2': weights_axis2}
+    xy = project(X, classifier)
+    absmax = float(np.abs(xy).max())
+    classifier.update(path=np.array([[0.0, -10 * absmax], [0.0, 10 * absmax]]),
+                      refpt_pos=xy[y == 1].mean(axis=0), refpt_neg=xy[y == 0].mean(axis=0), absmaxXY=absmax,
+                      axis_scale_ratio=float(xy[:, 0].std() / max(xy[:, 1].std(), 1e-12)))
+    accuracy = (classify_features(X, {'classifiers': [classifier]}) == np.where(y == 1, class1, class2)).mean()
+    _print(f"CANUPO training: {len(features[0])} + {len(features[1])} samples, training accuracy {accuracy:.1%}")
+    return {'scales': np.asarray(scales, dtype=np.float64), 'classifiers': [classifier]}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Train a CANUPO classifier (.prm) from two labelled sample clouds")
+    parser.add_argument('class1', help="Sample cloud of the first class (rock)")
+    parser.add_argument('class2', help="Sample cloud of the second class (vegetation)")
+    parser.add_argument('-o', '--output', required=True, help="Output .prm file")
+    parser.add_argument('--scales', type=float, nargs='+', default=[4.0, 3.5, 3.0, 2.5, 2.0, 1.5, 1.0, 0.5],
+                        help="Neighbourhood diameters in m (default: the scales of the included classifier)")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    samples = [loadPC(path, array=True) for path in [args.class1, args.class2]]
+    write_prm(args.output, train_classifier(samples, sorted(args.scales, reverse=True)))
+    print(f"Classifier written to {args.output}")
@@ -1,21 +1,115 @@
-import open3d as o3d
 import os
-from bin.utils import get_file_name, dbscan_core, savePC, _print
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+from bin.utils import get_file_name, dbscan_core, loadPC, savePC, _print, PC_EXT
+import bin.tiling as tiling
+import bin.spatial_index as si
+
+SOR_TILE_SIZE = 10.0
+SOR_CHUNK_SIZE = 2000000
 
 def dbscan_filter(pc_path, clean_folder, eps, min_samples):
     pc_cluster = dbscan_core(pc_path, eps, min_samples)
     pc_filtered = pc_cluster[pc_cluster[:, -1] >= 0]
     file_name = get_file_name(pc_path)
-    output_path = savePC(os.path.join(clean_folder, file_name + '__dbscan.xyz'), pc_filtered)
+    output_path = savePC(os.path.join(clean_folder, file_name + '__dbscan' + PC_EXT), pc_filtered)
     return output_path
 
-def outlier_filter(pc_path, nb_neighbors, std_ratio, output_folder):
+def tile_knn_distances(data, core, bounds, nb_neighbors):
+    queries = data[core]
+    distances = knn_distances(si.build_index(data), queries, nb_neighbors)
+    # The k nearest neighbours are exact if their ball fits inside the tile and its halo (XZ), otherwise the point is
+    # solved again against the whole cloud
+    xz = queries[:, tiling.TILE_AXES]
+    margin = np.minimum(xz - bounds[0], bounds[1] - xz).min(axis=1)
+    complete = distances[:, -1] <= margin
+    return _mean_distance(distances), complete
+
+def exact_distances(chunks, queries, nb_neighbors):
+    # k nearest neighbours of a few points against the whole cloud (given in chunks of XYZ), merging the neighbours
+    # found chunk by chunk
+    best = np.full((len(queries), nb_neighbors), np.inf)
+    for chunk in chunks:
+        distances = knn_distances(si.build_index(chunk), queries, nb_neighbors)
+        best = np.sort(np.hstack([best, distances]), axis=1)[:, :nb_neighbors]
+    return _mean_distance(best)
+
+def tile_bounds(key, tile_size, halo):
+    return np.array(key) * tile_size - halo, (np.array(key) + 1) * tile_size + halo
+
+def _tiled_distances(points, nb_neighbors, tile_size, workers):
+    halo = tile_size / 10
+    tiles = tiling.tile_memberships(points[:, tiling.TILE_AXES], tile_size, halo)
+    workers = workers or os.cpu_count() or 1
+    _print(f'{points.shape[0]} points in {len(tiles)} tiles of {tile_size} m using {workers} processes')
+
+    tiles = [(key, rows, core) for key, rows, core in tiles if core.any()]
+    datasets = [points[rows] for _, rows, _ in tiles]
+    cores = [core for _, _, core in tiles]
+    bounds = [tile_bounds(key, tile_size, halo) for key, _, _ in tiles]
+    neighbours = [nb_neighbors] * len(tiles)
+    if workers > 1 and len(tiles) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(tile_knn_distances, datasets, cores, bounds, neighbours))
+    else:
+        results = list(map(tile_knn_distances, datasets, cores, bounds, neighbours))
+
+    avg_distances = np.empty(points.shape[0])
+    incomplete = []
+    for (_, rows, core), (tile_distances, complete) in zip(tiles, results):
+        avg_distances[rows[core]] = tile_distances
+        incomplete.append(rows[core][~complete])
+    incomplete = np.concatenate(incomplete) if incomplete else np.empty(0, dtype=np.int64)
+    if incomplete.size:
+        _print(f'{incomplete.size} points with neighbours beyond the tile halo: solved against the whole cloud')
+        chunks = (points[start:start + SOR_CHUNK_SIZE] for start in range(0, points.shape[0], SOR_CHUNK_SIZE))
+        avg_distances[incomplete] = exact_distances(chunks, points[incomplete], nb_neighbors)
+    return avg_distances
+
+def outlier_filter(pc_path, nb_neighbors, std_ratio, output_folder, tile_size=SOR_TILE_SIZE, workers=0, save_distances=False, spatial_index=False):
+    # Same result as Open3D remove_statistical_outlier, computed in spatial tiles (XZ) in a process pool, or against the
+    # stored KD-tree of the cloud. First pass: mean distance to the k nearest neighbours; second pass: global threshold.
     file_name = get_file_name(pc_path)
     _print(f'Running statistical outlier filter {file_name}')
-    target = o3d.io.read_point_cloud(pc_path, format='xyz')
-    cl, ind = target.remove_statistical_outlier(nb_neighbors, std_ratio)
-    _print("Statistical outlier filter done")
-    output_path = os.path.join(output_folder, file_name + '__outlier.xyz')
-    o3d.io.write_point_cloud(output_path, cl, format='xyz', write_ascii=True, compressed=False)
+    points = np.ascontiguousarray(loadPC(pc_path, array=True)[:, :3], dtype=np.float64)
+    if spatial_index:
+        tree = si.open_index(pc_path, points)
+        avg_distances = np.concatenate([mean_knn_distance(tree, points[start:start + SOR_CHUNK_SIZE], nb_neighbors)
+                                        for start in range(0, points.shape[0], SOR_CHUNK_SIZE)])
+    else:
+        avg_distances = _tiled_distances(points, nb_neighbors, tile_size, workers)
+
+    # A point whose neighbours are exact duplicates has a mean distance of 0 and is kept, as in Open3D
+    valid = avg_distances[np.isfinite(avg_distances)]
+    distance_threshold = statistical_threshold(valid.sum(), np.square(valid).sum(), valid.size, std_ratio)
+    keep = np.isfinite(avg_distances) & (avg_distances < distance_threshold)
+    _print(f"Statistical outlier filter done: mean distance threshold {distance_threshold:.4f} m, {(~keep).sum()} points removed")
+
+    if save_distances:
+        # QA output: mean neighbour distance of every input point and whether it was kept
+        savePC(os.path.join(output_folder, file_name + '__sor_distances' + PC_EXT), distances_table(points, avg_distances, keep))
+    output_path = savePC(os.path.join(output_folder, file_name + '__outlier' + PC_EXT), points[keep])
     _print(f"Saving {get_file_name(output_path)} completed successfully")
     return output_path
+
+def distances_table(points, avg_distances, keep):
+    return pd.DataFrame({'x': points[:, 0], 'y': points[:, 1], 'z': points[:, 2], 'mean_distance': avg_distances, 'kept': keep.astype(np.int8)})
+
+def knn_distances(tree, queries, nb_neighbors):
+    distances, _ = si.knn(tree, queries, nb_neighbors)
+    return distances
+
+def _mean_distance(distances):
+    distances = distances.copy()
+    distances[np.isinf(distances)] = np.nan
+    return np.nanmean(distances, axis=1)
+
+def mean_knn_distance(tree, queries, nb_neighbors):
+    # Same definition as Open3D remove_statistical_outlier: the point itself is one of the k neighbours
+    return _mean_distance(knn_distances(tree, queries, nb_neighbors))
+
+def statistical_threshold(total, total_sq, count, std_ratio):
+    mean = total / count
+    std = np.sqrt(max(total_sq - count * mean ** 2, 0) / (count - 1))
+    return mean + std_ratio * std
@@ -1,26 +1,137 @@
+import matplotlib
 import matplotlib.pyplot as plt
 from pathlib import Path
-from bin.utils import loadPC, savePC, get_file_name, create_folder, _print
+from bin.utils import loadPC, savePC, read_columns, get_file_name, create_folder, _print, PC_EXT
 from sklearn.cluster import DBSCAN
+import bin.spatial_index as si
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import pandas as pd
 import numpy as np
 import open3d as o3d
 import os
+import itertools
+import multiprocessing
+import bin.tiling as tiling
+
+CLUSTER_COLUMNS = ['x', 'y', 'z', 'm3c2_diff']  # columns used by the clustering and volume steps
 
 def threshold_filter(threshold, e1e2_change_path):
-    pc = loadPC(e1e2_change_path)
     _print(f'Filtering Point Cloud: Difference threshold: {threshold}')
-    if threshold < 0:
-        pc_filtered = pc[pc['m3c2_diff'] < threshold]
-    if threshold > 0:
-        pc_filtered = pc[pc['m3c2_diff'] > threshold]
+    pc_filtered = read_columns(e1e2_change_path, CLUSTER_COLUMNS, ('m3c2_diff', '<' if threshold < 0 else '>', threshold))
     _print(f'Point Cloud after threshold filter: {pc_filtered.shape[0]} points')
     return pc_filtered
 
-def dbscan_core(diff_filter, eps, min_samples):
-    _print(f'Running DBSCAN algorithm for clustering the {diff_filter.shape[0]} points')
-    clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(diff_filter[['x','y','z']])
-    labels = clustering.labels_.reshape((-1, 1))
+GRID_CHUNK_SIZE = 100000
+GRID_MAX_DISTANCES = 5000000
+# Neighbour cells (cell size eps/sqrt(3)) that can hold points closer than eps, each pair of cells visited once
+GRID_STENCIL = np.array([o for o in itertools.product(range(-2, 3), repeat=3)
+                         if o > (0, 0, 0) and sum(max(abs(v) - 1, 0) ** 2 for v in o) < 3])
+
+def _cells_linked(points, starts, counts, a, b, eps):
+    # True for the pairs of cells (a, b) with at least two points closer than eps (all the distances are checked)
+    sizes = counts[a] * counts[b]
+    linked = np.zeros(a.size, dtype=bool)
+    bounds = np.searchsorted(np.cumsum(sizes), np.arange(GRID_MAX_DISTANCES, sizes.sum() + GRID_MAX_DISTANCES, GRID_MAX_DISTANCES), side='right')
+    begin = 0
+    for end in np.unique(np.append(np.maximum(bounds, 1), a.size)):
+        chunk = np.arange(begin, min(end, a.size))
+        if chunk.size == 0:
+            continue
+        pair = np.repeat(chunk, sizes[chunk])
+        offset = np.arange(pair.size) - np.repeat(np.cumsum(sizes[chunk]) - sizes[chunk], sizes[chunk])
+        i = starts[a[pair]] + offset // counts[b[pair]]
+        j = starts[b[pair]] + offset % counts[b[pair]]
+        close = np.einsum('ij,ij->i', points[i] - points[j], points[i] - points[j]) <= eps ** 2
+        linked[np.unique(pair[close])] = True
+        begin = end
+    return linked
+
+def dbscan_grid(points, eps, min_samples, chunk_size=GRID_CHUNK_SIZE):
+    # Same labels as scikit-learn DBSCAN, without keeping every neighbourhood in memory:
+    # 1. Core points: cells of diagonal eps with at least min_samples points are all core, the rest are counted
+    # 2. Clusters: cells are linked (union-find) when two of their core points are closer than eps. Face
+    #    neighbours are checked first, the other cells only when they are not connected yet
+    # 3. Border points take the lowest label among their core neighbours, as the scikit-learn expansion does
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    n_points = points.shape[0]
+    labels = np.full(n_points, -1, dtype=np.int64)
+    if n_points == 0:
+        return labels, np.zeros(0, dtype=bool)
+
+    keys = np.floor(points / (eps / np.sqrt(3))).astype(np.int64)
+    keys -= keys.min(axis=0) - 2
+    span = keys.max(axis=0) + 3
+    code = (keys[:, 0] * span[1] + keys[:, 1]) * span[2] + keys[:, 2]
+    unique_codes, cell = np.unique(code, return_inverse=True)
+    is_core = np.bincount(cell)[cell] >= min_samples
+    sparse = np.flatnonzero(~is_core)
+    if sparse.size:
+        tree = si.build_index(points)
+        for start in range(0, sparse.size, chunk_size):
+            rows = sparse[start:start + chunk_size]
+            is_core[rows] = si.radius_counts(tree, points[rows], eps) >= min_samples
+    core = np.flatnonzero(is_core)
+    if core.size == 0:
+        return labels, is_core
+
+    # Core points sorted by cell, and the cells that contain them
+    order = core[np.argsort(cell[core], kind='stable')]
+    core_cells, starts, counts = np.unique(cell[order], return_index=True, return_counts=True)
+    core_points = points[order]
+    cell_keys = keys[order[starts]]
+    cell_codes = unique_codes[core_cells]
+
+    component = np.arange(core_cells.size)
+    for face in [True, False]:
+        stencil = GRID_STENCIL[(np.abs(GRID_STENCIL).sum(axis=1) == 1) == face]
+        a, b = [], []
+        for offset in stencil:
+            neighbour = cell_keys + offset
+            neighbour_code = (neighbour[:, 0] * span[1] + neighbour[:, 1]) * span[2] + neighbour[:, 2]
+            position = np.minimum(np.searchsorted(cell_codes, neighbour_code), cell_codes.size - 1)
+            found = cell_codes[position] == neighbour_code
+            a.append(np.flatnonzero(found))
+            b.append(position[found])
+        a, b = np.concatenate(a), np.concatenate(b)
+        pending = component[a] != component[b]
+        a, b = a[pending], b[pending]
+        linked = _cells_linked(core_points, starts, counts, a, b, eps)
+        edges = np.column_stack([component[a[linked]], component[b[linked]]])
+        graph = coo_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])), shape=(core_cells.size, core_cells.size))
+        _, merged = connected_components(graph, directed=False)
+        component = merged[component]
+
+    # Clusters are numbered in the order of their first core point
+    core_component = np.empty(n_points, dtype=np.int64)
+    core_component[order] = np.repeat(component, counts)
+    core_component = core_component[core]
+    first = np.full(component.max() + 1, n_points)
+    np.minimum.at(first, core_component, core)
+    used = np.flatnonzero(first < n_points)
+    rank = np.full(first.size, -1)
+    rank[used[np.argsort(first[used])]] = np.arange(used.size)
+    labels[core] = rank[core_component]
+
+    border = np.flatnonzero(~is_core)
+    if border.size:
+        core_tree = si.build_index(points[core])
+        for start in range(0, border.size, chunk_size):
+            rows = border[start:start + chunk_size]
+            _, idx, owner = si.radius_neighbours(core_tree, points[rows], eps, workers=-1, return_sorted=False)
+            lowest = np.full(rows.size, np.iinfo(np.int64).max)
+            np.minimum.at(lowest, owner, labels[core[idx]])
+            reached = lowest < np.iinfo(np.int64).max
+            labels[rows[reached]] = lowest[reached]
+    return labels, is_core
+
+def dbscan_core(diff_filter, eps, min_samples, engine='sklearn'):
+    _print(f'Running DBSCAN algorithm ({engine}) for clustering the {diff_filter.shape[0]} points')
+    if engine == 'grid':
+        labels, _ = dbscan_grid(diff_filter[['x', 'y', 'z']].values, eps, min_samples)
+    else:
+        labels = DBSCAN(eps=eps, min_samples=min_samples).fit(diff_filter[['x','y','z']]).labels_
+    labels = labels.reshape((-1, 1))
     labels_df = pd.DataFrame(labels, columns=['rockfall_label'])
     diff_cluster = pd.concat([diff_filter.reset_index(drop=True), labels_df], axis=1)
     diff_cluster = diff_cluster[diff_cluster['rockfall_label'] >= 0]
@@ -29,46 +140,105 @@ def dbscan_core(diff_filter, eps, min_samples):
     _print(f'DBSCAN algorithm applied correctly: {diff_cluster.shape[0]} points in {diff_cluster["rockfall_label"].max()} clusters identified')
     return diff_cluster
 
-def plot_clusters(diff_cluster, e1e2_change_path, dbscan_folder, parameters, vegetation=True):
-    plt.figure(figsize=(20, 15), dpi=450)
-    if vegetation:
-        project_path = Path(dbscan_folder).parent
-        name = get_file_name(e1e2_change_path).split('_vs_')[0]
-        point_cloud = os.path.join(project_path, '1.2_canupo', name + '__canupo.xyz')
-        if os.path.exists(point_cloud):
-            canupo = loadPC(point_cloud, array=True)
-            data_sorted = canupo[canupo[:, 0].argsort()]
-            subsampled_data = data_sorted[::15]
-            labels = subsampled_data[:, 3]
-            colors = np.where(labels == 1, 'lightgrey', 'green')
-            plt.scatter(subsampled_data[:, 0], subsampled_data[:, 2], color=colors, s=1, marker='.')
-            file_name = '_vegetation'
-        else:
-            _print("No vegetation files. This plot will be skipped")
-            return
-    else:
-        pc = loadPC(e1e2_change_path)
-        data_sorted = pc.sort_values(by='x')
-        subsampled_data = data_sorted.iloc[::15]
-        plt.scatter(subsampled_data['x'], subsampled_data['z'], color='lightgrey', s=1, marker='.')
-        file_name = ''
-
-    plt.scatter(diff_cluster['x'], diff_cluster['z'], s=1.5, c='orange', marker='.')
-    grouped = diff_cluster.groupby('rockfall_label').agg({'x': 'mean', 'z': 'mean'}).reset_index()
-    for index, row in grouped.iterrows():
-        plt.text(int(row['x']+2), int(row['z']+2), f"{int(row['rockfall_label'])}", fontsize=12, ha='center', va='center')
-    plt.axis('off')
-    plt.tight_layout(pad=0.1)
-    plt.title(f"{get_file_name(e1e2_change_path)} with DBSCAN (eps = {parameters['eps_rockfalls']}, minPts = {parameters['min_samples_rockfalls']}) and DiffThreshold = {parameters['diff_threshold']} m", fontsize=20)
-    plt.savefig(os.path.join(dbscan_folder,get_file_name(e1e2_change_path)+f'{file_name}.jpg'), bbox_inches='tight', pad_inches=0.1)
-    plt.close()
+OVERVIEW_PIXELS = 3000  # raster cells along the longest side of the overview figures
+OVERVIEW_DPI = 200
+OVERVIEW_COLORS = {'empty': (1.0, 1.0, 1.0), 'rock': (0.83, 0.83, 0.83), 'vegetation': (0.0, 0.5, 0.0), 'cluster': (1.0, 0.65, 0.0)}
+
+def _raster_cells(xz, origin, cell_size, shape):
+    # Row-major index of the raster cell (row: z, column: x) of every point
+    ij = np.floor((xz - origin) / cell_size).astype(np.int64)
+    ij = np.minimum(np.maximum(ij, 0), [shape[1] - 1, shape[0] - 1])
+    return ij[:, 1] * shape[1] + ij[:, 0]
+
+def rasterize(xz, origin, cell_size, shape, weights=None):
+    # Points (or weights) per cell, binned with NumPy instead of drawing every point
+    return np.bincount(_raster_cells(xz, origin, cell_size, shape), weights, minlength=shape[0] * shape[1]).reshape(shape)
+
+def cluster_centroids(xz, labels):
+    unique, inverse = np.unique(labels, return_inverse=True)
+    counts = np.bincount(inverse)
+    return unique, np.bincount(inverse, xz[:, 0]) / counts, np.bincount(inverse, xz[:, 1]) / counts
+
+def _overview_figure(image, extent, labels, cx, cz, title, output_path):
+    fig, ax = plt.subplots(figsize=(20, 15), dpi=OVERVIEW_DPI)
+    ax.imshow(image, origin='lower', extent=extent, interpolation='nearest')
+    for label, x, z in zip(labels.tolist(), cx.tolist(), cz.tolist()):
+        ax.text(int(x + 2), int(z + 2), str(label), fontsize=12, ha='center', va='center')
+    ax.axis('off')
+    ax.set_title(title, fontsize=20)
+    fig.tight_layout(pad=0.1)
+    fig.savefig(output_path, bbox_inches='tight', pad_inches=0.1)
+    plt.close(fig)
+
+def render_overviews(e1ve2_DBSCAN_path, e1e2_change_path, dbscan_folder, parameters):
+    # Both overview figures (M3C2 background and CANUPO vegetation background) from a single load of every input
+    clusters = read_columns(e1ve2_DBSCAN_path, ['x', 'z', 'rockfall_label'])
+    change_xz = read_columns(e1e2_change_path, ['x', 'z']).values
+    name = get_file_name(e1e2_change_path).split('_vs_')[0]
+    canupo_path = os.path.join(Path(dbscan_folder).parent, '1.2_canupo', name + '__canupo' + PC_EXT)
+    canupo = loadPC(canupo_path, array=True) if os.path.exists(canupo_path) else None
+    if canupo is None:
+        _print("No vegetation files. The vegetation plot will be skipped")
+
+    bounds = [change_xz] + ([canupo[:, [0, 2]]] if canupo is not None else [])
+    lower = np.min([b.min(axis=0) for b in bounds if len(b)], axis=0)
+    upper = np.max([b.max(axis=0) for b in bounds if len(b)], axis=0)
+    cell_size = max((upper - lower).max() / OVERVIEW_PIXELS, 1e-6)
+    shape = tuple((np.floor((upper - lower) / cell_size).astype(np.int64) + 1)[::-1])
+    extent = [lower[0], lower[0] + shape[1] * cell_size, lower[1], lower[1] + shape[0] * cell_size]
+
+    # Cluster cells are grown by one cell so small rockfalls stay visible at the figure resolution
+    cluster_xz = clusters[['x', 'z']].values
+    occupied = rasterize(cluster_xz, lower, cell_size, shape) > 0
+    grown = occupied.copy()
+    grown[1:] |= occupied[:-1]
+    grown[:-1] |= occupied[1:]
+    grown[:, 1:] |= occupied[:, :-1]
+    grown[:, :-1] |= occupied[:, 1:]
+    labels, cx, cz = cluster_centroids(cluster_xz, clusters['rockfall_label'].values.astype(np.int64))
+
+    backgrounds = [('', rasterize(change_xz, lower, cell_size, shape) > 0, None)]
+    if canupo is not None:
+        rock = canupo[:, 3] == parameters.get('canupo_rock_class', 1)
+        rock_count = rasterize(canupo[:, [0, 2]], lower, cell_size, shape, rock.astype(np.float64))
+        total = rasterize(canupo[:, [0, 2]], lower, cell_size, shape)
+        backgrounds.append(('_vegetation', total > 0, total - rock_count > rock_count))
+
+    title = (f"{get_file_name(e1e2_change_path)} with DBSCAN (eps = {parameters['eps_rockfalls']}, minPts = {parameters['min_samples_rockfalls']}) "
+             f"and DiffThreshold = {parameters['diff_threshold']} m")
+    for suffix, points, vegetation in backgrounds:
+        image = np.empty(shape + (3,))
+        image[:] = OVERVIEW_COLORS['empty']
+        image[points] = OVERVIEW_COLORS['rock']
+        if vegetation is not None:
+            image[vegetation] = OVERVIEW_COLORS['vegetation']
+        image[grown] = OVERVIEW_COLORS['cluster']
+        _overview_figure(image, extent, labels, cx, cz, title, os.path.join(dbscan_folder, get_file_name(e1e2_change_path) + f'{suffix}.jpg'))
+    _print(f"Cluster overview figures saved ({len(backgrounds)} figures, {len(labels)} clusters)")
+
+def _render_overviews_background(e1ve2_DBSCAN_path, e1e2_change_path, dbscan_folder, parameters):
+    matplotlib.use('Agg')
+    render_overviews(e1ve2_DBSCAN_path, e1e2_change_path, dbscan_folder, parameters)
+
+def plot_clusters(e1ve2_DBSCAN_path, e1e2_change_path, dbscan_folder, parameters, background=False):
+    if background:
+        _print("Plotting the cluster overview figures in the background")
+        process = multiprocessing.Process(target=_render_overviews_background, args=(e1ve2_DBSCAN_path, e1e2_change_path, dbscan_folder, dict(parameters)))
+        process.start()
+        return process
+    render_overviews(e1ve2_DBSCAN_path, e1e2_change_path, dbscan_folder, parameters)
+    return None
 
 def dbscan(dbscan_folder, e1e2_change_path, parameters):
+    tile_size = parameters.get('tile_size', 0)
     pc_filtered = threshold_filter(parameters['diff_threshold'], e1e2_change_path)
-    diff_cluster = dbscan_core(pc_filtered, parameters['eps_rockfalls'], parameters['min_samples_rockfalls'])
+    if tile_size:
+        diff_cluster = tiling.tiled_dbscan_core(pc_filtered, parameters['eps_rockfalls'], parameters['min_samples_rockfalls'],
+                                                tile_size, parameters.get('tile_halo', tile_size / 10))
+    else:
+        diff_cluster = dbscan_core(pc_filtered, parameters['eps_rockfalls'], parameters['min_samples_rockfalls'],
+                                   parameters.get('dbscan_engine', 'sklearn'))
     file_name = get_file_name(e1e2_change_path)
-    dbscan_path = savePC(os.path.join(dbscan_folder, file_name + '__dbscan.xyz'), diff_cluster)
-    plot_clusters(diff_cluster, e1e2_change_path, dbscan_folder, parameters, vegetation=True)
-    plot_clusters(diff_cluster, e1e2_change_path, dbscan_folder, parameters, vegetation=False)
+    dbscan_path = savePC(os.path.join(dbscan_folder, file_name + '__dbscan' + PC_EXT), diff_cluster)
 
     return dbscan_path
\ No newline at end of file
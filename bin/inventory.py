@@ -0,0 +1,169 @@
+# Rockfall inventory: every run adds its clusters (centroid, bounding box, volume, epochs and parameters) to a
+# SQLite database shared by all the projects of the output folder. An R-tree index on the bounding boxes and
+# indexes on the volumes and epoch dates answer spatial, temporal and magnitude queries without reading the
+# __db.csv files of every run.
+#   python -m bin.inventory D:\PyRockDiff\rockfall_inventory.sqlite --min-volume 1 --since 2021-01-01 --csv events.csv
+
+import os
+import re
+import sys
+import json
+import sqlite3
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+from bin.utils import read_columns, get_file_name, _print
+
+INVENTORY_FILE = 'rockfall_inventory.sqlite'
+INVENTORY_VERSION = 1
+LOCK_TIMEOUT = 60  # seconds waiting for another run writing to the inventory
+EVENT_COLUMNS = ['x', 'y', 'z', 'm3c2_diff', 'rockfall_label']
+BOUNDS = ['min_x', 'max_x', 'min_y', 'max_y', 'min_z', 'max_z']
+RUN_OPTIONS = ['subsample_engine', 'vegetation_filter', 'cleaning_filtering', 'fast_registration', 'icp_registration', 'roi_focus', 'm3c2_engine', 'auto_parameters']
+RUN_PARAMETERS = ['spatial_distance', 'voxel_size', 'diff_threshold', 'eps_rockfalls', 'min_samples_rockfalls', 'dbscan_engine', 'tile_size']
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY, project TEXT UNIQUE NOT NULL, e1 TEXT, e2 TEXT, e1_date TEXT, e2_date TEXT,
+    parameters TEXT, created TEXT);
+CREATE TABLE IF NOT EXISTS events (
+    event_id INTEGER PRIMARY KEY, run_id INTEGER NOT NULL REFERENCES runs(run_id), label INTEGER, n_points INTEGER,
+    x REAL, y REAL, z REAL, m3c2_diff REAL, volume REAL, {', '.join(f'{name} REAL' for name in BOUNDS)});
+CREATE VIRTUAL TABLE IF NOT EXISTS events_rtree USING rtree(event_id, {', '.join(BOUNDS)});
+CREATE INDEX IF NOT EXISTS events_run ON events(run_id);
+CREATE INDEX IF NOT EXISTS events_volume ON events(volume);
+CREATE INDEX IF NOT EXISTS runs_dates ON runs(e2_date, e1_date);
+PRAGMA user_version = {INVENTORY_VERSION};
+'''
+
+def inventory_path(paths):
+    return paths.get('inventory') or os.path.join(paths['output'], INVENTORY_FILE)
+
+def open_inventory(path):
+    conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+    conn.executescript(SCHEMA)
+    return conn
+
+def epoch_date(path):
+    # Acquisition date from the scan name: 20190711_..., 2019-07-11_... or 190711_... (None if there is no date)
+    name = get_file_name(path)
+    for pattern, date_format in [(r'(?<!\d)(\d{4}-\d{2}-\d{2})(?!\d)', '%Y-%m-%d'), (r'(?<!\d)(\d{8})(?!\d)', '%Y%m%d'), (r'(?<!\d)(\d{6})(?!\d)', '%y%m%d')]:
+        for match in re.findall(pattern, name):
+            try:
+                return datetime.datetime.strptime(match, date_format).date().isoformat()
+            except ValueError:
+                continue
+    return None
+
+def cluster_events(e1ve2_DBSCAN_path, volumes_db=None):
+    # One row per cluster: median point (as in the __db.csv), bounding box, number of points and volume
+    rockfalls = read_columns(e1ve2_DBSCAN_path, EVENT_COLUMNS, dtype=np.float64)
+    rockfalls = rockfalls[rockfalls['rockfall_label'] >= 0]
+    rockfalls['rockfall_label'] = rockfalls['rockfall_label'].astype(np.int64)
+    groups = rockfalls.groupby('rockfall_label')
+    events = groups[['x', 'y', 'z', 'm3c2_diff']].median()
+    events['n_points'] = groups.size()
+    for axis in ['x', 'y', 'z']:
+        events['min_' + axis] = groups[axis].min()
+        events['max_' + axis] = groups[axis].max()
+    events = events.reset_index()
+    if volumes_db is not None:
+        events = pd.merge(events, volumes_db, on='rockfall_label', how='left')
+    else:
+        events['total_volume'] = np.nan
+    return events
+
+def add_run(path, project_folder, e1, e2, options, parameters, events):
+    # A run of the same project folder (rerun, resumed batch job) replaces its previous events
+    run = {'project': os.path.abspath(project_folder), 'e1': os.path.abspath(e1), 'e2': os.path.abspath(e2),
+           'e1_date': epoch_date(e1), 'e2_date': epoch_date(e2),
+           'parameters': json.dumps({'options': {key: options.get(key) for key in RUN_OPTIONS},
+                                     'parameters': {key: parameters.get(key) for key in RUN_PARAMETERS}}),
+           'created': datetime.datetime.now().isoformat(timespec='seconds')}
+    conn = open_inventory(path)
+    try:
+        with conn:
+            previous = conn.execute('SELECT run_id FROM runs WHERE project = ?', (run['project'],)).fetchone()
+            if previous:
+                conn.execute('DELETE FROM events_rtree WHERE event_id IN (SELECT event_id FROM events WHERE run_id = ?)', previous)
+                conn.execute('DELETE FROM events WHERE run_id = ?', previous)
+                conn.execute('DELETE FROM runs WHERE run_id = ?', previous)
+            run_id = conn.execute(f'INSERT INTO runs ({", ".join(run)}) VALUES ({", ".join("?" * len(run))})', list(run.values())).lastrowid
+            rows = [(run_id, int(event.rockfall_label), int(event.n_points), event.x, event.y, event.z, event.m3c2_diff,
+                     None if pd.isna(event.total_volume) else float(event.total_volume), *[getattr(event, name) for name in BOUNDS])
+                    for event in events.itertuples(index=False)]
+            conn.executemany(f'INSERT INTO events (run_id, label, n_points, x, y, z, m3c2_diff, volume, {", ".join(BOUNDS)}) '
+                             f'VALUES ({", ".join("?" * (8 + len(BOUNDS)))})', rows)
+            conn.execute(f'INSERT INTO events_rtree SELECT event_id, {", ".join(BOUNDS)} FROM events WHERE run_id = ?', (run_id,))
+    finally:
+        conn.close()
+    _print(f"Inventory: {len(rows)} events of {get_file_name(e1)} vs {get_file_name(e2)} saved in {path}" + (" (previous events of the run replaced)" if previous else ""))
+    return run_id
+
+def query_events(path, bbox=None, since=None, until=None, min_volume=None, max_volume=None):
+    # bbox: (min_x, min_y, min_z, max_x, max_y, max_z), events whose bounding box intersects it.
+    # since/until: ISO dates, events whose epoch interval (e1_date, e2_date) overlaps them.
+    conditions, values = [], []
+    join = ''
+    if bbox is not None:
+        min_x, min_y, min_z, max_x, max_y, max_z = bbox
+        # The R-tree stores float32 boxes rounded outwards: it selects the candidates, the stored bounds decide
+        join = 'JOIN events_rtree r ON r.event_id = e.event_id'
+        conditions += ['r.max_x >= ?', 'r.min_x <= ?', 'r.max_y >= ?', 'r.min_y <= ?', 'r.max_z >= ?', 'r.min_z <= ?',
+                       'e.max_x >= ?', 'e.min_x <= ?', 'e.max_y >= ?', 'e.min_y <= ?', 'e.max_z >= ?', 'e.min_z <= ?']
+        values += [min_x, max_x, min_y, max_y, min_z, max_z] * 2
+    if since is not None:
+        conditions.append('COALESCE(u.e2_date, u.e1_date) >= ?')
+        values.append(since)
+    if until is not None:
+        conditions.append('COALESCE(u.e1_date, u.e2_date) <= ?')
+        values.append(until)
+    if min_volume is not None:
+        conditions.append('e.volume >= ?')
+        values.append(min_volume)
+    if max_volume is not None:
+        conditions.append('e.volume <= ?')
+        values.append(max_volume)
+    query = (f'SELECT e.event_id, u.project, u.e1, u.e2, u.e1_date, u.e2_date, e.label, e.n_points, e.x, e.y, e.z, e.m3c2_diff, '
+             f'e.volume, {", ".join("e." + name for name in BOUNDS)}, u.parameters FROM events e JOIN runs u ON u.run_id = e.run_id {join}'
+             + (' WHERE ' + ' AND '.join(conditions) if conditions else '') + ' ORDER BY u.e2_date, e.event_id')
+    conn = open_inventory(path)
+    try:
+        return pd.read_sql_query(query, conn, params=values)
+    finally:
+        conn.close()
+
+def export_csv(events, output_path):
+    # Volumes sorted from the largest with the number of events of equal or larger volume (frequency-magnitude)
+    events = events.sort_values('volume', ascending=False, na_position='last').reset_index(drop=True)
+    volumes = events['volume'].to_numpy(dtype=np.float64)
+    known = ~np.isnan(volumes)
+    # Events of equal volume share the count of the first of them, not their position in the sorted list
+    events['n_larger_or_equal'] = np.nan
+    events.loc[known, 'n_larger_or_equal'] = known.sum() - np.searchsorted(np.sort(volumes[known]), volumes[known], side='left')
+    events.drop(columns=['parameters']).round(4).to_csv(output_path, index=False)
+    return output_path
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PyRockDiff rockfall inventory: query the events of every run")
+    parser.add_argument('inventory', help=f"Inventory database ({INVENTORY_FILE} in the output path)")
+    parser.add_argument('--bbox', type=float, nargs=6, metavar=('MIN_X', 'MIN_Y', 'MIN_Z', 'MAX_X', 'MAX_Y', 'MAX_Z'), help="Events intersecting this box")
+    parser.add_argument('--since', help="Events of epoch pairs ending on or after this date (YYYY-MM-DD)")
+    parser.add_argument('--until', help="Events of epoch pairs starting on or before this date (YYYY-MM-DD)")
+    parser.add_argument('--min-volume', type=float, help="Minimum volume (m³)")
+    parser.add_argument('--max-volume', type=float, help="Maximum volume (m³)")
+    parser.add_argument('--csv', help="Export the selected events to this CSV file")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not os.path.exists(args.inventory):
+        print(f"ERROR: Inventory not found: {args.inventory}")
+        sys.exit(2)
+    events = query_events(args.inventory, args.bbox, args.since, args.until, args.min_volume, args.max_volume)
+    print(f"{len(events)} events from {events['project'].nunique()} runs, total volume {events['volume'].sum():.3f} m³")
+    if args.csv:
+        print(f"Exported to {export_csv(events, args.csv)}")
+    else:
+        print(events.drop(columns=['parameters', 'project', 'e1', 'e2'] + BOUNDS).to_string(index=False))
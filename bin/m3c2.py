@@ -1,33 +1,251 @@
-import subprocess
+from bin.telemetry import run_CloudCompare
 import os
-from bin.utils import get_file_name, _print, loadPC, savePC
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+from bin.utils import get_file_name, _print, loadPC, savePC, ascii_copies, PC_EXT
+import bin.spatial_index as si
 import pandas as pd
-def m3c2_core(CloudComapare_path, e1_path, e2_path, m3c2_param, m3c2_path, epoch1_path, epoch2_path):
+import numpy as np
+
+OCTREE_NORMALS_RADIUS = 0.12  # same radius used by the CloudCompare backend (-OCTREE_NORMALS)
+M3C2_COLUMNS = ['x', 'y', 'z', 'change_significance', 'dist_uncertainty', 'm3c2_diff']
+
+def m3c2_core(CloudComapare_path, e1_path, e2_path, m3c2_param, m3c2_path, epoch1_path, epoch2_path, engine='cloudcompare', reference=None, spatial_index=False):
     epoch1_name = get_file_name(epoch1_path)
     epoch2_name = get_file_name(epoch2_path)
 
-    _print("Running M3C2 algorithm to compute the differences")
+    output = os.path.join(m3c2_path, epoch1_name + "_vs_" + epoch2_name + "__m3c2" + PC_EXT)
+    ascii_output = os.path.join(m3c2_path, epoch1_name + "_vs_" + epoch2_name + "__m3c2.xyz")
 
-    output = os.path.join(m3c2_path, epoch1_name + "_vs_" + epoch2_name + "__m3c2.xyz")
+    if engine == 'native':
+        _print("Running M3C2 algorithm (native engine) to compute the differences")
+        e1 = loadPC(e1_path, array=True)
+        e2 = loadPC(e2_path, array=True)
+        trees = (None, None)
+        if spatial_index:
+            trees = (None if reference is not None else si.open_index(e1_path, e1), si.open_index(e2_path, e2))
+        pc_df = m3c2_native(e1[:, :3], e2[:, :3], read_m3c2_params(m3c2_param), reference=reference, trees=trees)
+        _print("M3C2 algorithm completed successfully")
+        savePC(output, pc_df)
+        return output
 
-    CC_m3c2_Command = [CloudComapare_path,
-                      "-AUTO_SAVE", "OFF",
-                      "-C_EXPORT_FMT", "ASC", "-PREC", "3",
-                      "-O", e1_path, "-OCTREE_NORMALS", "0.12", "-ORIENT", "MINUS_ORIGIN",
-                      "-O", e2_path,
-                      "-M3C2", m3c2_param,
-                      "-CLEAR_NORMALS",
-                      "-SAVE_CLOUDS", "FILE", f'"{e1_path}" "{e2_path}" "{output}"']
+    _print("Running M3C2 algorithm to compute the differences")
+    with ascii_copies(e1_path, e2_path) as (e1_path, e2_path):
+        CC_m3c2_Command = [CloudComapare_path,
+                          "-AUTO_SAVE", "OFF",
+                          "-C_EXPORT_FMT", "ASC", "-PREC", "3",
+                          "-O", e1_path, "-OCTREE_NORMALS", str(OCTREE_NORMALS_RADIUS), "-ORIENT", "MINUS_ORIGIN",
+                          "-O", e2_path,
+                          "-M3C2", m3c2_param,
+                          "-CLEAR_NORMALS",
+                          "-SAVE_CLOUDS", "FILE", f'"{e1_path}" "{e2_path}" "{ascii_output}"']
 
-    subprocess.run(CC_m3c2_Command)
+        run_CloudCompare(CC_m3c2_Command)
 
     _print("M3C2 algorithm completed successfully")
     _print("M3C2 adding file headings")
 
-    pc = loadPC(output)
-    pc_df = pc.dropna()
-    pc_df.columns = ['x', 'y', 'z', 'change_significance', 'dist_uncertainty', 'm3c2_diff']
+    pc_df = pd.DataFrame(np.loadtxt(ascii_output, ndmin=2)[:, :len(M3C2_COLUMNS)], columns=M3C2_COLUMNS).dropna()
     savePC(output, pc_df)
+    os.remove(ascii_output)
 
     return output
 
+def read_m3c2_params(m3c2_param):
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    if not config.read(m3c2_param):
+        raise FileNotFoundError(f"M3C2 parameter file not found: {m3c2_param}")
+    general = config['General']
+    return {
+        'normal_mode': general.getint('NormalMode', 0),
+        'normal_scale': general.getfloat('NormalScale'),
+        'normal_min_scale': general.getfloat('NormalMinScale'),
+        'normal_step': general.getfloat('NormalStep'),
+        'normal_max_scale': general.getfloat('NormalMaxScale'),
+        'normal_orientation': general.getint('NormalPreferedOri', 2),
+        'search_scale': general.getfloat('SearchScale'),
+        'search_depth': general.getfloat('SearchDepth'),
+        'registration_error': general.getfloat('RegistrationError', 0) if general.getboolean('RegistrationErrorEnabled', False) else 0.0,
+        'use_median': general.getboolean('UseMedian', False),
+        'min_points': general.getint('MinPoints4Stat', 5) if general.getboolean('UseMinPoints4Stat', False) else 1,
+        'positive_only': general.getboolean('PositiveSearchOnly', False),
+        'single_pass': general.getboolean('UseSinglePass4Depth', False),
+        'max_threads': general.getint('MaxThreadCount', os.cpu_count() or 1),
+    }
+
+def _local_covariance(tree, points, queries, radius):
+    counts, idx, owner = si.radius_neighbours(tree, queries, radius)
+    rel = points[idx] - queries[owner]
+    n = np.maximum(counts, 1)
+    mean = np.stack([np.bincount(owner, rel[:, i], len(queries)) for i in range(3)], axis=1) / n[:, None]
+    cov = np.empty((len(queries), 3, 3))
+    for i in range(3):
+        for j in range(i, 3):
+            cov[:, i, j] = np.bincount(owner, rel[:, i] * rel[:, j], len(queries)) / n - mean[:, i] * mean[:, j]
+            cov[:, j, i] = cov[:, i, j]
+    return cov, counts
+
+def _orientation_vectors(points, orientation):
+    # CloudCompare M3C2 preferred orientations: +X, -X, +Y, -Y, +Z, -Z, +Barycenter, -Barycenter, +Origin, -Origin
+    if orientation < 6:
+        axis = np.zeros(3)
+        axis[orientation // 2] = 1 if orientation % 2 == 0 else -1
+        return np.broadcast_to(axis, points.shape)
+    if orientation < 8:
+        reference = points.mean(axis=0)
+        sign = 1 if orientation == 6 else -1
+    else:
+        reference = np.zeros(3)
+        sign = 1 if orientation == 8 else -1
+    return sign * (points - reference)
+
+def compute_normals(tree, points, queries, params):
+    mode = params['normal_mode']
+    if mode == 3:
+        return np.tile([0.0, 0.0, 1.0], (len(queries), 1))
+    if mode == 2:
+        scales = np.arange(params['normal_min_scale'], params['normal_max_scale'] + 1e-9, params['normal_step'])
+    elif mode == 1:
+        scales = [OCTREE_NORMALS_RADIUS * 2]
+    else:
+        scales = [params['normal_scale']]
+
+    normals = np.full((len(queries), 3), np.nan)
+    best = np.full(len(queries), np.inf)
+    for scale in scales:
+        cov, counts = _local_covariance(tree, points, queries, scale / 2)
+        eigenvalues, eigenvectors = np.linalg.eigh(cov)
+        planarity = eigenvalues[:, 0] / np.maximum(eigenvalues.sum(axis=1), 1e-12)
+        better = (counts >= 3) & (planarity < best)
+        normals[better] = eigenvectors[better, :, 0]
+        best[better] = planarity[better]
+
+    if mode == 4:
+        normals[:, 2] = 0
+        normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+
+    # mode 1 mimics "-ORIENT MINUS_ORIGIN" of the CloudCompare backend
+    reference = -queries if mode == 1 else _orientation_vectors(queries, params['normal_orientation'])
+    flip = np.einsum('ij,ij->i', normals, reference) < 0
+    normals[flip] *= -1
+    return normals
+
+def _group_quantile(sorted_values, starts, counts, q):
+    position = starts + q * (counts - 1)
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+def _cylinder_stats(tree, points, cores, normals, radius, half_length, use_median, positive_only):
+    search_radius = np.sqrt(radius ** 2 + half_length ** 2)
+    counts, idx, owner = si.radius_neighbours(tree, cores, search_radius)
+    rel = points[idx] - cores[owner]
+    h = np.einsum('ij,ij->i', rel, normals[owner])
+    inside = (np.einsum('ij,ij->i', rel, rel) - h ** 2 <= radius ** 2) & (np.abs(h) <= half_length)
+    if positive_only:
+        inside &= h >= 0
+    owner, h = owner[inside], h[inside]
+
+    n = np.bincount(owner, minlength=len(cores))
+    center = np.full(len(cores), np.nan)
+    spread = np.full(len(cores), np.nan)
+    valid = n > 0
+    if use_median:
+        order = np.lexsort((h, owner))
+        h_sorted = h[order]
+        starts = np.concatenate([[0], np.cumsum(n)[:-1]])[valid]
+        center[valid] = _group_quantile(h_sorted, starts, n[valid], 0.5)
+        spread[valid] = (_group_quantile(h_sorted, starts, n[valid], 0.75) - _group_quantile(h_sorted, starts, n[valid], 0.25))
+    else:
+        total = np.bincount(owner, h, len(cores))
+        total_sq = np.bincount(owner, h ** 2, len(cores))
+        center[valid] = total[valid] / n[valid]
+        spread[valid] = np.sqrt(np.maximum(total_sq[valid] / n[valid] - center[valid] ** 2, 0))
+    return n, center, spread
+
+def _progressive_stats(tree, points, cores, normals, params, positive_only=False):
+    radius = params['search_scale'] / 2
+    max_half_length = params['search_depth'] / 2
+    n = np.zeros(len(cores), dtype=np.int64)
+    center = np.full(len(cores), np.nan)
+    spread = np.full(len(cores), np.nan)
+
+    # Like CloudCompare, the cylinder grows progressively until enough points are found (unless single pass)
+    half_length = max_half_length if params['single_pass'] else min(radius, max_half_length)
+    pending = np.arange(len(cores))
+    while len(pending):
+        n_p, c_p, s_p = _cylinder_stats(tree, points, cores[pending], normals[pending], radius, half_length,
+                                        params['use_median'], positive_only)
+        n[pending], center[pending], spread[pending] = n_p, c_p, s_p
+        if half_length >= max_half_length:
+            break
+        pending = pending[n_p < params['min_points']]
+        half_length = min(half_length * 2, max_half_length)
+
+    center[n < params['min_points']] = np.nan
+    return n, center, spread
+
+def _reference_chunk(tree1, e1, cores, params):
+    normals = compute_normals(tree1, e1, cores, params)
+    n1, c1, s1 = _progressive_stats(tree1, e1, cores, normals, params)
+    return normals, n1, c1, s1
+
+def _m3c2_chunk(tree1, e1, tree2, e2, cores, params, reference_stats=None):
+    normals, n1, c1, s1 = reference_stats or _reference_chunk(tree1, e1, cores, params)
+    n2, c2, s2 = _progressive_stats(tree2, e2, cores, normals, params, positive_only=params['positive_only'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff = c2 - c1
+        uncertainty = 1.96 * (np.sqrt(s1 ** 2 / n1 + s2 ** 2 / n2) + params['registration_error'])
+    significance = (np.abs(diff) > uncertainty).astype(float)
+    significance[np.isnan(diff)] = np.nan
+    return np.column_stack([cores, significance, uncertainty, diff])
+
+def m3c2_reference(e1, params, chunk_size=20000, workers=None, tree=None):
+    # Everything that only depends on the reference epoch (core points = e1): KD-tree, normals and cylinder statistics
+    e1 = np.ascontiguousarray(e1[:, :3], dtype=np.float64)
+    workers = workers or params.get('max_threads') or os.cpu_count()
+    tree1 = tree if tree is not None else si.build_index(e1)
+    starts = range(0, e1.shape[0], chunk_size)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda start: _reference_chunk(tree1, e1, e1[start:start + chunk_size], params), starts))
+    if not results:
+        return {'tree': tree1, 'normals': np.empty((0, 3)), 'n': np.empty(0, dtype=np.int64), 'center': np.empty(0), 'spread': np.empty(0)}
+    normals, n, center, spread = [np.concatenate(values) for values in zip(*results)]
+    return {'tree': tree1, 'normals': normals, 'n': n, 'center': center, 'spread': spread}
+
+def m3c2_native(e1, e2, params, core_points=None, chunk_size=20000, workers=None, reference=None, trees=(None, None)):
+    e1 = np.ascontiguousarray(e1[:, :3], dtype=np.float64)
+    e2 = np.ascontiguousarray(e2[:, :3], dtype=np.float64)
+    cores = e1 if core_points is None else np.ascontiguousarray(core_points[:, :3], dtype=np.float64)
+    workers = workers or params.get('max_threads') or os.cpu_count()
+
+    if reference is not None and (core_points is not None or reference['tree'].n != e1.shape[0]):
+        _print("M3C2 native: the precomputed reference doesn't match the first epoch and won't be used")
+        reference = None
+    if reference is not None:
+        _print(f"M3C2 native: using the precomputed reference ({e1.shape[0]} points), building the KD-tree of {e2.shape[0]} points")
+        tree1 = reference['tree']
+    elif trees[0] is not None:
+        tree1 = trees[0]
+    else:
+        _print(f"M3C2 native: building the KD-tree of {e1.shape[0]} points")
+        tree1 = si.build_index(e1)
+    tree2 = trees[1] if trees[1] is not None else si.build_index(e2)
+
+    def chunk_result(start):
+        stop = start + chunk_size
+        reference_stats = None
+        if reference is not None:
+            reference_stats = tuple(reference[key][start:stop] for key in ['normals', 'n', 'center', 'spread'])
+        return _m3c2_chunk(tree1, e1, tree2, e2, cores[start:stop], params, reference_stats)
+
+    starts = range(0, cores.shape[0], chunk_size)
+    _print(f"M3C2 native: {cores.shape[0]} core points in {len(starts)} chunks using {workers} threads")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(chunk_result, starts))
+
+    result = np.vstack(results) if results else np.empty((0, len(M3C2_COLUMNS)))
+    pc_df = pd.DataFrame(result, columns=M3C2_COLUMNS).dropna()
+    _print(f"M3C2 native: {pc_df.shape[0]} core points with valid distances")
+    return pc_df
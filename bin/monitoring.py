@@ -0,0 +1,134 @@
+import os
+import glob
+import json
+import numpy as np
+import open3d as o3d
+import bin.cache as ch
+import bin.registration as reg
+import bin.m3c2 as m3c2
+import bin.spatial_index as si
+from bin.utils import get_file_name, _print, loadO3D, loadPC
+
+REFERENCE_SUFFIX = '_reference'
+REFERENCE_OPTIONS = ['transform_and_subsample', 'subsample_engine', 'vegetation_filter', 'canupo_engine', 'cleaning_filtering', 'fast_registration',
+                     'icp_registration', 'icp_engine', 'roi_focus', 'm3c2_dist', 'm3c2_engine']
+REFERENCE_PARAMETERS = ['spatial_distance', 'canupo_rock_class', 'nb_neighbors_f', 'std_ratio_f', 'tile_size', 'tile_halo', 'voxel_size', 'icp_voxel_levels', 'icp_max_distance']
+
+def expand_epochs(epochs, reference_path=None):
+    # A list of scans and/or glob patterns ("D:\\scans\\*.las"). Every pattern is expanded in name order
+    if isinstance(epochs, str):
+        epochs = [epochs]
+    paths = []
+    for pattern in epochs:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if matches else [pattern])
+    reference = os.path.abspath(reference_path) if reference_path else None
+    return [path for path in dict.fromkeys(paths) if os.path.abspath(path) != reference]
+
+def uses_m3c2_reference(options, parameters):
+    # The M3C2 normals and reference statistics are only valid if the reference cloud is not clipped per epoch
+    return (options['m3c2_dist'] and options.get('m3c2_engine', 'cloudcompare') == 'native'
+            and not options['roi_focus'] and not parameters.get('tile_size', 0))
+
+def open_reference(pointCloud, options, parameters, paths):
+    folder = paths.get('reference') or os.path.join(paths['output'], get_file_name(pointCloud['e1']) + REFERENCE_SUFFIX)
+    os.makedirs(folder, exist_ok=True)
+    hashes = {'hashes_path': os.path.join(folder, 'hashes.json'), 'hashes': {}}
+    if os.path.exists(hashes['hashes_path']):
+        with open(hashes['hashes_path']) as f:
+            hashes['hashes'] = json.load(f)
+
+    inputs = [pointCloud['e1']]
+    if options['vegetation_filter']:
+        inputs.append(paths['canupo_file'])
+    if uses_m3c2_reference(options, parameters):
+        inputs.append(paths['m3c2_param'])
+    params = {'options': {key: options.get(key) for key in REFERENCE_OPTIONS},
+              'parameters': {key: parameters.get(key) for key in REFERENCE_PARAMETERS}}
+    key = ch.stage_key(hashes, 'reference', inputs, params)
+
+    reference = {'folder': folder, 'key': key, 'params': params, 'files': {}, 'ready': False}
+    manifest_path = os.path.join(folder, 'reference.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        files = [name for value in manifest['files'].values() for name in (value if isinstance(value, list) else [value])]
+        if manifest['key'] == key and all(os.path.exists(os.path.join(folder, name)) for name in files):
+            reference.update(files=manifest['files'], ready=True)
+            _print(f"Monitoring: reusing the preprocessed reference {get_file_name(pointCloud['e1'])} ({key[:12]})")
+    return reference
+
+def _save_pcd(path, pcd):
+    np.save(path, np.hstack([np.asarray(pcd.points), np.asarray(pcd.normals)]))
+    return os.path.basename(path)
+
+def _load_pcd(path):
+    data = np.load(path)
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(np.ascontiguousarray(data[:, :3]))
+    pcd.normals = o3d.utility.Vector3dVector(np.ascontiguousarray(data[:, 3:6]))
+    return pcd
+
+def save_reference(reference, cloud_path, options, parameters, paths):
+    folder = reference['folder']
+    name = get_file_name(cloud_path)
+    files = {'cloud': os.path.relpath(cloud_path, folder)}
+
+    fgr = options['fast_registration']
+    icp = options['icp_registration'] and options.get('icp_engine', 'cloudcompare') == 'native'
+    if fgr or icp:
+        target = loadO3D(cloud_path)
+        voxel_size = parameters['voxel_size']
+        if fgr:
+            _print("Monitoring: computing the FPFH features of the reference")
+            target_down, target_fpfh = reg.preprocess_point_cloud(target, voxel_size)
+            files['fgr_points'] = _save_pcd(os.path.join(folder, name + '__fgr_points.npy'), target_down)
+            np.save(os.path.join(folder, name + '__fgr_fpfh.npy'), np.asarray(target_fpfh.data))
+            files['fgr_fpfh'] = name + '__fgr_fpfh.npy'
+        if icp:
+            _print("Monitoring: computing the ICP levels and normals of the reference")
+            voxel_levels = reg.icp_voxel_levels(parameters)
+            files['icp_levels'] = [_save_pcd(os.path.join(folder, name + f'__icp_level{level}.npy'), target_level)
+                                   for level, target_level in enumerate(reg.icp_target_levels(target, voxel_levels, reg.icp_max_distance(parameters)))]
+
+    if uses_m3c2_reference(options, parameters):
+        _print("Monitoring: computing the M3C2 normals, statistics and KD-tree of the reference")
+        e1 = loadPC(cloud_path, array=True)
+        tree = si.open_index(cloud_path, e1)
+        stats = m3c2.m3c2_reference(e1[:, :3], m3c2.read_m3c2_params(paths['m3c2_param']), tree=tree)
+        stats.pop('tree')
+        np.savez(os.path.join(folder, name + '__m3c2_stats.npz'), **stats)
+        files['m3c2_kdtree'] = os.path.relpath(si.index_path(cloud_path), folder)
+        files['m3c2_stats'] = name + '__m3c2_stats.npz'
+
+    manifest = {'key': reference['key'], 'params': reference['params'], 'files': files}
+    manifest_path = os.path.join(folder, 'reference.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    reference.update(files=files, ready=True)
+    return reference
+
+def load_reference(reference):
+    # Open3D clouds, features and the KD-tree are loaded once and shared by every epoch
+    folder = reference['folder']
+    files = reference['files']
+    loaded = {'cloud': os.path.join(folder, files['cloud'])}
+    if 'fgr_points' in files:
+        fpfh = o3d.pipelines.registration.Feature()
+        fpfh.data = np.load(os.path.join(folder, files['fgr_fpfh']))
+        loaded['fgr'] = (_load_pcd(os.path.join(folder, files['fgr_points'])), fpfh)
+    if 'icp_levels' in files:
+        loaded['icp'] = [_load_pcd(os.path.join(folder, name)) for name in files['icp_levels']]
+    if 'm3c2_kdtree' in files:
+        tree = si.open_index(loaded['cloud'])
+        with np.load(os.path.join(folder, files['m3c2_stats'])) as stats:
+            loaded['m3c2'] = dict(stats, tree=tree)
+    return loaded
+
+def save_summary(reference, results):
+    summary_path = os.path.join(reference['folder'], 'monitoring.json')
+    with open(summary_path + '.tmp', 'w') as f:
+        json.dump({'reference': reference['files'].get('cloud'), 'epochs': results}, f, indent=2)
+    os.replace(summary_path + '.tmp', summary_path)
+    return summary_path
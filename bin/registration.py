@@ -1,11 +1,15 @@
 import open3d as o3d
 import copy
+import json
 import numpy as np
 import os
 import subprocess
-from bin.utils import get_file_name, _print
+from bin.utils import get_file_name, _print, loadO3D, saveO3D, loadPC, ascii_copies, fromASCII, PC_EXT
 from pathlib import Path
+from bin.telemetry import run_CloudCompare
 import datetime
+from collections import namedtuple
+import bin.spatial_index as si
 
 def preprocess_point_cloud(pcd, voxel_size):
     _print("Downsample with a voxel size %.3f." % voxel_size)
@@ -35,15 +39,15 @@ def draw_registration_result(source, target, transformation, initial=False, enab
             _print("Showing Point Cloud registration result")
         o3d.visualization.draw_geometries([source_temp, target_temp])
 
-def prepare_dataset(voxel_size, target_pc, source_pc):
+def prepare_dataset(voxel_size, target_pc, source_pc, gui=True):
     _print("Load two point clouds and disturb initial pose.")
-    target = o3d.io.read_point_cloud(target_pc, format='xyz')
-    source = o3d.io.read_point_cloud(source_pc, format='xyz')
+    target = loadO3D(target_pc)
+    source = loadO3D(source_pc)
 
     source_down, source_fpfh = preprocess_point_cloud(source, voxel_size)
     target_down, target_fpfh = preprocess_point_cloud(target, voxel_size)
 
-    draw_registration_result(source_down, target_down, np.identity(4), initial=True, enable=True)
+    draw_registration_result(source_down, target_down, np.identity(4), initial=True, enable=gui)
 
     return source, target, source_down, target_down, source_fpfh, target_fpfh
 
@@ -75,64 +79,262 @@ def execute_fast_global_registration(source_down, target_down, source_fpfh, targ
     return result
 
 
-def FGR_reg(voxel_size, e1_path, e2_path, registration_folder, ite):
-    _print(f"Running FGR algorithm to do a fast registration - {ite} iterations will be executed")
-    e1_name = get_file_name(e1_path)
-    e2_name = get_file_name(e2_path)
-    e1_path_out = os.path.join(registration_folder, e1_name + '__FGR.xyz')
-    e2_path_out = os.path.join(registration_folder, e2_name + '__FGR.xyz')
+def step_metrics(method, step, voxel_size, distance_threshold, result, discarded=False):
+    return {'method': method, 'step': step, 'voxel_size': float(voxel_size), 'max_distance': float(distance_threshold),
+            'fitness': float(result.fitness), 'inlier_rmse': float(result.inlier_rmse), 'discarded': bool(discarded)}
+
+def converged(previous, result, tolerance):
+    # Relative gain in fitness and in inlier RMSE below the tolerance (0: never)
+    if not tolerance or previous is None:
+        return False
+    fitness_gain = (result.fitness - previous.fitness) / max(previous.fitness, 1e-12)
+    rmse_gain = (previous.inlier_rmse - result.inlier_rmse) / max(previous.inlier_rmse, 1e-12)
+    return fitness_gain < tolerance and rmse_gain < tolerance
+
+def FGR_core(source, target, voxel_size, ite, gui=True, target_features=None, tolerance=0, steps=None):
+    # The target (e1) never moves: its downsampled cloud and FPFH features are computed only once (or given by the monitoring reference).
+    # FPFH is invariant to rigid transforms, so the source features are reused and only its points are moved.
+    target_down, target_fpfh = target_features or preprocess_point_cloud(target, voxel_size)
+    source_down, source_fpfh = preprocess_point_cloud(source, voxel_size)
+    draw_registration_result(source_down, target_down, np.identity(4), initial=True, enable=gui)
 
+    steps = [] if steps is None else steps
+    transformation = np.identity(4)
+    previous = None
     for i in range(ite):
         _print(f"Running FGR algorithm for fast registration (Iteration {i + 1} of {ite})")
-        source, target, source_down, target_down, source_fpfh, target_fpfh = prepare_dataset(voxel_size, target_pc=e1_path, source_pc=e2_path)
-        result_fast = execute_fast_global_registration(source_down, target_down, source_fpfh, target_fpfh, voxel_size)
-        source_reg = source.transform(result_fast.transformation)
-        draw_registration_result(source_down.transform(result_fast.transformation), target_down, np.identity(4), enable=True)
-        # draw_registration_result(target, source_reg, np.identity(4))
+        source_moved = copy.deepcopy(source_down).transform(transformation)
+        result_fast = execute_fast_global_registration(source_moved, target_down, source_fpfh, target_fpfh, voxel_size)
+        _print(f"FGR algorithm - Iteration {i + 1} of {ite} completed successfully "
+               f"(fitness: {result_fast.fitness:.4f}, inlier RMSE: {result_fast.inlier_rmse:.4f})\n")
+        if converged(previous, result_fast, tolerance):
+            # An iteration that makes the alignment worse is discarded
+            worse = result_fast.fitness < previous.fitness
+            if not worse:
+                transformation = result_fast.transformation @ transformation
+            steps.append(step_metrics('FGR', i + 1, voxel_size, voxel_size * 0.5, result_fast, discarded=worse))
+            _print(f"FGR improvement below the tolerance ({tolerance:g}): {ite - i - 1} iterations not executed")
+            break
+        transformation = result_fast.transformation @ transformation
+        steps.append(step_metrics('FGR', i + 1, voxel_size, voxel_size * 0.5, result_fast))
+        previous = result_fast
+
+    draw_registration_result(source_down, target_down, transformation, enable=gui)
+    return transformation
+
+def registration_file(registration_folder, e2_path):
+    return os.path.join(registration_folder, get_file_name(e2_path) + '__registration.json')
+
+def save_registration(registration_folder, e2_name, transformation, steps, **info):
+    # Final transformation and the metrics of every FGR iteration and ICP level, in a single file per run
+    registration_path = registration_file(registration_folder, e2_name)
+    registration = dict(info, created=datetime.datetime.now().isoformat(timespec='seconds'),
+                        transformation=np.round(transformation, 9).tolist(), steps=steps)
+    with open(registration_path + '.tmp', 'w') as f:
+        json.dump(registration, f, indent=2)
+    os.replace(registration_path + '.tmp', registration_path)
+    _print(f"Transformation matrix:\n{np.array2string(transformation, precision=6)}")
+    return registration_path
 
-        o3d.io.write_point_cloud(e1_path_out, target, format='xyz',
-                                 write_ascii=True, compressed=False)
+def FGR_reg(voxel_size, e1_path, e2_path, registration_folder, ite, gui=True, reference=None, tolerance=0):
+    _print(f"Running FGR algorithm to do a fast registration - up to {ite} iterations will be executed")
+    e1_name = get_file_name(e1_path)
+    e2_name = get_file_name(e2_path)
+    e1_path_out = os.path.join(registration_folder, e1_name + '__FGR' + PC_EXT)
+    e2_path_out = os.path.join(registration_folder, e2_name + '__FGR' + PC_EXT)
 
-        o3d.io.write_point_cloud(e2_path_out, source_reg, format='xyz',
-                                 write_ascii=True, compressed=False)
+    _print("Load two point clouds")
+    target = loadO3D(e1_path)
+    source = loadO3D(e2_path)
 
-        now = datetime.datetime.now()
-        formatted_date = now.strftime("%Y-%m-%d")
-        formatted_time = now.strftime("%Hh%M")
-        transformation_matrix_path = os.path.join(registration_folder, e2_name + f'__FGR_REGISTRATION_MATRIX_{formatted_date}_{formatted_time}.txt')
-        np.savetxt(transformation_matrix_path, result_fast.transformation, fmt='%.6f')  # Guarda la matriz con 6 decimales
+    steps = []
+    transformation = FGR_core(source, target, voxel_size, ite, gui=gui, target_features=(reference or {}).get('fgr'), tolerance=tolerance, steps=steps)
 
-        e1_path = e1_path_out
-        e2_path = e2_path_out
-        _print(f"FGR algorithm - Iteration {i + 1} of {ite} completed successfully\n")
+    source_reg = source.transform(transformation)
+    saveO3D(e1_path_out, target)
+    saveO3D(e2_path_out, source_reg)
+    save_registration(registration_folder, e2_name, transformation, steps, method='FGR', e1=e1_path, e2=e2_path, tolerance=tolerance)
 
     return e1_path_out, e2_path_out
 
-def ICP_reg(e1_path, e2_path, CloudComapare_path, ite):
-    _print(f"Running ICP algorithm to refine registration - {ite} iterations will be executed")
+def icp_level(pcd, voxel_levels, level, max_distance):
+    # A full-resolution level (voxel 0) uses the voxel of the previous coarser level as distance, or max_distance
+    voxel = voxel_levels[level]
+    if voxel > 0:
+        return pcd.voxel_down_sample(voxel), voxel * 1.5
+    coarser = [previous for previous in voxel_levels[:level] if previous > 0]
+    return pcd, coarser[-1] if coarser else max_distance
+
+def icp_target_levels(target, voxel_levels, max_distance):
+    # Downsampled target of every ICP level with the normals needed by the point-to-plane estimation
+    target_levels = []
+    for level, voxel in enumerate(voxel_levels):
+        target_level, distance_threshold = icp_level(target, voxel_levels, level, max_distance)
+        radius_normal = max(voxel, distance_threshold) * 2
+        target_level.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=radius_normal, max_nn=30))
+        target_levels.append(target_level)
+    return target_levels
+
+def icp_voxel_levels(parameters):
+    voxel_size = parameters['voxel_size']
+    voxel_levels = parameters.get('icp_voxel_levels', [voxel_size, voxel_size / 2, voxel_size / 4])
+    if not voxel_levels:
+        raise ValueError("'icp_voxel_levels' is empty: give at least one ICP level (0 for full resolution)")
+    return voxel_levels
+
+def icp_max_distance(parameters):
+    # Correspondence distance of a full-resolution first ICP level: the FGR voxel unless it is given
+    return parameters.get('icp_max_distance') or parameters['voxel_size']
+
+def ICP_core(source, target, init, voxel_levels, max_distance, max_iteration=50, tolerance=1e-6, target_levels=None, level_tolerance=0, steps=None):
+    # Coarse-to-fine: with level_tolerance, the finer levels are skipped once a level barely improves the alignment it started from
+    if not voxel_levels:
+        raise ValueError("ICP needs at least one voxel level")
+    transformation = init
+    result = None
+    steps = [] if steps is None else steps
+    target_levels = target_levels or icp_target_levels(target, voxel_levels, max_distance)
+    for level, voxel in enumerate(voxel_levels):
+        source_level, distance_threshold = icp_level(source, voxel_levels, level, max_distance)
+        initial = None
+        if level_tolerance:
+            initial = o3d.pipelines.registration.evaluate_registration(source_level, target_levels[level], distance_threshold, transformation)
+
+        # Point-to-plane ICP stops by itself once the relative fitness and RMSE changes fall below the tolerance
+        result = o3d.pipelines.registration.registration_icp(
+            source_level, target_levels[level], distance_threshold, transformation,
+            o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+            o3d.pipelines.registration.ICPConvergenceCriteria(relative_fitness=tolerance, relative_rmse=tolerance,
+                                                             max_iteration=max_iteration))
+        transformation = result.transformation
+        steps.append(step_metrics('ICP', level + 1, voxel, distance_threshold, result))
+        _print(f"ICP level {level + 1} of {len(voxel_levels)} (voxel: {voxel:.3f}, max distance: {distance_threshold:.3f}): "
+               f"fitness: {result.fitness:.4f}, inlier RMSE: {result.inlier_rmse:.4f}")
+        if level + 1 < len(voxel_levels) and converged(initial, result, level_tolerance):
+            _print(f"ICP improvement below the tolerance ({level_tolerance:g}): {len(voxel_levels) - level - 1} finer levels not executed")
+            break
+    return transformation, result
+
+def native_registration(e1_path, e2_path, registration_folder, parameters, fgr=True, icp=True, gui=True, reference=None):
+    e1_name = get_file_name(e1_path)
+    e2_name = get_file_name(e2_path)
+    method = 'ICP' if icp else 'FGR'
+    e1_path_out = os.path.join(registration_folder, e1_name + f'__{method}' + PC_EXT)
+    e2_path_out = os.path.join(registration_folder, e2_name + f'__{method}' + PC_EXT)
+    tolerance = parameters.get('registration_tolerance', 0)
+
+    _print("Load two point clouds")
+    target = loadO3D(e1_path)
+    source = loadO3D(e2_path)
+
+    steps = []
+    transformation = np.identity(4)
+    if fgr:
+        _print(f"Running FGR algorithm to do a fast registration - up to {parameters['ite_FGR']} iterations will be executed")
+        transformation = FGR_core(source, target, parameters['voxel_size'], parameters['ite_FGR'], gui=gui,
+                                  target_features=(reference or {}).get('fgr'), tolerance=tolerance, steps=steps)
+
+    if icp:
+        voxel_levels = icp_voxel_levels(parameters)
+        _print(f"Running ICP algorithm (point-to-plane) to refine registration - voxel levels: {voxel_levels}")
+        transformation, result = ICP_core(source, target, transformation, voxel_levels, icp_max_distance(parameters),
+                                          parameters.get('icp_max_iteration', 50), parameters.get('icp_tolerance', 1e-6),
+                                          target_levels=(reference or {}).get('icp'), level_tolerance=tolerance, steps=steps)
+        _print(f"ICP algorithm completed successfully: fitness: {result.fitness:.4f}, inlier RMSE: {result.inlier_rmse:.4f}")
+        draw_registration_result(source, target, transformation, enable=gui)
+    save_registration(registration_folder, e2_name, transformation, steps, method='+'.join(['FGR'] * fgr + ['ICP'] * icp),
+                      e1=e1_path, e2=e2_path, tolerance=tolerance)
+
+    source_reg = source.transform(transformation)
+    saveO3D(e1_path_out, target)
+    saveO3D(e2_path_out, source_reg)
+
+    return e1_path_out, e2_path_out
+
+Evaluation = namedtuple('Evaluation', 'fitness inlier_rmse')
+
+def evaluate_points(tree, points, max_distance):
+    # Same definitions as Open3D: share of the points within max_distance of the target, and RMSE of those points
+    distances, _ = si.knn(tree, points, 1, distance_upper_bound=max_distance)
+    inliers = distances[np.isfinite(distances[:, 0]), 0]
+    return Evaluation(inliers.size / max(len(points), 1), float(np.sqrt(np.mean(np.square(inliers)))) if inliers.size else 0.0)
+
+def rigid_transform(source, target):
+    # Least squares rotation and translation from source to target (same points, same order)
+    source_center, target_center = source.mean(axis=0), target.mean(axis=0)
+    u, _, vt = np.linalg.svd((source - source_center).T @ (target - target_center))
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1, 1, d]) @ u.T
+    transformation = np.identity(4)
+    transformation[:3, :3] = rotation
+    transformation[:3, 3] = target_center - rotation @ source_center
+    return transformation
+
+def ICP_reg(e1_path, e2_path, CloudComapare_path, ite, max_distance, registration_folder=None, tolerance=0):
+    # CloudCompare doesn't report the quality of its ICP: after every run the registered e2 is compared with e1
+    # (fitness and inlier RMSE within max_distance, voxel_size in main.py) and the iterations stop
+    # once they stop improving by more than the tolerance
+    _print(f"Running ICP algorithm to refine registration - up to {ite} iterations will be executed")
 
     e1_file = get_file_name(e1_path)
     e2_file = get_file_name(e2_path)
-    e1_path_out = os.path.join(Path(e1_path).parent, e1_file + "__ICP.xyz")
-    e2_path_out = os.path.join(Path(e2_path).parent, e2_file + "__ICP.xyz")
+    after_fgr = Path(e2_path).stem.endswith('__FGR')
+    e1_path_out = os.path.join(Path(e1_path).parent, e1_file + "__ICP" + PC_EXT)
+    e2_path_out = os.path.join(Path(e2_path).parent, e2_file + "__ICP" + PC_EXT)
+    e1_ascii_out = os.path.join(Path(e1_path).parent, e1_file + "__ICP.xyz")
+    e2_ascii_out = os.path.join(Path(e2_path).parent, e2_file + "__ICP.xyz")
+    registration_folder = registration_folder or str(Path(e2_path).parent)
 
-    for i in range(ite):
-        _print(f"Running ICP algorithm to refine registration (Iteration {i + 1} of {ite})")
-        CC_ICP_Command = [CloudComapare_path,
-                          "-AUTO_SAVE", "OFF",
-                          "-C_EXPORT_FMT", "ASC", "-PREC", "3",
-                          "-O", e1_path,
-                          "-O", e2_path,
-                          "-ICP", "-REFERENCE_IS_FIRST", "-OVERLAP", "100",
-                          "-RANDOM_SAMPLING_LIMIT", "1000000000", "-FARTHEST_REMOVAL",
-                          "-SAVE_CLOUDS", "FILE", f'"{e1_path_out}" "{e2_path_out}"']
-        try:
-            subprocess.run(CC_ICP_Command, check=True)
+    e1_points = loadPC(e1_path, array=True)[:, :3]
+    e2_initial = np.array(loadPC(e2_path, array=True)[:, :3], dtype=np.float64)
+    tree = si.build_index(e1_points)
+    previous = evaluate_points(tree, e2_initial, max_distance)
+    _print(f"Initial alignment: fitness: {previous.fitness:.4f}, inlier RMSE: {previous.inlier_rmse:.4f} (max distance: {max_distance:.3f})")
+    with ascii_copies(e1_path, e2_path) as (e1_path, e2_path):
+        steps = []
+        for i in range(ite):
+            _print(f"Running ICP algorithm to refine registration (Iteration {i + 1} of {ite})")
+            CC_ICP_Command = [CloudComapare_path,
+                              "-AUTO_SAVE", "OFF",
+                              "-C_EXPORT_FMT", "ASC", "-PREC", "3",
+                              "-O", e1_path,
+                              "-O", e2_path,
+                              "-ICP", "-REFERENCE_IS_FIRST", "-OVERLAP", "100",
+                              "-RANDOM_SAMPLING_LIMIT", "1000000000", "-FARTHEST_REMOVAL",
+                              "-SAVE_CLOUDS", "FILE", f'"{e1_ascii_out}" "{e2_ascii_out}"']
+            try:
+                run_CloudCompare(CC_ICP_Command, check=True)
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError(f"CloudCompare ICP failed with exit code {e.returncode} (iteration {i + 1} of {ite}): "
+                                   f"the registered clouds were not written. Check the CloudCompare path and its output above") from e
             _print(f"ICP algorithm - Iteration {i+1} of {ite} completed successfully")
-        except subprocess.CalledProcessError as e:
-            _print(f"ICP command failed with exit code {e.returncode}")
 
-        e1_path = e1_path_out
-        e2_path = e2_path_out
+            e1_path = e1_ascii_out
+            e2_path = e2_ascii_out
+            result = evaluate_points(tree, loadPC(e2_ascii_out, array=True)[:, :3], max_distance)
+            steps.append(step_metrics('ICP', i + 1, 0, max_distance, result))
+            _print(f"ICP iteration {i + 1} of {ite}: fitness: {result.fitness:.4f}, inlier RMSE: {result.inlier_rmse:.4f}")
+            if i + 1 < ite and converged(previous, result, tolerance):
+                _print(f"ICP improvement below the tolerance ({tolerance:g}): {ite - i - 1} iterations not executed")
+                break
+            previous = result
+
+    fromASCII(e1_ascii_out, e1_path_out)
+    fromASCII(e2_ascii_out, e2_path_out)
+    # CloudCompare reads and writes the clouds with 3 decimals: the transformation is recovered within a few millimetres
+    transformation = rigid_transform(e2_initial, loadPC(e2_path_out, array=True)[:, :3])
+    save_icp_registration(registration_folder, e2_file, transformation, steps, tolerance, after_fgr)
+    return e1_path_out, e2_path_out
 
-    return e1_path_out, e2_path_out
\ No newline at end of file
+def save_icp_registration(registration_folder, e2_name, transformation, steps, tolerance, after_fgr=False):
+    # After FGR, the ICP transformation and steps are added to the registration file of the FGR step
+    registration_path = registration_file(registration_folder, e2_name)
+    info = {'method': 'ICP (CloudCompare)', 'tolerance': tolerance}
+    if after_fgr and os.path.exists(registration_path):
+        with open(registration_path) as f:
+            fgr = json.load(f)
+        if fgr.get('method') == 'FGR':
+            transformation = transformation @ np.array(fgr['transformation'])
+            steps = fgr['steps'] + steps
+            info = {'method': 'FGR+ICP (CloudCompare)', 'e1': fgr.get('e1'), 'e2': fgr.get('e2'), 'tolerance': tolerance}
+    return save_registration(registration_folder, e2_name, transformation, steps, **info)
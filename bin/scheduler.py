@@ -0,0 +1,98 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from bin.utils import _print, start_log_buffer, stop_log_buffer, flush_log
+
+MEMORY_FACTOR = 4  # memory of a stage as a multiple of the size of its input file
+
+# Placeholder for the result of another task: it is also a dependency of the task that uses it
+Result = namedtuple('Result', 'name')
+
+def task(name, func, *args, requires=(), memory_gb=0.0, **kwargs):
+    results = [value.name for value in list(args) + list(kwargs.values()) if isinstance(value, Result)]
+    return {'name': name, 'func': func, 'args': args, 'kwargs': kwargs,
+            'requires': list(dict.fromkeys(list(requires) + results)), 'memory_gb': memory_gb}
+
+def estimate_memory_gb(path, factor=MEMORY_FACTOR):
+    return os.path.getsize(path) * factor / 1024 ** 3 if os.path.isfile(path) else 0.0
+
+def _resolve(value, results):
+    return results[value.name] if isinstance(value, Result) else value
+
+def _call(t, results):
+    return t['func'](*[_resolve(value, results) for value in t['args']],
+                     **{key: _resolve(value, results) for key, value in t['kwargs'].items()})
+
+def _run_buffered(t, results):
+    # Messages of concurrent tasks are kept apart and printed task by task, in the order of the graph
+    start_log_buffer()
+    try:
+        return _call(t, results)
+    finally:
+        t['log'] = stop_log_buffer()
+
+def check_graph(tasks):
+    # Tasks can only depend on previous tasks, so the graph has no cycles
+    names = set()
+    for t in tasks:
+        if t['name'] in names:
+            raise ValueError(f"Task {t['name']} is defined twice")
+        missing = [name for name in t['requires'] if name not in names]
+        if missing:
+            raise ValueError(f"Task {t['name']} depends on {', '.join(missing)}, which must be defined before it")
+        names.add(t['name'])
+
+def run_tasks(tasks, workers=1, memory_gb=0):
+    # A task starts when its dependencies are done, a worker is free and its memory fits in 'memory_gb'
+    # (0: no limit; a task larger than the limit runs alone). After a failure no new task is started,
+    # the running ones are completed and the first error is raised.
+    check_graph(tasks)
+    results = {}
+    if workers <= 1 or len(tasks) == 1:
+        for t in tasks:
+            results[t['name']] = _call(t, results)
+        return results
+
+    pending = list(tasks)
+    running = {}
+    finished = set()
+    error = None
+    used = 0.0
+    flushed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if error is None:
+                for t in list(pending):
+                    if len(running) >= workers:
+                        break
+                    if any(name not in results for name in t['requires']):
+                        continue
+                    if memory_gb and running and used + t['memory_gb'] > memory_gb:
+                        continue
+                    pending.remove(t)
+                    used += t['memory_gb']
+                    running[executor.submit(_run_buffered, t, results)] = t
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                t = running.pop(future)
+                used -= t['memory_gb']
+                finished.add(t['name'])
+                try:
+                    results[t['name']] = future.result()
+                except Exception as e:
+                    _print(f"Task {t['name']} failed: {e}")
+                    error = error or e
+            while flushed < len(tasks) and tasks[flushed]['name'] in finished:
+                flush_log(tasks[flushed].pop('log', []))
+                flushed += 1
+
+    for t in tasks[flushed:]:
+        flush_log(t.pop('log', []))
+    if error is not None:
+        skipped = [t['name'] for t in pending]
+        if skipped:
+            _print(f"Tasks not executed: {', '.join(skipped)}")
+        raise error
+    return results
@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+import scipy
+from scipy.spatial import cKDTree
+from bin.utils import get_file_name, loadPC, _print
+
+INDEX_VERSION = 2  # increase when the stored index changes
+INDEX_SUFFIX = '__kdtree'
+# Arrays of the cKDTree state (scipy pickling protocol), stored as .npy files and memory-mapped when loaded
+TREE_ARRAYS = {0: 'tree', 1: 'data', 5: 'maxes', 6: 'mins', 7: 'indices'}
+TREE_VALUES = {2: 'n', 3: 'm', 4: 'leafsize'}
+
+def index_path(cloud_path):
+    return os.path.join(os.path.dirname(cloud_path), Path(cloud_path).stem + INDEX_SUFFIX)
+
+def _signature(cloud_path):
+    stat = os.stat(cloud_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def build_index(points):
+    return cKDTree(np.ascontiguousarray(points[:, :3], dtype=np.float64))
+
+def save_index(cloud_path, tree, path=None):
+    # Stored next to the cloud with its size and modification time: an index is never used with another cloud.
+    # Only arrays and a JSON header are written, so loading an index never runs code from the file.
+    path = path or index_path(cloud_path)
+    state = tree.__getstate__()
+    if state[8] is not None:
+        raise ValueError("Periodic KD-trees can't be stored")
+    temporary = path + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for position, name in TREE_ARRAYS.items():
+        np.save(os.path.join(temporary, name + '.npy'), np.asarray(state[position]))
+    header = {'version': INDEX_VERSION, 'scipy': scipy.__version__, 'signature': _signature(cloud_path),
+              **{name: int(state[position]) for position, name in TREE_VALUES.items()}}
+    with open(os.path.join(temporary, 'index.json'), 'w') as f:
+        json.dump(header, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary, path)
+    return path
+
+def load_index(cloud_path, path=None):
+    # None if the index doesn't exist or was built for a different version of the cloud (or of scipy, which
+    # defines the layout of the tree). The points and indices stay on disk, memory-mapped
+    path = path or index_path(cloud_path)
+    header_path = os.path.join(path, 'index.json')
+    if not os.path.exists(header_path):
+        return None
+    with open(header_path) as f:
+        header = json.load(f)
+    if header.get('version') != INDEX_VERSION or header.get('scipy') != scipy.__version__ or header.get('signature') != _signature(cloud_path):
+        return None
+    state = [None] * 10
+    for position, name in TREE_ARRAYS.items():
+        state[position] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+    for position, name in TREE_VALUES.items():
+        state[position] = header[name]
+    if state[1].shape != (header['n'], header['m']):
+        return None
+    tree = cKDTree.__new__(cKDTree)
+    tree.__setstate__(tuple(state))
+    return tree
+
+def open_index(cloud_path, points=None, persist=True):
+    # KD-tree of a cloud file, built once and reused by every stage (and run) that queries the same points
+    tree = load_index(cloud_path) if persist else None
+    if tree is not None and (points is None or tree.n == len(points)):
+        _print(f'Spatial index of {get_file_name(cloud_path)}: reusing the stored KD-tree ({tree.n} points)')
+        return tree
+    if points is None:
+        points = loadPC(cloud_path, array=True)
+    _print(f'Spatial index of {get_file_name(cloud_path)}: building the KD-tree of {len(points)} points')
+    tree = build_index(points)
+    if persist:
+        save_index(cloud_path, tree)
+    return tree
+
+def knn(tree, queries, k, workers=-1, distance_upper_bound=np.inf):
+    distances, indices = tree.query(queries, k=k, workers=workers, distance_upper_bound=distance_upper_bound)
+    return distances.reshape(len(queries), -1), indices.reshape(len(queries), -1)
+
+def radius_neighbours(tree, queries, radius, workers=1, return_sorted=None):
+    # Flattened neighbourhoods: number of neighbours of every query, neighbour indices and the query of each neighbour
+    neighbours = tree.query_ball_point(queries, radius, workers=workers, return_sorted=return_sorted)
+    counts = np.fromiter(map(len, neighbours), dtype=np.int64, count=len(neighbours))
+    if counts.sum() == 0:
+        return counts, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    idx = np.concatenate([np.asarray(n, dtype=np.int64) for n in neighbours])
+    owner = np.repeat(np.arange(len(neighbours)), counts)
+    return counts, idx, owner
+
+def radius_counts(tree, queries, radius, workers=-1):
+    return tree.query_ball_point(queries, radius, return_length=True, workers=workers)
+
+def pairs(tree, radius):
+    # Pairs (i, j), i < j, of indexed points closer than radius
+    return tree.query_pairs(radius, output_type='ndarray')
@@ -0,0 +1,135 @@
+import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import numpy as np
+from bin.utils import get_file_name, _print, savePC, PC_EXT
+import bin.spatial_index as si
+
+try:
+    import laspy  # optional: native reading of .las/.laz scans
+except ImportError:
+    laspy = None
+
+CHUNK_SIZE = 5000000
+ASCII_FORMATS = ['.xyz', '.txt', '.asc', '.pts', '.csv']
+LAS_FORMATS = ['.las', '.laz']
+
+def native_format(path):
+    suffix = Path(path).suffix.lower()
+    return suffix == PC_EXT or suffix in ASCII_FORMATS or (suffix in LAS_FORMATS and laspy is not None)
+
+def _ascii_layout(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                break
+    sep = ',' if ',' in line else ';' if ';' in line else r'\s+'
+    tokens = line.replace(',', ' ').replace(';', ' ').split()
+    try:
+        [float(token) for token in tokens[:3]]
+        header = False
+    except ValueError:
+        header = True
+    return sep, header
+
+def iter_xyz(path, chunk_size=CHUNK_SIZE):
+    # Streams the XYZ coordinates of a scan: other fields (RGB, normals, scalar fields) are dropped
+    suffix = Path(path).suffix.lower()
+    if suffix == PC_EXT:
+        pc = np.load(path, mmap_mode='r')
+        for start in range(0, pc.shape[0], chunk_size):
+            chunk = pc[start:start + chunk_size]
+            if pc.dtype.names:
+                chunk = np.column_stack([chunk[name] for name in pc.dtype.names[:3]])
+            yield np.asarray(chunk[:, :3], dtype=np.float64)
+    elif suffix in LAS_FORMATS:
+        if laspy is None:
+            raise ValueError(f"Reading {suffix} files requires the laspy package")
+        with laspy.open(path) as f:
+            for points in f.chunk_iterator(chunk_size):
+                yield np.column_stack([points.x, points.y, points.z]).astype(np.float64)
+    elif suffix in ASCII_FORMATS:
+        sep, header = _ascii_layout(path)
+        reader = pd.read_csv(path, sep=sep, header=None, skiprows=1 if header else 0, usecols=[0, 1, 2],
+                             dtype=np.float64, chunksize=chunk_size, skip_blank_lines=True)
+        for chunk in reader:
+            yield chunk.values
+    else:
+        raise ValueError(f"Format {suffix} can't be read natively")
+
+def neighbour_pairs(points, radius, workers=None):
+    # Pairs (i, j), i < j, closer than radius. The cloud is split in X slabs processed in parallel:
+    # every slab also sees a margin of the next one, and only keeps the pairs with a point of its own
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or points.shape[0] < 100000:
+        return si.pairs(si.build_index(points), radius)
+    order = np.argsort(points[:, 0], kind='stable')
+    x = points[order, 0]
+    bounds = np.linspace(0, len(order), workers + 1).astype(np.int64)
+
+    def slab_pairs(k):
+        start, end = bounds[k], bounds[k + 1]
+        if start == end:
+            return np.empty((0, 2), dtype=np.int64)
+        stop = np.searchsorted(x, x[end - 1] + radius, side='right')
+        members = order[start:stop]
+        pairs = si.pairs(si.build_index(points[members]), radius)
+        pairs = pairs[(pairs < end - start).any(axis=1)]
+        pairs = members[pairs]
+        return np.sort(pairs, axis=1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return np.vstack(list(executor.map(slab_pairs, range(workers))))
+
+def greedy_selection(n_points, pairs):
+    # Same result as visiting the points in order and keeping a point when no kept point is closer than
+    # the radius, solved in rounds: a point is kept when all its lower neighbours are removed
+    state = np.zeros(n_points, dtype=np.int8)  # 0 undecided, 1 kept, 2 removed
+    lower, upper = pairs[:, 0], pairs[:, 1]
+    while True:
+        state[upper[state[lower] == 1]] = 2
+        active = (state[upper] == 0) & (state[lower] == 0)
+        lower, upper = lower[active], upper[active]
+        blocked = np.zeros(n_points, dtype=bool)
+        blocked[upper] = True
+        state[(state == 0) & ~blocked] = 1
+        if not (state == 0).any():
+            return state == 1
+
+def cell_representatives(path, cell_size, chunk_size=CHUNK_SIZE):
+    # First point of every occupied cell, in reading order. The cell diagonal equals the spatial distance,
+    # so the rest of the points of a cell are always too close to be kept.
+    reps = np.empty((0, 3))
+    keys = np.empty((0, 3), dtype=np.int64)
+    n_points = 0
+    for chunk in iter_xyz(path, chunk_size):
+        reps = np.vstack([reps, chunk])
+        keys = np.vstack([keys, np.floor(chunk / cell_size).astype(np.int64)])
+        first = ~pd.DataFrame(keys).duplicated(keep='first').values  # hash based, keeps the reading order
+        reps, keys = reps[first], keys[first]
+        n_points += chunk.shape[0]
+    return reps, n_points
+
+def spatial_subsample(path, data_folder, spatial_distance, chunk_size=CHUNK_SIZE, workers=None):
+    output_path = os.path.join(data_folder, get_file_name(path) + PC_EXT)
+    _print(f'Converting to XYZ and subsampling {get_file_name(path)} (native). Spatial distance: {spatial_distance} m')
+
+    reps, n_points = cell_representatives(path, spatial_distance / np.sqrt(3), chunk_size)
+    _print(f'{n_points} points read, {reps.shape[0]} occupied cells')
+    kept = reps[greedy_selection(reps.shape[0], neighbour_pairs(reps, spatial_distance, workers))]
+
+    # Second pass: points whose cell representative was removed may be far from every kept point
+    tree = si.build_index(kept)
+    uncovered = []
+    for chunk in iter_xyz(path, chunk_size):
+        distances, _ = si.knn(tree, chunk, 1, distance_upper_bound=spatial_distance)
+        uncovered.append(chunk[np.isinf(distances[:, 0])])
+    uncovered = np.vstack(uncovered)
+    if uncovered.shape[0]:
+        uncovered = uncovered[greedy_selection(uncovered.shape[0], neighbour_pairs(uncovered, spatial_distance, workers))]
+        kept = np.vstack([kept, uncovered])
+
+    savePC(output_path, kept)
+    _print(f'Conversion and subsampling {get_file_name(path)} completed: {kept.shape[0]} of {n_points} points kept')
+    return output_path
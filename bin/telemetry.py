@@ -0,0 +1,223 @@
+import os
+import csv
+import json
+import time
+import datetime
+import threading
+import subprocess
+from pathlib import Path
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import psutil  # optional: per-stage peak memory (including CloudCompare) and I/O counters
+except ImportError:
+    psutil = None
+try:
+    import resource  # POSIX fallback for the peak memory
+except ImportError:
+    resource = None
+
+SAMPLE_INTERVAL = 0.2  # seconds between memory samples
+CSV_FIELDS = ['stage', 'status', 'start', 'wall_s', 'cpu_s', 'cpu_children_s', 'cpu_exact', 'cpu_process_s', 'concurrent_stages',
+              'peak_rss_mb', 'read_mb', 'write_mb', 'input_points', 'output_points', 'input_mb', 'output_mb', 'points_per_s', 'subprocesses']
+
+_report = None
+_state = threading.local()  # stage being recorded by each thread (the scheduler runs stages concurrently)
+_lock = threading.Lock()
+_running = []  # records of the stages in progress, to flag the ones that overlapped
+
+def start_report(project_folder):
+    global _report
+    _report = {'project_folder': project_folder, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'psutil': psutil is not None, 'stages': []}
+    return _report
+
+def count_points(path):
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return None
+    if Path(path).suffix == '.npy':
+        return int(np.load(path, mmap_mode='r').shape[0])
+    return None  # text and CloudCompare formats would need a full read
+
+def describe_files(paths):
+    paths = [path for path in dict.fromkeys(paths) if isinstance(path, str) and os.path.isfile(path)]
+    counts = [count_points(path) for path in paths]
+    return {'files': paths,
+            'points': sum(counts) if paths and None not in counts else None,
+            'mb': round(sum(os.path.getsize(path) for path in paths) / 1024 ** 2, 3)}
+
+def _rss(process):
+    try:
+        return process.memory_info().rss + sum(child.memory_info().rss for child in process.children(recursive=True))
+    except psutil.Error:
+        return 0
+
+def _sample_children_cpu(process, cpu, first):
+    # CPU time of the child processes (CloudCompare, process pools) seen during the stage: children already
+    # running at the first sample only count from then
+    try:
+        children = process.children(recursive=True)
+    except psutil.Error:
+        return
+    for child in children:
+        try:
+            times = child.cpu_times()
+        except psutil.Error:
+            continue
+        start = cpu.get(child.pid, [times.user + times.system if first else 0.0])[0]
+        cpu[child.pid] = [start, times.user + times.system]
+
+def _sample_memory(process, stop, state):
+    first = True
+    while True:
+        state['peak'] = max(state['peak'], _rss(process))
+        _sample_children_cpu(process, state['children_cpu'], first)
+        first = False
+        if stop.wait(SAMPLE_INTERVAL):
+            break
+
+def _memory_sampler(pid=None):
+    state = {'peak': 0, 'children_cpu': {}}
+    if psutil is None:
+        return None, None, state
+    stop = threading.Event()
+    thread = threading.Thread(target=_sample_memory, args=(psutil.Process(pid), stop, state), daemon=True)
+    thread.start()
+    return thread, stop, state
+
+def _peak_rss_mb(state):
+    if state['peak']:
+        return round(state['peak'] / 1024 ** 2, 1)
+    if resource is not None:
+        # Without psutil only the peak of the whole run is available (kB on Linux)
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        return round(peak / 1024, 1)
+    return None
+
+def _io_counters():
+    if psutil is None:
+        return None
+    try:
+        return psutil.Process().io_counters()
+    except (psutil.Error, AttributeError):
+        return None
+
+@contextmanager
+def stage(name, inputs=()):
+    record = {'stage': name, 'status': 'running', 'start': datetime.datetime.now().isoformat(timespec='seconds'),
+              'inputs': describe_files(list(inputs)), 'outputs': [], 'subprocesses': [], 'concurrent_stages': []}
+    previous, _state.current = getattr(_state, 'current', None), record
+    with _lock:
+        for other in _running:
+            other['concurrent_stages'].append(name)
+            record['concurrent_stages'].append(other['stage'])
+        _running.append(record)
+    thread, stop, memory = _memory_sampler()
+    io_start = _io_counters()
+    times_start = os.times()
+    thread_start = time.thread_time()
+    wall_start = time.perf_counter()
+    try:
+        yield record
+        record['status'] = 'done'
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        wall = time.perf_counter() - wall_start
+        thread_cpu = time.thread_time() - thread_start
+        times_end = os.times()
+        io_end = _io_counters()
+        if thread is not None:
+            stop.set()
+            thread.join()
+        _state.current = previous
+        with _lock:
+            _running.remove(record)
+
+        # os.times() is process-wide: exact for a stage running alone (its worker threads, and its pool workers
+        # and CloudCompare processes once they exit). With concurrent stages it also counts the other stages, so
+        # the stage only gets the CPU time of its own thread and of the CloudCompare processes it started
+        process_cpu = times_end.user - times_start.user + times_end.system - times_start.system
+        record['wall_s'] = round(wall, 3)
+        record['cpu_exact'] = not record['concurrent_stages']
+        if record['cpu_exact']:
+            children_cpu = times_end.children_user - times_start.children_user + times_end.children_system - times_start.children_system
+            # Windows doesn't report the children in os.times(): psutil samples them instead
+            sampled = sum(last - start for start, last in memory['children_cpu'].values())
+            record['cpu_s'] = round(process_cpu, 3)
+            record['cpu_children_s'] = round(max(children_cpu, sampled, sum(p['cpu_s'] or 0 for p in record['subprocesses'])), 3)
+        else:
+            record['cpu_s'] = round(thread_cpu, 3)
+            record['cpu_children_s'] = round(sum(p['cpu_s'] or 0 for p in record['subprocesses']), 3)
+        record['cpu_process_s'] = round(process_cpu, 3)
+        record['peak_rss_mb'] = max([_peak_rss_mb(memory) or 0] + [p['peak_rss_mb'] or 0 for p in record['subprocesses']])
+        if io_start is not None and io_end is not None:
+            record['read_mb'] = round((io_end.read_bytes - io_start.read_bytes) / 1024 ** 2, 3)
+            record['write_mb'] = round((io_end.write_bytes - io_start.write_bytes) / 1024 ** 2, 3)
+        record['outputs'] = describe_files(list(record['outputs']))
+        if record['inputs']['points'] and wall > 0:
+            record['points_per_s'] = round(record['inputs']['points'] / wall, 1)
+        if _report is not None:
+            with _lock:
+                _report['stages'].append(record)
+                save_report()
+
+def run_CloudCompare(command, check=False):
+    # Drop-in replacement of subprocess.run for the CloudCompare calls, recording time and memory of the child
+    record = {'command': [str(arg) for arg in command[1:]], 'start': datetime.datetime.now().isoformat(timespec='seconds')}
+    times_start = os.times()
+    wall_start = time.perf_counter()
+    # The output goes through _print: with concurrent stages it is kept in the log of the stage that started it
+    from bin.utils import _print  # not at the top: utils imports telemetry
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+    thread, stop, memory = _memory_sampler(process.pid)
+    for line in process.stdout:
+        if line.strip():
+            _print(f"CloudCompare: {line.rstrip()}")
+    process.stdout.close()
+    if hasattr(os, 'wait4'):
+        # Resource usage of this child only (other stages may be waiting for their own CloudCompare)
+        _, status, usage = os.wait4(process.pid, 0)
+        returncode = process.returncode = os.waitstatus_to_exitcode(status)
+        cpu = usage.ru_utime + usage.ru_stime
+    else:
+        returncode = process.wait()
+        times_end = os.times()
+        cpu = times_end.children_user - times_start.children_user + times_end.children_system - times_start.children_system
+    if thread is not None:
+        stop.set()
+        thread.join()
+
+    record['returncode'] = returncode
+    record['wall_s'] = round(time.perf_counter() - wall_start, 3)
+    record['cpu_s'] = round(cpu, 3)
+    record['peak_rss_mb'] = round(memory['peak'] / 1024 ** 2, 1) if memory['peak'] else None
+    current = getattr(_state, 'current', None)
+    if current is not None:
+        current['subprocesses'].append(record)
+
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    return subprocess.CompletedProcess(command, returncode)
+
+def save_report():
+    # Written to a temporary file and renamed: batch.py reads telemetry.json while the job is running
+    folder = _report['project_folder']
+    path = os.path.join(folder, 'telemetry.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(_report, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+    path = os.path.join(folder, 'telemetry.csv')
+    with open(path + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for record in _report['stages']:
+            row = dict(record)
+            row.update(input_points=record['inputs']['points'], output_points=record['outputs']['points'],
+                       input_mb=record['inputs']['mb'], output_mb=record['outputs']['mb'],
+                       concurrent_stages=';'.join(record['concurrent_stages']), subprocesses=len(record['subprocesses']))
+            writer.writerow(row)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,259 @@
+import os
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import bin.spatial_index as si
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import DBSCAN
+from bin.utils import get_file_name, _print, loadPC, savePC, PC_EXT
+from bin.m3c2 import m3c2_native, read_m3c2_params
+import bin.cleaning as cleaning
+
+TILE_AXES = [0, 2]  # tiles are laid out on the XZ plane (cliff face), as the ROI, plots and volumes
+CHUNK_SIZE = 2000000
+
+def iter_chunks(pc_path, chunk_size=CHUNK_SIZE):
+    if Path(pc_path).suffix == PC_EXT:
+        pc = np.load(pc_path, mmap_mode='r')
+        columns = list(pc.dtype.names) if pc.dtype.names else None
+        for start in range(0, pc.shape[0], chunk_size):
+            chunk = pc[start:start + chunk_size]
+            if columns:
+                chunk = np.column_stack([chunk[column] for column in columns])
+            yield start, np.asarray(chunk, dtype=np.float64), columns
+    else:
+        _print(f'File {get_file_name(pc_path)} is not {PC_EXT}: it will be fully loaded before tiling')
+        pc = loadPC(pc_path)
+        columns = list(map(str, pc.columns)) if isinstance(pc, pd.DataFrame) else None
+        pc = np.asarray(pc, dtype=np.float64)
+        for start in range(0, pc.shape[0], chunk_size):
+            yield start, pc[start:start + chunk_size], columns
+
+def tile_memberships(xz, tile_size, halo):
+    # Every point belongs to its own tile (core) and to the halo of up to three neighbouring tiles
+    if halo >= tile_size:
+        raise ValueError(f"The tile halo ({halo}) must be smaller than the tile size ({tile_size})")
+    own = np.floor(xz / tile_size).astype(np.int64)
+    keys, rows, core = [], [], []
+    for dx in (-1, 0, 1):
+        for dz in (-1, 0, 1):
+            key = own + [dx, dz]
+            member = np.all((xz >= key * tile_size - halo) & (xz < (key + 1) * tile_size + halo), axis=1)
+            keys.append(key[member])
+            rows.append(np.flatnonzero(member))
+            core.append(np.full(member.sum(), dx == 0 and dz == 0))
+    keys, rows, core = np.concatenate(keys), np.concatenate(rows), np.concatenate(core)
+    order = np.lexsort((keys[:, 1], keys[:, 0]))
+    keys, rows, core = keys[order], rows[order], core[order]
+    unique, starts = np.unique(keys, axis=0, return_index=True)
+    ends = np.append(starts[1:], len(keys))
+    return [(tuple(key), rows[a:b], core[a:b]) for key, a, b in zip(unique.tolist(), starts, ends)]
+
+def split_tiles(pc_path, tile_size, halo, tiles_folder, chunk_size=CHUNK_SIZE):
+    _print(f'Splitting {get_file_name(pc_path)} in tiles of {tile_size} m with a halo of {halo} m')
+    if os.path.exists(tiles_folder):
+        shutil.rmtree(tiles_folder)
+    os.makedirs(tiles_folder)
+
+    tiles = {}
+    columns, n_cols, total = None, 0, 0
+    for start, chunk, columns in iter_chunks(pc_path, chunk_size):
+        n_cols = chunk.shape[1]
+        for key, rows, core in tile_memberships(chunk[:, TILE_AXES], tile_size, halo):
+            name = f'tile_{key[0]}_{key[1]}'
+            tile = tiles.setdefault(name, {'key': list(key), 'path': os.path.join(tiles_folder, name + '.bin'), 'rows': 0, 'core': 0})
+            with open(tile['path'], 'ab') as f:
+                np.column_stack([rows + start, core, chunk[rows]]).astype(np.float64).tofile(f)
+            tile['rows'] += len(rows)
+            tile['core'] += int(core.sum())
+        total += chunk.shape[0]
+
+    index = {'source': pc_path, 'columns': columns, 'n_cols': n_cols + 2, 'tile_size': tile_size, 'halo': halo,
+             'points': total, 'tiles': tiles}
+    with open(os.path.join(tiles_folder, 'tiles.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    _print(f'{total} points split in {len(tiles)} tiles')
+    return index
+
+def load_tile(index, name):
+    rows = np.fromfile(index['tiles'][name]['path'], dtype=np.float64).reshape(-1, index['n_cols'])
+    return rows[:, 0].astype(np.int64), rows[:, 1] > 0, rows[:, 2:]
+
+def stitch(parts, output_path):
+    arrays = [np.load(part, mmap_mode='r') for part in parts]
+    if not arrays:
+        raise ValueError(f"No tile produced results for {get_file_name(output_path)}")
+    total = sum(array.shape[0] for array in arrays)
+    output = np.lib.format.open_memmap(output_path, mode='w+', dtype=arrays[0].dtype, shape=(total,) + arrays[0].shape[1:])
+    position = 0
+    for array in arrays:
+        output[position:position + array.shape[0]] = array
+        position += array.shape[0]
+    output.flush()
+    del output
+    _print(f'{len(parts)} tiles stitched in {get_file_name(output_path)}: {total} points')
+    return output_path
+
+def tiled_outlier_filter(pc_path, nb_neighbors, std_ratio, output_folder, tile_size, halo, save_distances=False):
+    # Out-of-core version of cleaning.outlier_filter with the same tiles check: points whose k nearest neighbours
+    # may lie beyond the halo are solved again against the whole cloud, read in chunks
+    file_name = get_file_name(pc_path)
+    _print(f'Running statistical outlier filter {file_name} (tiled)')
+    tiles_folder = os.path.join(output_folder, f'tiles_{file_name}')
+    index = split_tiles(pc_path, tile_size, halo, tiles_folder)
+
+    # First pass: mean distance to the k nearest neighbours of the core points
+    incomplete = []
+    for name, tile in index['tiles'].items():
+        _, core, data = load_tile(index, name)
+        if not core.any():
+            continue
+        avg_distances, complete = cleaning.tile_knn_distances(data[:, :3], core, cleaning.tile_bounds(tile['key'], tile_size, halo), nb_neighbors)
+        np.save(os.path.join(tiles_folder, name + '__distances.npy'), avg_distances)
+        if not complete.all():
+            incomplete.append((name, np.flatnonzero(~complete), data[core][~complete, :3]))
+    if incomplete:
+        queries = np.concatenate([points for _, _, points in incomplete])
+        _print(f'{queries.shape[0]} points with neighbours beyond the tile halo: solved against the whole cloud')
+        exact = np.split(cleaning.exact_distances((chunk[:, :3] for _, chunk, _ in iter_chunks(pc_path)), queries, nb_neighbors),
+                         np.cumsum([len(positions) for _, positions, _ in incomplete])[:-1])
+        for (name, positions, _), distances in zip(incomplete, exact):
+            distances_path = os.path.join(tiles_folder, name + '__distances.npy')
+            avg_distances = np.load(distances_path)
+            avg_distances[positions] = distances
+            np.save(distances_path, avg_distances)
+
+    total, total_sq, count = 0.0, 0.0, 0
+    for name in index['tiles']:
+        distances_path = os.path.join(tiles_folder, name + '__distances.npy')
+        if not os.path.exists(distances_path):
+            continue
+        avg_distances = np.load(distances_path)
+        valid = avg_distances[np.isfinite(avg_distances)]
+        total += valid.sum()
+        total_sq += np.square(valid).sum()
+        count += valid.size
+    distance_threshold = cleaning.statistical_threshold(total, total_sq, count, std_ratio)
+    _print(f'Global mean distance threshold: {distance_threshold:.4f} m')
+
+    # Second pass: keep the core points under the global threshold
+    parts, distance_parts = [], []
+    for name in index['tiles']:
+        distances_path = os.path.join(tiles_folder, name + '__distances.npy')
+        if not os.path.exists(distances_path):
+            continue
+        _, core, data = load_tile(index, name)
+        avg_distances = np.load(distances_path)
+        keep = np.isfinite(avg_distances) & (avg_distances < distance_threshold)
+        parts.append(os.path.join(tiles_folder, name + '__outlier.npy'))
+        np.save(parts[-1], np.ascontiguousarray(data[core][keep, :3]))
+        if save_distances:
+            distance_parts.append(os.path.join(tiles_folder, name + '__sor_distances.npy'))
+            np.save(distance_parts[-1], cleaning.distances_table(data[core], avg_distances, keep).to_records(index=False))
+
+    output_path = stitch(parts, os.path.join(output_folder, file_name + '__outlier' + PC_EXT))
+    if save_distances:
+        # QA output: mean neighbour distance of every input point and whether it was kept (in tile order)
+        stitch(distance_parts, os.path.join(output_folder, file_name + '__sor_distances' + PC_EXT))
+    shutil.rmtree(tiles_folder)
+    _print("Statistical outlier filter done")
+    return output_path
+
+def tiled_m3c2(e1_path, e2_path, m3c2_param, m3c2_path, epoch1_path, epoch2_path, tile_size, halo):
+    epoch1_name = get_file_name(epoch1_path)
+    epoch2_name = get_file_name(epoch2_path)
+    output = os.path.join(m3c2_path, epoch1_name + "_vs_" + epoch2_name + "__m3c2" + PC_EXT)
+    params = read_m3c2_params(m3c2_param)
+
+    reach = max(np.hypot(params['search_scale'] / 2, params['search_depth'] / 2), params['normal_max_scale'] / 2, params['normal_scale'] / 2)
+    if halo < reach:
+        raise ValueError(f"The tile halo ({halo} m) must be at least the M3C2 search reach ({reach:.2f} m) to match a single-pass run")
+
+    _print("Running M3C2 algorithm (native engine, tiled) to compute the differences")
+    index1 = split_tiles(e1_path, tile_size, halo, os.path.join(m3c2_path, 'tiles_e1'))
+    index2 = split_tiles(e2_path, tile_size, halo, os.path.join(m3c2_path, 'tiles_e2'))
+
+    parts = []
+    for i, name in enumerate(index1['tiles']):
+        if name not in index2['tiles'] or index1['tiles'][name]['core'] == 0:
+            continue
+        _print(f'M3C2 tile {name} ({i + 1} of {len(index1["tiles"])})')
+        _, core, e1 = load_tile(index1, name)
+        _, _, e2 = load_tile(index2, name)
+        pc_df = m3c2_native(e1[:, :3], e2[:, :3], params, core_points=e1[core, :3])
+        parts.append(savePC(os.path.join(m3c2_path, 'tiles_e1', name + '__m3c2' + PC_EXT), pc_df))
+
+    stitch(parts, output)
+    shutil.rmtree(os.path.join(m3c2_path, 'tiles_e1'))
+    shutil.rmtree(os.path.join(m3c2_path, 'tiles_e2'))
+    _print("M3C2 algorithm completed successfully")
+    return output
+
+def tiled_dbscan_core(diff_filter, eps, min_samples, tile_size, halo):
+    if halo < eps:
+        raise ValueError(f"The tile halo ({halo}) must be at least eps ({eps}) to merge clusters across tiles")
+    points = diff_filter[['x', 'y', 'z']].values
+    n_points = points.shape[0]
+    _print(f'Running DBSCAN algorithm (tiled) for clustering the {n_points} points')
+
+    node = np.full(n_points, -1)             # cluster node of every point, computed in its own tile
+    is_core_sample = np.zeros(n_points, dtype=bool)
+    halo_points, halo_nodes = [], []
+    n_nodes = 0
+    tiles = tile_memberships(points[:, TILE_AXES], tile_size, halo)
+    for key, rows, core in tiles:
+        if not core.any():
+            continue
+        clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(points[rows])
+        labels = clustering.labels_
+        core_samples = np.zeros(len(rows), dtype=bool)
+        core_samples[clustering.core_sample_indices_] = True
+        tile_nodes = np.where(labels >= 0, labels + n_nodes, -1)
+        node[rows[core]] = tile_nodes[core]
+        is_core_sample[rows[core]] = core_samples[core]
+        in_halo = ~core & (labels >= 0)
+        halo_points.append(rows[in_halo])
+        halo_nodes.append(tile_nodes[in_halo])
+        n_nodes += labels.max() + 1 if len(labels) else 0
+
+    # A halo point reached by a cluster of a neighbouring tile links both clusters when it is a core point
+    # in its own tile (where its neighbourhood is complete)
+    halo_points = np.concatenate(halo_points) if halo_points else np.empty(0, dtype=int)
+    halo_nodes = np.concatenate(halo_nodes) if halo_nodes else np.empty(0, dtype=int)
+    link = is_core_sample[halo_points] & (node[halo_points] >= 0)
+    graph = coo_matrix((np.ones(link.sum()), (halo_nodes[link], node[halo_points[link]])), shape=(n_nodes, n_nodes))
+    _, component = connected_components(graph, directed=False)
+
+    labels = np.full(n_points, -1)
+    core_rows = np.flatnonzero(is_core_sample)
+    if core_rows.size:
+        # Clusters of the core points, numbered like scikit-learn: in the order of their first core point
+        core_labels = component[node[core_rows]]
+        first = np.full(component.max() + 1, n_points)
+        np.minimum.at(first, core_labels, core_rows)
+        used = np.flatnonzero(first < n_points)
+        rank = np.full(first.size, -1)
+        rank[used[np.argsort(first[used])]] = np.arange(used.size)
+        labels[core_rows] = rank[core_labels]
+
+        # Border points take the lowest label among their core neighbours, as in dbscan_grid. The halo is at
+        # least eps, so the neighbours of the points of a tile are all in the tile and its halo
+        for key, rows, core in tiles:
+            border = rows[core & ~is_core_sample[rows]]
+            tile_core = rows[is_core_sample[rows]]
+            if not border.size or not tile_core.size:
+                continue
+            _, idx, owner = si.radius_neighbours(si.build_index(points[tile_core]), points[border], eps, workers=-1, return_sorted=False)
+            lowest = np.full(border.size, np.iinfo(np.int64).max)
+            np.minimum.at(lowest, owner, labels[tile_core[idx]])
+            reached = lowest < np.iinfo(np.int64).max
+            labels[border[reached]] = lowest[reached]
+
+    labels_df = pd.DataFrame(labels.reshape((-1, 1)), columns=['rockfall_label'])
+    diff_cluster = pd.concat([diff_filter.reset_index(drop=True), labels_df], axis=1)
+    diff_cluster = diff_cluster[diff_cluster['rockfall_label'] >= 0]
+    _print(f'DBSCAN algorithm applied correctly: {diff_cluster.shape[0]} points in {diff_cluster["rockfall_label"].max()} clusters identified')
+    return diff_cluster
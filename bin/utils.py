@@ -3,9 +3,10 @@ import open3d as o3d
 from pathlib import Path
 import os
 import shutil
-import subprocess
+from bin.telemetry import run_CloudCompare
 import datetime
 from sklearn.cluster import DBSCAN
+from scipy.stats import norm
 import math
 import time
 import json
@@ -13,6 +14,11 @@ import pandas as pd
 import logging
 import webbrowser
 import sys
+import threading
+import tempfile
+from contextlib import contextmanager
+
+_log_buffer = threading.local()  # messages of the stages run by the scheduler, flushed in stage order
 
 def create_log(project_folder):
     current_time = datetime.datetime.now()
@@ -25,6 +31,7 @@ def create_log(project_folder):
         filemode="w",
         level=logging.INFO,
         format='%(message)s',
+        force=True,
     )
 
     start_message = f"Log file created on: {current_time.strftime('%d/%m/%Y at %H:%M:%S')}"
@@ -47,7 +54,7 @@ def check_path(path, path_name, warning, is_required=True):
     print(f"{path_name}: {status}")
     return warning
 
-def start_code(options, parameters, pointCloud, paths):
+def start_code(options, parameters, pointCloud, paths, confirm=True):
 
     GREEN = "\033[92m"
     RED = "\033[91m"
@@ -99,7 +106,7 @@ def start_code(options, parameters, pointCloud, paths):
 
     print('\033[1m\nFile Paths and PointClouds Verification:\033[0m')
     warning = False
-    warning = check_path(paths["CloudCompare"], "CloudCompare", warning)
+    warning = check_path(paths["CloudCompare"], "CloudCompare", warning, is_required=requires_CloudCompare(options))
     warning = check_path(paths["output"], "output", warning)
 
     if requires_two_clouds:
@@ -124,6 +131,11 @@ def start_code(options, parameters, pointCloud, paths):
     if warning:
         print("\n\033[91mWarning: One or more required paths were not found. Code will not run properly\033[0m")
 
+    if not confirm:
+        print("\n" + "=" * 50 + "\n")
+        _print("Executing the code")
+        return warning
+
     while True:
         user_response = input("\nDo you want to start the code with these parameters? (y/n): ").strip().lower()
         if user_response == "y":
@@ -135,11 +147,31 @@ def start_code(options, parameters, pointCloud, paths):
             sys.exit()
         else:
             print("\nInvalid input. Please enter 'y' or 'n'.")
+    return warning
+
+def requires_CloudCompare(options):
+    return any([options["transform_and_subsample"] and options.get("subsample_engine", "cloudcompare") == "cloudcompare", options["vegetation_filter"] and options.get("canupo_engine", "cloudcompare") == "cloudcompare", options["icp_registration"] and options.get("icp_engine", "cloudcompare") == "cloudcompare",
+                options["m3c2_dist"] and options.get("m3c2_engine", "cloudcompare") == "cloudcompare"])
+
+PC_EXT = '.npy'  # binary intermediate format shared by every stage
 
 def loadPC(path, array=False):
     _print(f'File {get_file_name(path)}: Loading')
     get_file_name(path)
 
+    if Path(path).suffix == PC_EXT:
+        pc = np.load(path, mmap_mode='r')
+        if pc.dtype.names is None:
+            _print(f'File {get_file_name(path)}: Loaded as NumPy array (memory-mapped)')
+            return pc
+        if array==True:
+            pc = np.column_stack([pc[name] for name in pc.dtype.names]).astype(np.float64)
+            _print(f'File {get_file_name(path)}: Loaded as NumPy array')
+            return pc
+        pc = pd.DataFrame({name: pc[name] for name in pc.dtype.names})
+        _print(f'File {get_file_name(path)}: Loaded as DataFrame. Number of points: {pc.shape[0]} with {pc.shape[1]} columns')
+        return pc
+
     if array==True:
         pc = np.loadtxt(path)
         _print(f'File {get_file_name(path)}: Loaded as NumPy array')
@@ -165,10 +197,101 @@ def loadPC(path, array=False):
     _print(f'Failed to load the file: {get_file_name(path)}')
     return None
 
+READ_CHUNK_SIZE = 2000000
+FLOAT32_LIMIT = 1e4  # columns with larger values (georeferenced coordinates) keep float64: float32 steps would exceed 1 mm
+PREDICATES = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}
+
+def iter_columns(path, columns, chunk_size=READ_CHUNK_SIZE):
+    # Chunks of the requested columns only, in the dtype of the file
+    if Path(path).suffix == PC_EXT:
+        pc = np.load(path, mmap_mode='r')
+        missing = [column for column in columns if pc.dtype.names is None or column not in pc.dtype.names]
+        if missing:
+            raise ValueError(f"File {get_file_name(path)} has no column {', '.join(missing)}")
+        for start in range(0, pc.shape[0], chunk_size):
+            chunk = pc[start:start + chunk_size]
+            yield {column: chunk[column] for column in columns}
+    else:
+        for chunk in pd.read_csv(path, sep=' ', usecols=columns, chunksize=chunk_size):
+            yield {column: chunk[column].values for column in columns}
+
+def read_columns(path, columns, where=None, dtype=np.float32, chunk_size=READ_CHUNK_SIZE):
+    # Column projection and predicate pushdown: only the requested columns are read and the rows are
+    # filtered while streaming, e.g. where=('m3c2_diff', '<', -0.05). Memory follows the selected points.
+    _print(f'File {get_file_name(path)}: Reading columns {", ".join(columns)}' + (f' where {" ".join(map(str, where))}' if where else ''))
+    names = list(dict.fromkeys(list(columns) + ([where[0]] if where else [])))
+    selected = {column: [] for column in columns}
+    wide = set()
+    n_points = 0
+    for chunk in iter_columns(path, names, chunk_size):
+        n_points += len(chunk[names[0]])
+        mask = PREDICATES[where[1]](chunk[where[0]], where[2]) if where else slice(None)
+        for column in columns:
+            values = np.asarray(chunk[column][mask])
+            if column not in wide and values.size and np.abs(values).max() > FLOAT32_LIMIT:
+                wide.add(column)
+            selected[column].append(values.astype(np.float64 if column in wide else dtype))
+    pc = pd.DataFrame({column: np.concatenate(selected[column]).astype(np.float64 if column in wide else dtype)
+                       if selected[column] else np.empty(0, dtype=dtype) for column in columns})
+    if wide:
+        _print(f'File {get_file_name(path)}: Columns {", ".join(sorted(wide))} kept as float64 (values over {FLOAT32_LIMIT:g})')
+    _print(f'File {get_file_name(path)}: {pc.shape[0]} of {n_points} points read')
+    return pc
+
+def loadO3D(path):
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(np.ascontiguousarray(loadPC(path, array=True)[:, :3], dtype=np.float64))
+    return pcd
+
+def saveO3D(path, pcd):
+    return savePC(path, np.asarray(pcd.points))
+
+def toASCII(path, folder):
+    if Path(path).suffix != PC_EXT:
+        return path
+    ascii_path = os.path.join(folder, Path(path).stem + '.xyz')
+    pc = loadPC(path, array=True)
+    np.savetxt(ascii_path, pc, fmt='%1.3f', delimiter=' ')
+    return ascii_path
+
+@contextmanager
+def ascii_copies(*paths):
+    # CloudCompare only reads text/standard formats: binary intermediates get a .xyz copy in a temporary folder
+    # next to them (same disk), deleted when the CloudCompare call is over, even if it fails
+    folders = []
+    try:
+        copies = []
+        for path in paths:
+            if Path(path).suffix == PC_EXT:
+                folders.append(tempfile.mkdtemp(prefix='.ascii_', dir=Path(path).parent))
+                path = toASCII(path, folders[-1])
+            copies.append(path)
+        yield copies
+    finally:
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+
+def fromASCII(ascii_path, path, columns=None, remove=True):
+    pc = np.loadtxt(ascii_path, ndmin=2)
+    if columns is not None:
+        pc = pd.DataFrame(pc[:, :len(columns)], columns=columns)
+    savePC(path, pc)
+    if remove:
+        os.remove(ascii_path)
+    return path
+
+def export_ascii(path):
+    if path is None or Path(path).suffix != PC_EXT or not os.path.exists(path):
+        return None
+    pc = loadPC(path)
+    output_path = str(Path(path).with_suffix('.xyz'))
+    savePC(output_path, pc)
+    return output_path
+
 def PCVisualization(path, enable=False):
     try:
         if enable:
-            pcd = o3d.io.read_point_cloud(path, format='xyz')
+            pcd = loadO3D(path)
             o3d.visualization.draw_geometries([pcd])
     except:
         print(f'ERROR: {path}')
@@ -179,7 +302,7 @@ def get_file_name(path):
     file_name = file_name.split('__')[0]
     return file_name
 
-def create_project_folders(output_path, epoch1_path, epoch2_path, file):
+def create_project_folders(output_path, epoch1_path, epoch2_path, file, overwrite='ask', folder_name=None, open_folder=True):
     timestamp = datetime.datetime.now().strftime('%y%m%d_%H%M%S')
     epoch1_name = get_file_name(epoch1_path)
     epoch2_name = get_file_name(epoch2_path)
@@ -189,9 +312,23 @@ def create_project_folders(output_path, epoch1_path, epoch2_path, file):
     warning = check_path(output_path, "output path", warning)
     if warning:
         print("\n\033[91mWarning: The output path is incorrect or does not exist. Change the output path in the JSON file and run PyRockDiff again.\033[0m")
+        if overwrite != 'ask':
+            raise FileNotFoundError(f"Output path not found: {output_path}")
         sys.exit()
 
-    while True:
+    if overwrite != 'ask':
+        # Non-interactive mode: the folder name and the overwrite policy come from the command line
+        project_path = os.path.join(output_path, folder_name or epoch1_name + '_to_' + epoch2_name)
+        if os.path.exists(project_path):
+            if overwrite == 'fail':
+                raise FileExistsError(f"Project folder already exists: {project_path}")
+            if overwrite == 'timestamp':
+                project_path = os.path.join(output_path, f"{timestamp}__{Path(project_path).name}")
+                print("\nThe folder already exists. It will be created with a new timestamp to avoid overwriting.")
+            else:
+                print("\nThe files in the folder will be overwritten.")
+
+    while overwrite == 'ask':
         filename = input(f"\nDefault folder name: {epoch1_name + '_to_' + epoch2_name}, do you want to modify it? (y/n):").strip().lower()
         if filename == 'y':
             while True:
@@ -212,7 +349,7 @@ def create_project_folders(output_path, epoch1_path, epoch2_path, file):
         else:
             print("\nInvalid input. Please enter 'y' or 'n'")
 
-    if os.path.exists(project_path):
+    if overwrite == 'ask' and os.path.exists(project_path):
         while True:
             overwrite = input(f"\n\033[91mWarning:\033[0m The folder '\033[94m{project_path}\033[0m' already exists. Do you want to overwrite the contents? (y/n) (If not, an automatic timestamp will be added): ").strip().lower()
             if overwrite == 'n':
@@ -229,8 +366,11 @@ def create_project_folders(output_path, epoch1_path, epoch2_path, file):
     except:
         print("\nERROR: Folder can't be created. Check the output path in the JSON file")
     shutil.copy(file, os.path.join(project_path, Path(file).name))
-    print(f"\nFolder created at: \033[94m{project_path}\033[0m\nThis folder will now be opened.")
-    webbrowser.open(project_path)
+    if open_folder:
+        print(f"\nFolder created at: \033[94m{project_path}\033[0m\nThis folder will now be opened.")
+        webbrowser.open(project_path)
+    else:
+        print(f"\nFolder created at: \033[94m{project_path}\033[0m")
     return project_path
 
 def create_folder(project_path, folder):
@@ -248,7 +388,17 @@ def savePC(path, pointcloud):
     pc_name = get_file_name(path)
     _print(f"Saving {pc_name} data in '{Path(path).parts[-2]}' folder")
 
-    if isinstance(pointcloud, pd.DataFrame):
+    if Path(path).suffix == PC_EXT:
+        if isinstance(pointcloud, pd.DataFrame):
+            records = np.empty(pointcloud.shape[0], dtype=[(str(column), pointcloud[column].dtype) for column in pointcloud.columns])
+            for column in pointcloud.columns:
+                records[str(column)] = pointcloud[column].values
+            np.save(path, records)
+        elif isinstance(pointcloud, np.ndarray):
+            np.save(path, np.ascontiguousarray(pointcloud))
+        else:
+            raise ValueError("Unsupported data type. Pointcloud must be a pandas DataFrame or a NumPy ndarray.")
+    elif isinstance(pointcloud, pd.DataFrame):
         pointcloud.to_csv(path, index=False, float_format='%.3f', sep=' ')
     elif isinstance(pointcloud, np.ndarray):
         np.savetxt(path, pointcloud, fmt='%1.3f', delimiter=' ')
@@ -270,30 +420,77 @@ def subsampling(path, spatial_distance, CloudComapare_path, subsample_folder):
                       "-SS", "SPATIAL", str(spatial_distance),
                       "-SAVE_CLOUDS", "FILE", f'"{output_path}"']
 
-    subprocess.run(CC_SUB_Command)
+    run_CloudCompare(CC_SUB_Command)
     _print(f'Subsampling {get_file_name(path)} completed')
 
     return os.path.join(subsample_folder, get_file_name(path) + "_sub.xyz")
 
-def density(path, CloudCompare_path, dbscan_folder):
-    output_path = os.path.join(dbscan_folder, get_file_name(path) + "__density.xyz")
-    radius = 0.25
-    _print(f'Computing point density {get_file_name(path)}. Sphere radius: {radius} m')
-    CC_DEN_Command = [CloudCompare_path,
-                      "-AUTO_SAVE", "OFF",
-                      "-C_EXPORT_FMT", "ASC", "-PREC", "3",
-                      "-O", path,
-                      "-DENSITY", str(radius), "-TYPE", "KNN",
-                      "-SAVE_CLOUDS", "FILE", f'"{output_path}"']
-
-    subprocess.run(CC_DEN_Command)
-    _print(f"Computing the median density points for ¨{get_file_name(path)}: Done")
-    time.sleep(5)
-    densPC = loadPC(output_path, array=True)
-    num_points = densPC[:,6].mean()
-    density_points = num_points/(math.pi*(radius**2))
-    spatial_distance = math.sqrt(1/density_points)
-    _print(f'Point cloud density: {density_points:.2f} points/m2')
+DENSITY_RADIUS = 0.25  # same sphere radius as the former CloudCompare -DENSITY call
+DENSITY_MAX_SAMPLE = 200000  # the neighbourhoods of the sample are indexed: this bounds the size of that tree
+
+def _xyz_source(pc):
+    # .npy clouds are memory-mapped: only the sampled rows and one chunk at a time are read
+    if isinstance(pc, (str, Path)):
+        return np.load(pc, mmap_mode='r') if Path(pc).suffix == PC_EXT else loadPC(pc, array=True)
+    if isinstance(pc, pd.DataFrame):
+        return pc[['x', 'y', 'z']].values
+    return pc
+
+def _xyz_rows(pc, rows):
+    chunk = pc[rows]
+    if pc.dtype.names:
+        chunk = np.column_stack([chunk[name] for name in pc.dtype.names[:3]])
+    return np.asarray(chunk[:, :3], dtype=np.float64)
+
+def _neighbour_counts(pc, sample, radius, tree=None, chunk_size=READ_CHUNK_SIZE):
+    # Neighbours of the sampled points (excluding themselves). Without a stored index, the cloud is streamed once
+    # and only the points within the radius of a sampled point are indexed, instead of the whole cloud
+    import bin.spatial_index as si  # not at the top: spatial_index imports utils
+    queries = _xyz_rows(pc, np.sort(sample))
+    if tree is None:
+        sample_tree = si.build_index(queries)
+        bound = np.nextafter(radius, np.inf)  # the radius query includes the points at exactly the radius
+        neighbourhood = []
+        for start in range(0, pc.shape[0], chunk_size):
+            chunk = _xyz_rows(pc, slice(start, start + chunk_size))
+            distances, _ = si.knn(sample_tree, chunk, 1, distance_upper_bound=bound)
+            neighbourhood.append(chunk[np.isfinite(distances[:, 0])])
+        tree = si.build_index(np.vstack(neighbourhood))
+    return si.radius_counts(tree, queries, radius) - 1
+
+def density(pc, radius=DENSITY_RADIUS, confidence=0.95, margin=0.02, pilot_size=1000, seed=0, max_sample_size=DENSITY_MAX_SAMPLE):
+    # Neighbours in a sphere (excluding the point itself, like CloudCompare KNN density) counted on a random
+    # sample of the cloud. The sample size keeps the confidence interval of the mean within +/- margin.
+    import bin.spatial_index as si  # not at the top: spatial_index imports utils
+    name = get_file_name(pc) if isinstance(pc, (str, Path)) else 'point cloud'
+    tree = si.load_index(str(pc)) if isinstance(pc, (str, Path)) and os.path.exists(pc) else None
+    source = _xyz_source(pc)
+    n_points = source.shape[0]
+    _print(f'Computing point density {name}. Sphere radius: {radius} m' + (' (stored spatial index)' if tree is not None else ''))
+    if n_points == 0:
+        raise ValueError(f"The density of {name} can't be computed: the cloud is empty")
+
+    rng = np.random.default_rng(seed)
+    z = norm.ppf(0.5 + confidence / 2)
+    pilot = rng.choice(n_points, min(pilot_size, n_points), replace=False)
+    counts = _neighbour_counts(source, pilot, radius, tree)
+    mean, std = counts.mean(), counts.std(ddof=1) if counts.size > 1 else 0.0
+    sample_size = min(n_points, max_sample_size, max(pilot.size, math.ceil((z * std / (margin * max(mean, 1e-9))) ** 2)))
+    if sample_size > pilot.size:
+        sample = rng.choice(n_points, sample_size, replace=False)
+        counts = _neighbour_counts(source, sample, radius, tree)
+        mean, std = counts.mean(), counts.std(ddof=1)
+    if mean == 0:
+        raise ValueError(f"The density of {name} can't be computed: no sampled point has neighbours within {radius} m "
+                         f"(the cloud is too sparse for this radius)")
+
+    # Finite population correction: the interval collapses when the whole cloud is used
+    half_width = z * std / math.sqrt(sample_size) * math.sqrt(max(n_points - sample_size, 0) / max(n_points - 1, 1))
+    area = math.pi * (radius ** 2)
+    density_points = mean / area
+    spatial_distance = math.sqrt(1 / density_points)
+    _print(f'Point cloud density: {density_points:.2f} points/m2 ({confidence:.0%} CI: {(mean - half_width) / area:.2f} - '
+           f'{(mean + half_width) / area:.2f}, {sample_size} of {n_points} points sampled)')
     _print(f'Point cloud spatial distance: {spatial_distance:.3f} m')
     return density_points, spatial_distance
 
@@ -307,14 +504,32 @@ def auto_param(density_points, radius, safety_factor):
 
 def _print(message):
     current_time = datetime.datetime.now()
-    formatted_time = current_time.strftime("[%d/%m/%Y - %H:%M]")
+    formatted_time = current_time.strftime("[%d/%m/%Y - %H:%M:%S]")
     full_message = f"{formatted_time} :: {message}"
+    messages = getattr(_log_buffer, 'messages', None)
+    if messages is not None:
+        messages.append(full_message)
+        return
     print(full_message)
     logging.info(full_message)
 
+def start_log_buffer():
+    _log_buffer.messages = []
+
+def stop_log_buffer():
+    messages = getattr(_log_buffer, 'messages', None) or []
+    _log_buffer.messages = None
+    return messages
+
+def flush_log(messages):
+    for message in messages:
+        print(message)
+        logging.info(message)
+
 def transform_subsample(CloudComapare_path, path, data_folder, spatial_distance):
 
-    output_path = os.path.join(data_folder, get_file_name(path) + ".xyz")
+    ascii_path = os.path.join(data_folder, get_file_name(path) + ".xyz")
+    output_path = os.path.join(data_folder, get_file_name(path) + PC_EXT)
     _print(f'Converting to XYZ and subsampling {get_file_name(path)}. Spatial distance: {spatial_distance} cm')
 
     CC_TRA_Command = [CloudComapare_path,
@@ -323,9 +538,10 @@ def transform_subsample(CloudComapare_path, path, data_folder, spatial_distance)
                       "-SS", "SPATIAL", str(spatial_distance),
                       "-C_EXPORT_FMT", "ASC", "-PREC", "3",
                       "-REMOVE_ALL_SFS", "-REMOVE_RGB", "-REMOVE_NORMALS",
-                      "-SAVE_CLOUDS", "FILE", f'"{output_path}"']
+                      "-SAVE_CLOUDS", "FILE", f'"{ascii_path}"']
 
-    subprocess.run(CC_TRA_Command)
+    run_CloudCompare(CC_TRA_Command)
+    fromASCII(ascii_path, output_path)
     _print(f'Conversiond and subsampling {get_file_name(path)} completed')
 
     return output_path
@@ -339,7 +555,7 @@ def transform_file(CloudComapare_path, path, data_folder):
                       "-O", path,
                       "-SAVE_CLOUDS", "FILE", f'"{output_path}"']
 
-    subprocess.run(CC_TRA_Command)
+    run_CloudCompare(CC_TRA_Command)
     time.sleep(5)
     pc_xyz = loadPC(output_path)
     pc_name = get_file_name(path)
@@ -376,15 +592,7 @@ def select_json_file():
             selection = int(input(f"\nSelect the file number (1-{len(json_files)}): ")) - 1
             if 0 <= selection < len(json_files):
                 file = os.path.join(json_directory, json_files[selection])
-
-                with open(file, 'r') as f:
-                    config = json.load(f)
-                    pointCloud = config['pointCloud']
-                    options = config['options']
-                    parameters = config['parameters']
-                    paths = config['paths']
-
-                return pointCloud, options, parameters, paths, file
+                return read_json_file(file)
 
             else:
                 print("ERROR: Invalid selection. Please try again (check that JSON file is properly created")
@@ -392,4 +600,12 @@ def select_json_file():
         except ValueError:
             print("ERROR: Invalid input. Please enter a number.")
 
+def read_json_file(file):
+    with open(file, 'r') as f:
+        config = json.load(f)
+        pointCloud = config['pointCloud']
+        options = config['options']
+        parameters = config['parameters']
+        paths = config['paths']
 
+    return pointCloud, options, parameters, paths, file
@@ -1,62 +1,83 @@
 from scipy.spatial import Delaunay
-import alphashape
-from shapely.geometry import Polygon, MultiPolygon
-from sklearn.neighbors import NearestNeighbors
+from scipy.spatial import QhullError
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from bin.utils import loadPC, _print, get_file_name
-from matplotlib.collections import PolyCollection
+import bin.spatial_index as si
+from matplotlib.collections import PolyCollection, LineCollection
 import pandas as pd
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import os
-import matplotlib
-matplotlib.use('TkAgg')  #Activate/Deactivate interactive plot
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 #TODO: use original epoch2 points instead of epoch1+diff
 
 def estimate_alpha(points, percentile=50):
-    nbrs = NearestNeighbors(n_neighbors=2, algorithm='ball_tree').fit(points)
-    distances, _ = nbrs.kneighbors(points)
+    distances, _ = si.knn(si.build_index(points), points, 2)
     typical_distance = np.percentile(distances[:, 1], percentile)
     return 1 / (typical_distance * 2)
 
+def circumradius(points, simplices):
+    a, b, c = points[simplices[:, 0]], points[simplices[:, 1]], points[simplices[:, 2]]
+    ab = np.linalg.norm(b - a, axis=1)
+    bc = np.linalg.norm(c - b, axis=1)
+    ca = np.linalg.norm(a - c, axis=1)
+    double_area = np.abs(np.cross(b - a, c - a))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        radius = ab * bc * ca / (2 * double_area)
+    radius[double_area == 0] = np.inf
+    return radius
+
+def fill_enclosed(tri, valid):
+    # The alpha shape polygon fills the holes enclosed by valid triangles: an invalid triangle is kept
+    # when its group of connected invalid triangles does not reach the convex hull.
+    invalid = np.flatnonzero(~valid)
+    if invalid.size == 0:
+        return valid
+    neighbors = tri.neighbors[invalid]
+    position = np.full(len(valid), -1)
+    position[invalid] = np.arange(invalid.size)
+    rows = np.repeat(np.arange(invalid.size), 3)
+    cols = position[neighbors.ravel()]
+    linked = (neighbors.ravel() >= 0) & (cols >= 0)
+    graph = coo_matrix((np.ones(linked.sum()), (rows[linked], cols[linked])), shape=(invalid.size, invalid.size))
+    _, component = connected_components(graph, directed=False)
+    outside = np.zeros(component.max() + 1, dtype=bool)
+    outside[component[(neighbors == -1).any(axis=1)]] = True
+    filled = valid.copy()
+    filled[invalid[~outside[component]]] = True
+    return filled
+
+def boundary_edges(simplices):
+    edges = np.sort(np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [2, 0]]]), axis=1)
+    unique, counts = np.unique(edges, axis=0, return_counts=True)
+    return unique[counts == 1]
+
 def alphashape_delaunay(points, alpha):
-    alpha_shape = alphashape.alphashape(points, alpha)
     tri = Delaunay(points)
-
-    valid_simplices = []
-    for simplex in tri.simplices:
-        triangle = Polygon(points[simplex])
-        if alpha_shape.contains(triangle.centroid):
-            valid_simplices.append(simplex)
-
-    return np.array(valid_simplices), alpha_shape
+    valid = circumradius(points, tri.simplices) < 1.0 / alpha
+    valid = fill_enclosed(tri, valid)
+    valid_simplices = tri.simplices[valid]
+    return valid_simplices, boundary_edges(valid_simplices)
 
 def calculate_triangle_volumes(points, simplices, diff):
-    volumes = []
-    for simplex in simplices:
-        triangle = points[simplex]
-        area = 0.5 * np.abs(np.cross(triangle[1] - triangle[0], triangle[2] - triangle[0]))
-        avg_diff = np.mean(diff[simplex])
-        volume = area * avg_diff
-        volumes.append(volume)
-    total_volume = np.sum(volumes)
+    if len(simplices) == 0:
+        return 0.0
+    triangles = points[simplices]
+    area = 0.5 * np.abs(np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]))
+    avg_diff = diff[simplices].mean(axis=1)
+    total_volume = np.sum(area * avg_diff)
     return total_volume
 
-def volume_plot(valid_simplices, alpha_shape, diff, auto_alpha, total_volume, points_xz, volume_folder, i, file_name):
+def volume_plot(valid_simplices, alpha_edges, diff, auto_alpha, total_volume, points_xz, volume_folder, i, file_name):
     try:
         fig, ax = plt.subplots(figsize=(6, 6))
-        for simplex in valid_simplices:
-            ax.plot(points_xz[simplex, 0], points_xz[simplex, 1], 'c-', linewidth=0.5, alpha=0.5)
-
-        if isinstance(alpha_shape, Polygon):
-            x, y = alpha_shape.exterior.xy
-            ax.plot(x, y, 'r--', linewidth=2)
-
-        elif isinstance(alpha_shape, MultiPolygon):
-            for poly in alpha_shape.geoms:
-                x, y = poly.exterior.xy
-                ax.plot(x, y, 'r--', linewidth=2)
+        ax.add_collection(LineCollection(points_xz[valid_simplices][:, [0, 1, 2, 0]], colors='c', linewidths=0.5, alpha=0.5))
+        ax.add_collection(LineCollection(points_xz[alpha_edges], colors='r', linestyles='--', linewidths=2))
 
         tri_diff = np.mean(diff[valid_simplices], axis=1)
         triangles = points_xz[valid_simplices]
@@ -95,29 +116,92 @@ def rockfall_db(volume_folder, rockfalls, volumes_db, file_name):
     merged_df = merged_df.round(4)
     merged_df.to_csv(os.path.join(volume_folder, file_name + '__db.csv'), sep=' ', index=False)
 
-def volume(e1ve2_DBSCAN_path, volume_folder):
+def cluster_volume(points_xz, diff):
+    auto_alpha = estimate_alpha(points_xz)
+    try:
+        valid_simplices, alpha_edges = alphashape_delaunay(points_xz, auto_alpha)
+    except (QhullError, ValueError):
+        return 0.0, np.empty((0, 3), dtype=int), np.empty((0, 2), dtype=int), auto_alpha
+    total_volume = calculate_triangle_volumes(points_xz, valid_simplices, diff)
+    return total_volume, valid_simplices, alpha_edges, auto_alpha
+
+def split_clusters(rockfalls):
+    labels = rockfalls['rockfall_label'].values
+    order = np.argsort(labels, kind='stable')
+    unique, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    return order, unique, starts, counts
+
+def _cluster_volume_task(label, points_xz, diff):
+    total_volume, valid_simplices, alpha_edges, auto_alpha = cluster_volume(points_xz, diff)
+    # The triangulation is kept for the plots (int32 indices: the clusters are far below 2^31 points)
+    shape = (valid_simplices.astype(np.int32), alpha_edges.astype(np.int32), auto_alpha)
+    return label, total_volume, auto_alpha, points_xz.shape[0], shape
+
+def volume(e1ve2_DBSCAN_path, volume_folder, workers=0):
     rockfalls = loadPC(e1ve2_DBSCAN_path)
     file_name = get_file_name(e1ve2_DBSCAN_path)
+    workers = workers or os.cpu_count() or 1
+
+    order, labels, starts, counts = split_clusters(rockfalls)
+    xz = rockfalls[['x', 'z']].values[order]
+    diff = rockfalls['m3c2_diff'].values[order]*(-1)
+    points_xz = [xz[start:start + count] for start, count in zip(starts, counts)]
+    diffs = [diff[start:start + count] for start, count in zip(starts, counts)]
+    _print(f"Computing volume for every cluster: {len(labels)} clusters using {workers} processes")
+
+    if workers > 1 and len(labels) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_cluster_volume_task, labels, points_xz, diffs,
+                                        chunksize=max(1, len(labels) // (workers * 4))))
+    else:
+        results = list(map(_cluster_volume_task, labels, points_xz, diffs))
 
     rockfall_volumes = []
-    _print("Computing volume for every cluster")
-
-    for i in range(rockfalls['rockfall_label'].max()+1):
-        _print(f'Computing volume: cluster {i} of {rockfalls["rockfall_label"].max()+1}')
-        rockfall = rockfalls[rockfalls["rockfall_label"] == i]
-        points_xz = rockfall[['x', 'z']].values
-        points_xyz = rockfall[['x', 'y', 'z']].values
-        diff = rockfall['m3c2_diff'].values*(-1)
-        y_diff = rockfall['y'].values+diff
-        auto_alpha = estimate_alpha(points_xz)
-        _print(f"Automatically calculated alpha: {auto_alpha}")
-        valid_simplices, alpha_shape = alphashape_delaunay(points_xz, auto_alpha)
-        total_volume = calculate_triangle_volumes(points_xz, valid_simplices, diff)
-        _print(f"Cluster {i}: Volume: {total_volume} m³")
+    shapes = {}
+    for i, total_volume, auto_alpha, n_points, shape in results:
+        _print(f"Cluster {i}: {n_points} points | alpha: {auto_alpha:.3f} | Volume: {total_volume} m³")
         rockfall_volumes.append({'rockfall_label': i, 'total_volume': total_volume})
-        volume_plot(valid_simplices, alpha_shape, diff, auto_alpha, total_volume, points_xz, volume_folder, i, file_name)
-        rockfall_plot(points_xyz, y_diff, valid_simplices, volume_folder, i, file_name)
+        shapes[i] = shape
 
-    volumes_db = pd.DataFrame(rockfall_volumes)
+    volumes_db = pd.DataFrame(rockfall_volumes, columns=['rockfall_label', 'total_volume'])
     rockfall_db(volume_folder, rockfalls, volumes_db, file_name)
-    return volumes_db
\ No newline at end of file
+    return volumes_db, shapes
+
+def _plot_clusters(e1ve2_DBSCAN_path, volume_folder, selected):
+    # selected: {label: (total_volume, valid_simplices, alpha_edges, auto_alpha)} computed by volume()
+    rockfalls = loadPC(e1ve2_DBSCAN_path)
+    file_name = get_file_name(e1ve2_DBSCAN_path)
+    order, labels, starts, counts = split_clusters(rockfalls)
+    xyz = rockfalls[['x', 'y', 'z']].values[order]
+    m3c2_diff = rockfalls['m3c2_diff'].values[order]
+
+    for i, start, count in zip(labels, starts, counts):
+        if i not in selected:
+            continue
+        points_xyz = xyz[start:start + count]
+        points_xz = points_xyz[:, [0, 2]]
+        diff = m3c2_diff[start:start + count]*(-1)
+        y_diff = points_xyz[:, 1]+diff
+        total_volume, valid_simplices, alpha_edges, auto_alpha = selected[i]
+        volume_plot(valid_simplices, alpha_edges, diff, auto_alpha, total_volume, points_xz, volume_folder, i, file_name)
+        rockfall_plot(points_xyz, y_diff, valid_simplices, volume_folder, i, file_name)
+    _print(f"Volume plots saved for {len(selected)} clusters")
+
+def _plot_clusters_background(e1ve2_DBSCAN_path, volume_folder, selected):
+    matplotlib.use('Agg')
+    _plot_clusters(e1ve2_DBSCAN_path, volume_folder, selected)
+
+def plot_volumes(e1ve2_DBSCAN_path, volume_folder, volumes_db, shapes, top=0, background=False):
+    volumes_db = volumes_db.sort_values('total_volume', ascending=False)
+    if top:
+        volumes_db = volumes_db.head(top)
+    # Only the triangulations of the plotted clusters are sent to the background process
+    selected = {label: (total_volume, *shapes[label]) for label, total_volume in zip(volumes_db['rockfall_label'], volumes_db['total_volume'])}
+    _print(f"Plotting {len(selected)} clusters" + (" (top by volume)" if top else "") + (" in the background" if background else ""))
+
+    if background:
+        process = multiprocessing.Process(target=_plot_clusters_background, args=(e1ve2_DBSCAN_path, volume_folder, selected))
+        process.start()
+        return process
+    _plot_clusters(e1ve2_DBSCAN_path, volume_folder, selected)
+    return None
@@ -16,97 +16,382 @@
 #TODO include verbososity option + Silent in cloudcompare
 
 ''' Import libraries '''
+import os
+import sys
+import argparse
+import traceback
+import matplotlib
 import bin.utils as utils
 import bin.registration as reg
-from bin.Boundary3D import main_2Dcut
+from bin.Boundary3D import main_2Dcut, raster_2Dcut, ROI_CELL_SIZE, ROI_CLOSING
 import bin.m3c2 as m3c2
 import bin.canupo as cp
 import bin.cleaning as cl
 import bin.clustering as rf
 import bin.volume as vl
+import bin.tiling as tl
+import bin.cache as ch
+import bin.telemetry as tm
+import bin.subsampling as ss
+import bin.monitoring as mn
+import bin.scheduler as sd
+import bin.inventory as inv
 
-pointCloud, options, parameters, paths, file = utils.select_json_file()
-
-project_folder = utils.create_project_folders(paths['output'], pointCloud['e1'], pointCloud['e2'], file)
-
-log_path = utils.create_log(project_folder)
-
-utils.start_code(options, parameters, pointCloud, paths)
-
-if options['transform_and_subsample']:
-    print("\nConverting PointClouds to XYZ and subsampling")
-    XYZ_sub_folder = utils.create_folder(project_folder, '1_XYZ_sub')
-    e1_sub_path = utils.transform_subsample(paths['CloudCompare'], pointCloud['e1'], XYZ_sub_folder, parameters['spatial_distance'])
-    e2_sub_path = utils.transform_subsample(paths['CloudCompare'], pointCloud['e2'], XYZ_sub_folder, parameters['spatial_distance'])
-else:
-    e1_sub_path = pointCloud['e1']
-    e2_sub_path = pointCloud['e2']
-
-if options['vegetation_filter']:
-    print("\nData vegetation filtering")
-    canupo_folder = utils.create_folder(project_folder, '1.2_canupo')
-    e1_canupo_path = cp.canupo_core(paths['CloudCompare'], e1_sub_path, paths['canupo_file'], canupo_folder)
-    e2_canupo_path = cp.canupo_core(paths['CloudCompare'], e2_sub_path, paths['canupo_file'], canupo_folder)
-else:
-    e1_canupo_path = e1_sub_path
-    e2_canupo_path = e2_sub_path
-
-if options['cleaning_filtering']:
-    print("\nStatistical outlier removal")
-    clean_folder = utils.create_folder(project_folder, '1.3_clean')
-    e1_filtered_path = cl.outlier_filter(e1_canupo_path, parameters['nb_neighbors_f'], parameters['std_ratio_f'], clean_folder)
-    e2_filtered_path = cl.outlier_filter(e2_canupo_path, parameters['nb_neighbors_f'], parameters['std_ratio_f'], clean_folder)
-else:
-    e1_filtered_path = e1_canupo_path
-    e2_filtered_path = e2_canupo_path
-
-if options['fast_registration']:
-    print("\nFast Global Registration")
-    registration_folder = utils.create_folder(project_folder, '2_registration')
-    e1_reg_path, e2_reg_path = reg.FGR_reg(parameters['voxel_size'], e1_filtered_path, e2_filtered_path, registration_folder, parameters['ite_FGR'])
-else:
-    e1_reg_path = e1_filtered_path
-    e2_reg_path = e2_filtered_path
-
-if options['icp_registration']:
-    print("\nICP registration")
-    registration_folder = utils.create_folder(project_folder, '2_registration')
-    e1_reg_path, e2_reg_path = reg.ICP_reg(e1_reg_path, e2_reg_path, paths['CloudCompare'], parameters['ite_ICP'])
-
-if options['roi_focus']:
-    print("\nROI clipping")
-    e1_RegCut_path, e2_RegCut_path = main_2Dcut(e1_reg_path, e2_reg_path, registration_folder)
-else:
-    e1_cut_path = e1_reg_path
-    e2_cut_path = e2_reg_path
-
-if options['m3c2_dist']:
-    print("\nM3C2 Computation")
-    m3c2_folder = utils.create_folder(project_folder, '3_change_detection')
-    e1e2_change_path = m3c2.m3c2_core(paths['CloudCompare'], e1_cut_path, e2_cut_path, paths['m3c2_param'], m3c2_folder, pointCloud['e1'], pointCloud['e2'])
-else:
-    e1e2_change_path = pointCloud['e1_e2']
-
-if options['auto_parameters']:
-    print("\nAuto DBSCAN parameters computation")
-    dbscan_folder = utils.create_folder(project_folder, '4_dbscan')
-    density_points, spatial_distance = utils.density(e1e2_change_path, paths['CloudCompare'], dbscan_folder)
-    parameters['min_samples_rockfalls'] = utils.auto_param(density_points, parameters['eps_rockfalls'], safety_factor=0.9)
-
-if options["rf_clustering"]:
-    print("\nClustering (DBSCAN)")
-    dbscan_folder = utils.create_folder(project_folder, '4_dbscan')
-    e1ve2_DBSCAN_path = rf.dbscan(dbscan_folder, e1e2_change_path, parameters)
-else:
-    e1ve2_DBSCAN_path = pointCloud['e1_e2']
-
-if options["rf_volume"]:
-    print("\nComputing volumes")
-    volume_folder = utils.create_folder(project_folder, '5_volume')
-    volumes_db = vl.volume(e1ve2_DBSCAN_path, volume_folder)
-
-print("\n" + "="*50)
-print("The code has finished running successfully!")
-print("\nResults are available at: \033[94m{}\033[0m".format(project_folder))
-print("Log can be found at: \033[92m{}\033[0m".format(log_path))
-print("="*50 + "\n")
\ No newline at end of file
+''' Exit codes '''
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_CONFIG_ERROR = 2
+EXIT_MISSING_PATHS = 3
+EXIT_FOLDER_EXISTS = 4
+EXIT_INTERRUPTED = 130
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PyRockDiff - Automatic change-detection workflow for rockfall identification")
+    parser.add_argument('config', nargs='?',
+                        help="JSON configuration file. If omitted, the file is selected interactively from json_files/")
+    parser.add_argument('-o', '--output', help="Output directory (overrides 'output' in the JSON paths)")
+    parser.add_argument('--name', help="Project folder name (default: <e1>_to_<e2>)")
+    parser.add_argument('--overwrite', choices=['ask', 'overwrite', 'timestamp', 'fail'],
+                        help="What to do if the project folder already exists (default: 'ask' in interactive runs, 'timestamp' otherwise)")
+    parser.add_argument('--no-gui', action='store_true',
+                        help="Headless mode: no windows, no file browser and no questions (uses the Agg matplotlib backend)")
+    parser.add_argument('-y', '--yes', action='store_true', help="Run without asking any question")
+    parser.add_argument('--monitor', action='store_true',
+                        help="Monitoring mode: compare every scan of 'epochs' in the JSON pointCloud against the reference e1")
+    parser.add_argument('--cache', action='store_true',
+                        help="Enable the stage cache: steps already computed with the same inputs and parameters are reused")
+    return parser.parse_args(argv)
+
+def subsample_epoch(epoch_path, options, parameters, paths, project_folder, cache=None):
+    utils._print(f"Converting {utils.get_file_name(epoch_path)} to XYZ and subsampling")
+    with tm.stage('subsample', [epoch_path]) as record:
+        XYZ_sub_folder = utils.create_folder(project_folder, '1_XYZ_sub')
+        sub_params = {'spatial_distance': parameters['spatial_distance'], 'engine': options.get('subsample_engine', 'cloudcompare')}
+        if options.get('subsample_engine', 'cloudcompare') == 'native' and ss.native_format(epoch_path):
+            sub_path = ch.run_stage(cache, 'subsample', [epoch_path], sub_params, ss.spatial_subsample, epoch_path, XYZ_sub_folder, parameters['spatial_distance'])
+        else:
+            if options.get('subsample_engine', 'cloudcompare') == 'native':
+                utils._print(f"Format of {utils.get_file_name(epoch_path)} can't be read natively: CloudCompare will be used")
+            sub_path = ch.run_stage(cache, 'subsample', [epoch_path], sub_params, utils.transform_subsample, paths['CloudCompare'], epoch_path, XYZ_sub_folder, parameters['spatial_distance'])
+        record['outputs'] = [sub_path]
+    return sub_path
+
+def canupo_epoch(epoch_path, options, parameters, paths, project_folder, cache=None):
+    utils._print(f"Vegetation filtering of {utils.get_file_name(epoch_path)}")
+    with tm.stage('canupo', [epoch_path]) as record:
+        canupo_folder = utils.create_folder(project_folder, '1.2_canupo')
+        canupo_params = {'engine': options.get('canupo_engine', 'cloudcompare'), 'rock_class': parameters.get('canupo_rock_class', 1)}
+        outputs = [os.path.join(canupo_folder, utils.get_file_name(epoch_path) + '__canupo' + utils.PC_EXT)]  # classified cloud, read by the cluster plots
+        if options.get('canupo_engine', 'cloudcompare') == 'native':
+            rock_path = ch.run_stage(cache, 'canupo', [epoch_path, paths['canupo_file']], canupo_params, cp.canupo_native, epoch_path, paths['canupo_file'], canupo_folder,
+                                     parameters.get('canupo_tile_size', cp.CANUPO_TILE_SIZE), parameters.get('canupo_workers', 0), parameters.get('canupo_rock_class', 1), outputs=outputs)
+        else:
+            rock_path = ch.run_stage(cache, 'canupo', [epoch_path, paths['canupo_file']], canupo_params, cp.canupo_core, paths['CloudCompare'], epoch_path, paths['canupo_file'], canupo_folder,
+                                     parameters.get('canupo_rock_class', 1), outputs=outputs)
+        record['outputs'] = [rock_path]
+    return rock_path
+
+def clean_epoch(epoch_path, options, parameters, paths, project_folder, cache=None):
+    utils._print(f"Statistical outlier removal of {utils.get_file_name(epoch_path)}")
+    with tm.stage('cleaning', [epoch_path]) as record:
+        clean_folder = utils.create_folder(project_folder, '1.3_clean')
+        clean_params = {key: parameters.get(key) for key in ['nb_neighbors_f', 'std_ratio_f', 'tile_size', 'tile_halo']}
+        clean_params['sor_distances'] = options.get('sor_distances', False)
+        outputs = [os.path.join(clean_folder, utils.get_file_name(epoch_path) + '__sor_distances' + utils.PC_EXT)] if options.get('sor_distances', False) else []
+        if parameters.get('tile_size', 0):
+            clean_path = ch.run_stage(cache, 'cleaning', [epoch_path], clean_params, tl.tiled_outlier_filter, epoch_path, parameters['nb_neighbors_f'], parameters['std_ratio_f'], clean_folder, parameters['tile_size'], parameters['tile_halo'],
+                                      options.get('sor_distances', False), outputs=outputs)
+        else:
+            clean_path = ch.run_stage(cache, 'cleaning', [epoch_path], clean_params, cl.outlier_filter, epoch_path, parameters['nb_neighbors_f'], parameters['std_ratio_f'], clean_folder,
+                                      parameters.get('sor_tile_size', cl.SOR_TILE_SIZE), parameters.get('sor_workers', 0), options.get('sor_distances', False),
+                                      spatial_index=options.get('spatial_index', False), outputs=outputs)
+        record['outputs'] = [clean_path]
+    return clean_path
+
+PREPROCESSING_STAGES = [('transform_and_subsample', subsample_epoch), ('vegetation_filter', canupo_epoch), ('cleaning_filtering', clean_epoch)]
+
+def preprocess_epochs(epoch_paths, options, parameters, paths, project_folder, cache=None):
+    # Every epoch is an independent chain of stages: the scheduler runs the chains concurrently
+    stages = [func for option, func in PREPROCESSING_STAGES if options[option]]
+    if not stages:
+        return list(epoch_paths)
+    print(f"\nPreprocessing {len(epoch_paths)} epochs: {', '.join(func.__name__.split('_')[0] for func in stages)}")
+
+    tasks = []
+    epoch_results = []
+    for i, epoch_path in enumerate(epoch_paths, start=1):
+        memory_gb = sd.estimate_memory_gb(epoch_path)
+        current = epoch_path
+        for func in stages:
+            tasks.append(sd.task(f'{func.__name__}:{i}', func, current, options, parameters, paths, project_folder, cache, memory_gb=memory_gb))
+            current = sd.Result(tasks[-1]['name'])
+        epoch_results.append(current)
+
+    results = sd.run_tasks(tasks, parameters.get('stage_workers', 1), parameters.get('stage_memory_gb', 0))
+    return [results[current.name] for current in epoch_results]
+
+def run_pipeline(pointCloud, options, parameters, paths, project_folder, gui=True, reference=None):
+    plots_process = cluster_plots_process = volumes_db = volume_shapes = None
+    cache = ch.open_cache(paths, options, parameters, project_folder)
+
+    if reference is None:
+        e1_filtered_path, e2_filtered_path = preprocess_epochs([pointCloud['e1'], pointCloud['e2']], options, parameters, paths, project_folder, cache)
+    else:
+        # Monitoring mode: the reference epoch was preprocessed once, only the new epoch is processed
+        e1_filtered_path = reference['cloud']
+        e2_filtered_path, = preprocess_epochs([pointCloud['e2']], options, parameters, paths, project_folder, cache)
+
+    if options.get('icp_engine', 'cloudcompare') == 'native' and (options['fast_registration'] or options['icp_registration']):
+        print("\nRegistration (FGR + ICP in memory)")
+        with tm.stage('registration', [e1_filtered_path, e2_filtered_path]) as record:
+            registration_folder = utils.create_folder(project_folder, '2_registration')
+            reg_params = {key: parameters.get(key) for key in ['voxel_size', 'ite_FGR', 'icp_voxel_levels', 'icp_max_distance', 'icp_max_iteration', 'icp_tolerance', 'registration_tolerance']}
+            reg_params.update(fgr=options['fast_registration'], icp=options['icp_registration'])
+            e1_reg_path, e2_reg_path = ch.run_stage(cache, 'registration_native', [e1_filtered_path, e2_filtered_path], reg_params,
+                                                    reg.native_registration, e1_filtered_path, e2_filtered_path, registration_folder, parameters,
+                                                    fgr=options['fast_registration'], icp=options['icp_registration'], gui=gui, reference=reference,
+                                                    outputs=[reg.registration_file(registration_folder, e2_filtered_path)])
+            record['outputs'] = [e1_reg_path, e2_reg_path]
+    else:
+        if options['fast_registration']:
+            print("\nFast Global Registration")
+            with tm.stage('fgr', [e1_filtered_path, e2_filtered_path]) as record:
+                registration_folder = utils.create_folder(project_folder, '2_registration')
+                fgr_params = {'voxel_size': parameters['voxel_size'], 'ite_FGR': parameters['ite_FGR'], 'registration_tolerance': parameters.get('registration_tolerance', 0)}
+                e1_reg_path, e2_reg_path = ch.run_stage(cache, 'fgr', [e1_filtered_path, e2_filtered_path], fgr_params,
+                                                        reg.FGR_reg, parameters['voxel_size'], e1_filtered_path, e2_filtered_path, registration_folder, parameters['ite_FGR'], gui=gui, reference=reference,
+                                                        tolerance=parameters.get('registration_tolerance', 0), outputs=[reg.registration_file(registration_folder, e2_filtered_path)])
+                record['outputs'] = [e1_reg_path, e2_reg_path]
+        else:
+            e1_reg_path = e1_filtered_path
+            e2_reg_path = e2_filtered_path
+
+        if options['icp_registration']:
+            print("\nICP registration")
+            with tm.stage('icp', [e1_reg_path, e2_reg_path]) as record:
+                registration_folder = utils.create_folder(project_folder, '2_registration')
+                icp_params = {key: parameters.get(key) for key in ['ite_ICP', 'voxel_size', 'registration_tolerance']}
+                e1_reg_path, e2_reg_path = ch.run_stage(cache, 'icp_cloudcompare', [e1_reg_path, e2_reg_path], icp_params,
+                                                        reg.ICP_reg, e1_reg_path, e2_reg_path, paths['CloudCompare'], parameters['ite_ICP'], parameters['voxel_size'],
+                                                        registration_folder=registration_folder, tolerance=parameters.get('registration_tolerance', 0),
+                                                        outputs=[reg.registration_file(registration_folder, e2_reg_path)])  # written or completed (after FGR) by the ICP
+                record['outputs'] = [e1_reg_path, e2_reg_path]
+
+    if options['roi_focus']:
+        print("\nROI clipping")
+        with tm.stage('roi', [e1_reg_path, e2_reg_path]) as record:
+            roi_folder = utils.create_folder(project_folder, '2_registration')
+            roi_params = {'engine': options.get('roi_engine', 'alphashape'), 'cell_size': parameters.get('roi_cell_size', ROI_CELL_SIZE),
+                          'closing': parameters.get('roi_closing', ROI_CLOSING)}
+            if options.get('roi_engine', 'alphashape') == 'raster':
+                e1_cut_path, e2_cut_path = ch.run_stage(cache, 'roi', [e1_reg_path, e2_reg_path], roi_params, raster_2Dcut, e1_reg_path, e2_reg_path, roi_folder,
+                                                        roi_params['cell_size'], roi_params['closing'], plot=gui)
+            else:
+                e1_cut_path, e2_cut_path = ch.run_stage(cache, 'roi', [e1_reg_path, e2_reg_path], roi_params, main_2Dcut, e1_reg_path, e2_reg_path, roi_folder, plot=gui)
+            record['outputs'] = [e1_cut_path, e2_cut_path]
+    else:
+        e1_cut_path = e1_reg_path
+        e2_cut_path = e2_reg_path
+
+    if options['m3c2_dist']:
+        print("\nM3C2 Computation")
+        with tm.stage('m3c2', [e1_cut_path, e2_cut_path]) as record:
+            m3c2_folder = utils.create_folder(project_folder, '3_change_detection')
+            m3c2_inputs = [e1_cut_path, e2_cut_path, paths['m3c2_param']]
+            m3c2_params = {'engine': options.get('m3c2_engine', 'cloudcompare'), 'tile_size': parameters.get('tile_size', 0), 'tile_halo': parameters.get('tile_halo'),
+                           'epochs': [utils.get_file_name(pointCloud['e1']), utils.get_file_name(pointCloud['e2'])]}
+            if parameters.get('tile_size', 0) and options.get('m3c2_engine', 'cloudcompare') == 'native':
+                e1e2_change_path = ch.run_stage(cache, 'm3c2_tiled', m3c2_inputs, m3c2_params, tl.tiled_m3c2, e1_cut_path, e2_cut_path, paths['m3c2_param'], m3c2_folder, pointCloud['e1'], pointCloud['e2'], parameters['tile_size'], parameters['tile_halo'])
+            else:
+                e1e2_change_path = ch.run_stage(cache, 'm3c2', m3c2_inputs, m3c2_params, m3c2.m3c2_core, paths['CloudCompare'], e1_cut_path, e2_cut_path, paths['m3c2_param'], m3c2_folder, pointCloud['e1'], pointCloud['e2'], options.get('m3c2_engine', 'cloudcompare'),
+                                                reference=(reference or {}).get('m3c2'), spatial_index=options.get('spatial_index', False))
+            record['outputs'] = [e1e2_change_path]
+    else:
+        e1e2_change_path = pointCloud['e1_e2']
+
+    if options['auto_parameters']:
+        print("\nAuto DBSCAN parameters computation")
+        with tm.stage('auto_parameters', [e1e2_change_path]):
+            density_points, spatial_distance = utils.density(e1e2_change_path)
+            parameters['min_samples_rockfalls'] = utils.auto_param(density_points, parameters['eps_rockfalls'], safety_factor=0.9)
+
+    if options["rf_clustering"]:
+        print("\nClustering (DBSCAN)")
+        with tm.stage('dbscan', [e1e2_change_path]) as record:
+            dbscan_folder = utils.create_folder(project_folder, '4_dbscan')
+            dbscan_params = {key: parameters.get(key) for key in ['diff_threshold', 'eps_rockfalls', 'min_samples_rockfalls', 'dbscan_engine', 'tile_size', 'tile_halo']}
+            e1ve2_DBSCAN_path = ch.run_stage(cache, 'dbscan', [e1e2_change_path], dbscan_params, rf.dbscan, dbscan_folder, e1e2_change_path, parameters)
+            record['outputs'] = [e1ve2_DBSCAN_path]
+        with tm.stage('cluster_plots', [e1ve2_DBSCAN_path]):
+            cluster_plots_process = rf.plot_clusters(e1ve2_DBSCAN_path, e1e2_change_path, dbscan_folder, parameters,
+                                                     background=parameters.get('cluster_plots_background', False))
+    else:
+        e1ve2_DBSCAN_path = pointCloud['e1_e2']
+
+    if options["rf_volume"]:
+        print("\nComputing volumes")
+        with tm.stage('volume', [e1ve2_DBSCAN_path]) as record:
+            volume_folder = utils.create_folder(project_folder, '5_volume')
+            volumes_db, volume_shapes = vl.volume(e1ve2_DBSCAN_path, volume_folder, parameters.get('volume_workers', 0))
+            record['outputs'] = [volumes_db]
+
+        if options.get('volume_plots', True):
+            print("\nVolume plots")
+            with tm.stage('volume_plots', [e1ve2_DBSCAN_path]):
+                plots_process = vl.plot_volumes(e1ve2_DBSCAN_path, volume_folder, volumes_db, volume_shapes,
+                                                top=parameters.get('volume_plots_top', 0),
+                                                background=parameters.get('volume_plots_background', False))
+
+    if options.get('rockfall_inventory', False) and (options['rf_clustering'] or options['rf_volume']):
+        print("\nRockfall inventory")
+        with tm.stage('inventory', [e1ve2_DBSCAN_path]) as record:
+            inventory_path = inv.inventory_path(paths)
+            events = inv.cluster_events(e1ve2_DBSCAN_path, volumes_db)
+            inv.add_run(inventory_path, project_folder, pointCloud['e1'], pointCloud['e2'], options, parameters, events)
+            record['outputs'] = [inventory_path]
+
+    for name, process in [('Cluster overview', cluster_plots_process), ('Volume', plots_process)]:
+        if process is not None:
+            utils._print(f"Waiting for the {name.lower()} plots running in the background")
+            process.join()
+            if process.exitcode != 0:
+                utils._print(f"ERROR: {name} plots finished with exit code {process.exitcode}")
+
+    if options.get('ascii_export', False):
+        print("\nExporting results to ASCII")
+        for result_path in [e1_reg_path, e2_reg_path, e1e2_change_path, e1ve2_DBSCAN_path]:
+            if result_path and os.path.abspath(result_path).startswith(os.path.abspath(project_folder)):
+                utils.export_ascii(result_path)
+
+def run_monitoring(pointCloud, options, parameters, paths, file, overwrite='timestamp', interactive=True, gui=True):
+    epochs = mn.expand_epochs(pointCloud.get('epochs', []), pointCloud['e1'])
+    if not epochs:
+        print("ERROR: Monitoring mode requires a list of scans in 'epochs' (JSON pointCloud)")
+        return EXIT_CONFIG_ERROR
+
+    warning = utils.start_code(options, parameters, dict(pointCloud, e2=epochs[0]), paths, confirm=interactive)
+    if warning and not interactive:
+        utils._print("ERROR: One or more required paths were not found")
+        return EXIT_MISSING_PATHS
+
+    try:
+        reference = mn.open_reference(pointCloud, options, parameters, paths)
+        if not reference['ready']:
+            utils.create_log(reference['folder'])
+            tm.start_report(reference['folder'])
+            utils._print(f"Monitoring: preprocessing the reference epoch {utils.get_file_name(pointCloud['e1'])} (only once)")
+            reference_path, = preprocess_epochs([pointCloud['e1']], options, parameters, paths, reference['folder'])
+            mn.save_reference(reference, reference_path, options, parameters, paths)
+        loaded = mn.load_reference(reference)
+    except KeyboardInterrupt:
+        utils._print("Execution interrupted by the user")
+        return EXIT_INTERRUPTED
+    except Exception:
+        utils._print(f"ERROR: The reference epoch can't be preprocessed\n{traceback.format_exc()}")
+        return EXIT_FAILURE
+
+    results = []
+    for i, epoch_path in enumerate(epochs):
+        print("\n" + "="*50)
+        print(f"Monitoring: epoch {i + 1} of {len(epochs)}: \033[94m{utils.get_file_name(epoch_path)}\033[0m")
+        print("="*50)
+        result = {'epoch': epoch_path, 'project_folder': None, 'status': 'failed'}
+        results.append(result)
+        if not os.path.exists(epoch_path):
+            print(f"ERROR: Point cloud not found: {epoch_path}")
+            continue
+        try:
+            # Every epoch gets its own project folder: asking for folder names would stop the series
+            project_folder = utils.create_project_folders(paths['output'], pointCloud['e1'], epoch_path, file,
+                                                          overwrite='timestamp' if overwrite == 'ask' else overwrite, open_folder=False)
+        except (FileExistsError, FileNotFoundError) as e:
+            print(f"ERROR: {e}")
+            continue
+        result['project_folder'] = project_folder
+        log_path = utils.create_log(project_folder)
+        tm.start_report(project_folder)
+        try:
+            run_pipeline(dict(pointCloud, e2=epoch_path), options, dict(parameters), paths, project_folder, gui=gui, reference=loaded)
+            result['status'] = 'done'
+        except KeyboardInterrupt:
+            utils._print("Execution interrupted by the user")
+            mn.save_summary(reference, results)
+            return EXIT_INTERRUPTED
+        except Exception:
+            utils._print(f"ERROR: PyRockDiff stopped because of an unexpected error\n{traceback.format_exc()}")
+            print("Log can be found at: \033[92m{}\033[0m".format(log_path))
+        mn.save_summary(reference, results)
+
+    failed = [result['epoch'] for result in results if result['status'] != 'done']
+    print("\n" + "="*50)
+    print(f"Monitoring finished: {len(results) - len(failed)} of {len(results)} epochs processed successfully")
+    for epoch_path in failed:
+        print(f"  Failed: \033[91m{epoch_path}\033[0m")
+    print("\nSummary: \033[94m{}\033[0m".format(os.path.join(reference['folder'], 'monitoring.json')))
+    print("="*50 + "\n")
+    return EXIT_FAILURE if failed else EXIT_OK
+
+def main(argv=None):
+    args = parse_args(argv)
+    interactive = not (args.no_gui or args.yes)
+    overwrite = args.overwrite or ('ask' if interactive else 'timestamp')
+    if args.no_gui:
+        matplotlib.use('Agg')
+
+    try:
+        if args.config:
+            pointCloud, options, parameters, paths, file = utils.read_json_file(args.config)
+        elif interactive:
+            pointCloud, options, parameters, paths, file = utils.select_json_file()
+        else:
+            print("ERROR: A JSON configuration file is required in non-interactive mode")
+            return EXIT_CONFIG_ERROR
+    except (OSError, ValueError, KeyError) as e:
+        print(f"ERROR: The JSON configuration file can't be read: {e}")
+        return EXIT_CONFIG_ERROR
+
+    if args.output:
+        paths['output'] = args.output
+    if args.cache:
+        options['stage_cache'] = True
+
+    if args.monitor or options.get('monitoring', False):
+        return run_monitoring(pointCloud, options, parameters, paths, file, overwrite, interactive=interactive, gui=not args.no_gui)
+
+    try:
+        project_folder = utils.create_project_folders(paths['output'], pointCloud['e1'], pointCloud['e2'], file,
+                                                      overwrite=overwrite, folder_name=args.name, open_folder=not args.no_gui)
+    except FileExistsError as e:
+        print(f"ERROR: {e}")
+        return EXIT_FOLDER_EXISTS
+    except FileNotFoundError as e:
+        print(f"ERROR: {e}")
+        return EXIT_MISSING_PATHS
+
+    log_path = utils.create_log(project_folder)
+    tm.start_report(project_folder)
+
+    warning = utils.start_code(options, parameters, pointCloud, paths, confirm=interactive)
+    if warning and not interactive:
+        utils._print("ERROR: One or more required paths were not found")
+        return EXIT_MISSING_PATHS
+
+    try:
+        run_pipeline(pointCloud, options, parameters, paths, project_folder, gui=not args.no_gui)
+    except KeyboardInterrupt:
+        utils._print("Execution interrupted by the user")
+        return EXIT_INTERRUPTED
+    except Exception:
+        utils._print(f"ERROR: PyRockDiff stopped because of an unexpected error\n{traceback.format_exc()}")
+        print("Log can be found at: \033[92m{}\033[0m".format(log_path))
+        return EXIT_FAILURE
+
+    print("\n" + "="*50)
+    print("The code has finished running successfully!")
+    print("\nResults are available at: \033[94m{}\033[0m".format(project_folder))
+    print("Log can be found at: \033[92m{}\033[0m".format(log_path))
+    print("="*50 + "\n")
+    return EXIT_OK
+
+if __name__ == '__main__':
+    sys.exit(main())